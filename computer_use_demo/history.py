@@ -0,0 +1,215 @@
+"""
+Message history that indexes the screenshot images it contains and keeps a running
+estimate of its size in tokens.
+"""
+
+import json
+import operator
+import uuid
+from collections import deque
+from typing import Any, Iterable, SupportsIndex
+
+from anthropic.types.beta import BetaMessageParam
+
+# Rough token cost of a downscaled screenshot, (width * height) / 750 for 1280x800.
+IMAGE_TOKENS = 1400
+CHARS_PER_TOKEN = 4
+
+
+class MessageHistory(list):
+    """
+    A list of API messages that keeps track of the tool_result images in the order
+    they were appended, so that old screenshots can be pruned without rescanning
+    the whole history on every step.
+
+    `append`, `extend` and `pop` maintain the index incrementally; any other
+    in-place change rebuilds it. Code that mutates the content of a message after
+    appending it must not add or remove tool_result images.
+
+    `session_id` identifies the history as an owner of images in the image store,
+    see `ImageStore.retain`. A copy or unpickled checkpoint gets a new one.
+    """
+
+    def __init__(self, messages: Iterable[BetaMessageParam] = ()):
+        super().__init__()
+        self.session_id = uuid.uuid4().hex
+        # (message, tool_result block, image block) in history order
+        self._images: deque[tuple[Any, dict, dict]] = deque()
+        self.estimated_tokens = 0
+        # the last message left without images by pruning, see `prune_images`
+        self._pruned_through: BetaMessageParam | None = None
+        self.cache_boundary: BetaMessageParam | None = None
+        self.extend(messages)
+
+    def __reduce__(self):
+        return (self.__class__, (list(self),))
+
+    @property
+    def image_count(self) -> int:
+        return len(self._images)
+
+    def image_refs(self) -> set[str]:
+        """Keys of the image store entries the history refers to."""
+        return {
+            image["source"]["ref"]
+            for _, _, image in self._images
+            if image["source"].get("type") == "image_ref"
+        }
+
+    def append(self, message: BetaMessageParam):
+        super().append(message)
+        self._images.extend(_iter_tool_result_images(message))
+        self.estimated_tokens += estimate_tokens(message)
+
+    def extend(self, messages: Iterable[BetaMessageParam]):
+        for message in messages:
+            self.append(message)
+
+    def pop(self, index: SupportsIndex = -1):
+        message = super().pop(index)
+        if operator.index(index) in (-1, len(self)):
+            while self._images and self._images[-1][0] is message:
+                self._images.pop()
+            self.estimated_tokens -= estimate_tokens(message)
+        else:
+            self._reindex()
+        return message
+
+    def insert(self, index: SupportsIndex, message: BetaMessageParam):
+        super().insert(index, message)
+        self._reindex()
+
+    def remove(self, message: BetaMessageParam):
+        super().remove(message)
+        self._reindex()
+
+    def clear(self):
+        super().clear()
+        self._images.clear()
+        self.estimated_tokens = 0
+        self._pruned_through = self.cache_boundary = None
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._reindex()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._reindex()
+
+    def __iadd__(self, messages: Iterable[BetaMessageParam]):
+        self.extend(messages)
+        return self
+
+    def _reindex(self):
+        self._images = deque(
+            image for message in self for image in _iter_tool_result_images(message)
+        )
+        self.estimated_tokens = sum(estimate_tokens(message) for message in self)
+        # e.g. compaction, which rewrites the start of the history
+        self._pruned_through = self.cache_boundary = None
+
+    def prune_images(self, images_to_keep: int, min_removal_threshold: int = 10):
+        """
+        Remove all but the final `images_to_keep` tool_result images in place, in
+        chunks of `min_removal_threshold`. Costs O(images removed).
+
+        Messages up to the last one pruned never change again, so
+        `cache_boundary` is a place for a prompt cache breakpoint that pruning
+        does not invalidate. It moves forward one call after a chunk is pruned:
+        the request sent right after the prune still reads the cache up to the
+        old boundary, while the new one gets cached.
+        """
+        self.cache_boundary = self._pruned_through
+        images_to_remove = len(self._images) - images_to_keep
+        if images_to_remove <= 0:
+            return
+        images_to_remove -= images_to_remove % min_removal_threshold
+        if not images_to_remove:
+            return
+
+        for _ in range(images_to_remove):
+            message, tool_result, image = self._images.popleft()
+            tool_result["content"].remove(image)
+        self.estimated_tokens -= images_to_remove * IMAGE_TOKENS
+        # a message that still holds an image changes again with the next chunk
+        if not (self._images and self._images[0][0] is message):
+            self._pruned_through = message
+
+    def compaction_split(self, tokens_to_keep: int) -> int:
+        """
+        Returns the number of leading messages to summarize so that roughly the most
+        recent `tokens_to_keep` tokens are kept verbatim. The split never separates
+        a tool_result from the tool_use it answers: the first kept message is either
+        an assistant turn or a user turn without tool results. Returns 0 when no
+        such split exists.
+        """
+        kept_tokens = 0
+        split = len(self)
+        for index in range(len(self) - 1, 0, -1):
+            kept_tokens += estimate_tokens(self[index])
+            if kept_tokens > tokens_to_keep:
+                break
+            split = index
+        while split < len(self) and not _can_start_history(self[split]):
+            split += 1
+        return split if split < len(self) else 0
+
+    def compact(self, split: int, summary: BetaMessageParam):
+        """Replace the first `split` messages with a single summary message."""
+        self[:split] = [summary]
+
+
+def _iter_tool_result_images(message: BetaMessageParam):
+    content = message["content"]
+    if not isinstance(content, list):
+        return
+    for item in content:
+        if not (isinstance(item, dict) and item.get("type") == "tool_result"):
+            continue
+        tool_result_content = item.get("content")
+        if not isinstance(tool_result_content, list):
+            continue
+        for block in tool_result_content:
+            if isinstance(block, dict) and block.get("type") == "image":
+                yield message, item, block
+
+
+def _can_start_history(message: BetaMessageParam) -> bool:
+    if message["role"] == "assistant":
+        return True
+    content = message["content"]
+    return not (
+        isinstance(content, list)
+        and any(
+            isinstance(item, dict) and item.get("type") == "tool_result"
+            for item in content
+        )
+    )
+
+
+def estimate_tokens(message: BetaMessageParam) -> int:
+    """Cheap estimate of the number of input tokens a message costs."""
+    content = message["content"]
+    if isinstance(content, str):
+        return len(content) // CHARS_PER_TOKEN
+    return sum(_estimate_block_tokens(block) for block in content)
+
+
+def _estimate_block_tokens(block: Any) -> int:
+    if not isinstance(block, dict):
+        # content blocks parsed from API responses
+        block = block.model_dump()
+    block_type = block.get("type")
+    if block_type == "image":
+        return IMAGE_TOKENS
+    if block_type == "text":
+        return len(block.get("text", "")) // CHARS_PER_TOKEN
+    if block_type == "tool_result":
+        content = block.get("content", "")
+        if isinstance(content, str):
+            return len(content) // CHARS_PER_TOKEN
+        return sum(_estimate_block_tokens(item) for item in content)
+    if block_type == "tool_use":
+        return len(json.dumps(block.get("input", {}))) // CHARS_PER_TOKEN
+    return len(json.dumps(block, default=str)) // CHARS_PER_TOKEN
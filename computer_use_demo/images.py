@@ -0,0 +1,169 @@
+"""
+Content-addressed store for the screenshots referenced by the message history.
+
+Tool results hold a short `image_ref` block instead of a base64 copy of the image,
+so the history, its pickled checkpoints and the screenshot callback never copy the
+image data. The raw bytes are kept once per distinct image, and the base64 text
+the API needs is produced only while a request is being built.
+"""
+
+import base64
+import hashlib
+import math
+import time
+from pathlib import Path
+from typing import Any
+
+from anthropic.types.beta import BetaMessageParam
+
+EXTENSIONS = {"image/png": "png", "image/jpeg": "jpeg", "image/webp": "webp"}
+
+
+def base64_size(size: int) -> int:
+    """Length of the base64 encoding of `size` bytes."""
+    return 4 * math.ceil(size / 3)
+
+
+def image_ref_block(key: str, media_type: str) -> dict[str, Any]:
+    """A history image block referring to an image in the store."""
+    return {
+        "type": "image",
+        "source": {"type": "image_ref", "ref": key, "media_type": media_type},
+    }
+
+
+class ImageStore:
+    """
+    Encoded images keyed by their SHA-256. With a `directory`, every image is also
+    written there once, which lets checkpoints that refer to it be resumed by a
+    later process and lets the bytes of images no history refers to anymore be
+    dropped from memory.
+    """
+
+    # how long an image no history has claimed is kept, e.g. the result of a tool
+    # call still in flight, before it is taken for one that was never used
+    unclaimed_seconds = 600.0
+
+    def __init__(self, directory: str | Path | None = None):
+        self.directory = Path(directory) if directory else None
+        self._images: dict[str, bytes] = {}
+        # session ids of the histories that refer to each image, see `retain`
+        self._owners: dict[str, set[str]] = {}
+        # when each image that no history refers to yet was stored
+        self._unclaimed: dict[str, float] = {}
+
+    def __len__(self):
+        return len(self._images)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(data) for data in self._images.values())
+
+    def put(self, data: bytes, media_type: str) -> str:
+        key = hashlib.sha256(data).hexdigest()
+        if key not in self._images:
+            self._images[key] = data
+            path = self.path(key, media_type)
+            if path is not None and not path.exists():
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(data)
+        if key not in self._owners:
+            self._unclaimed[key] = time.monotonic()
+        return key
+
+    def path(self, key: str, media_type: str) -> Path | None:
+        if self.directory is None:
+            return None
+        return self.directory / f"{key}.{EXTENSIONS.get(media_type, 'bin')}"
+
+    def get(self, key: str) -> bytes:
+        data = self._images.get(key)
+        if data is not None:
+            return data
+        if self.directory is not None:
+            for path in self.directory.glob(f"{key}.*"):
+                return path.read_bytes()
+        raise KeyError(f"Image {key} is not in the image store")
+
+    def base64(self, key: str) -> str:
+        return base64.b64encode(self.get(key)).decode()
+
+    def retain(self, owner: str, keys: set[str]):
+        """
+        Record that the history with session id `owner` now refers to exactly
+        `keys`. Images that no history refers to anymore are dropped, and so are
+        images never claimed by any history within `unclaimed_seconds`.
+        """
+        for key in keys:
+            self._owners.setdefault(key, set()).add(owner)
+            self._unclaimed.pop(key, None)
+        for key in [key for key, owners in self._owners.items() if owner in owners]:
+            if key in keys:
+                continue
+            owners = self._owners[key]
+            owners.discard(owner)
+            if not owners:
+                del self._owners[key]
+                self._images.pop(key, None)
+        cutoff = time.monotonic() - self.unclaimed_seconds
+        for key in [key for key, stored in self._unclaimed.items() if stored < cutoff]:
+            del self._unclaimed[key]
+            self._images.pop(key, None)
+
+
+_store = ImageStore()
+
+
+def get_image_store() -> ImageStore:
+    """The process-wide store used by the computer tool and the sampling loop."""
+    return _store
+
+
+def set_image_store(store: ImageStore):
+    global _store
+    _store = store
+
+
+def materialize_images(
+    messages: list[BetaMessageParam], store: ImageStore | None = None
+) -> list[BetaMessageParam]:
+    """
+    Return the messages with every `image_ref` block replaced by a base64 image
+    block, as the API expects. Messages without references are passed through, and
+    the base64 text lives only as long as the returned list.
+    """
+    store = store or get_image_store()
+    encoded: dict[str, str] = {}
+    materialized: list[BetaMessageParam] = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            materialized.append(message)
+            continue
+        blocks = [_materialize_block(block, store, encoded) for block in content]
+        if any(new is not old for new, old in zip(blocks, content)):
+            message = {**message, "content": blocks}
+        materialized.append(message)
+    return materialized
+
+
+def _materialize_block(block: Any, store: ImageStore, encoded: dict[str, str]) -> Any:
+    if not isinstance(block, dict):
+        return block
+    if block.get("type") == "image" and block["source"].get("type") == "image_ref":
+        source = block["source"]
+        if source["ref"] not in encoded:
+            encoded[source["ref"]] = store.base64(source["ref"])
+        return {
+            **block,
+            "source": {
+                "type": "base64",
+                "media_type": source["media_type"],
+                "data": encoded[source["ref"]],
+            },
+        }
+    if block.get("type") == "tool_result" and isinstance(block.get("content"), list):
+        content = [_materialize_block(item, store, encoded) for item in block["content"]]
+        if any(new is not old for new, old in zip(content, block["content"])):
+            return {**block, "content": content}
+    return block
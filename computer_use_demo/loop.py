@@ -5,12 +5,13 @@ Agentic sampling loop that calls the Anthropic API and local implenmentation of
 import asyncio
 import json
 import platform
-from collections.abc import Callable
+import time
+from collections.abc import Awaitable, Callable
 from datetime import datetime
 from enum import StrEnum
-from typing import Any, cast
+from typing import Any, TypeVar, cast
 
-from anthropic import Anthropic, AnthropicBedrock, AnthropicVertex, APIResponse
+from anthropic import AsyncAnthropic, APIResponse, APIStatusError, AsyncAPIResponse
 from anthropic.types import (
     ToolResultBlockParam,
 )
@@ -21,12 +22,33 @@ from anthropic.types.beta import (
     BetaMessage,
     BetaMessageParam,
     BetaTextBlockParam,
+    BetaToolParam,
     BetaToolResultBlockParam,
+    BetaToolUnionParam,
 )
 
-from openai import OpenAI
-
-from .tools import BashTool, ComputerTool, EditTool, ToolCollection, ToolResult
+from openai import AsyncOpenAI
+
+from .tools import (
+    BashJobsTool,
+    BashTool,
+    ComputerBatchTool,
+    ComputerTool,
+    ComputerZoomTool,
+    EditTool,
+    SessionPool,
+    ToolCollection,
+    ToolResult,
+)
+from .tools.capture import CaptureBackend
+from .tools.computer import OVERVIEW_WIDTH
+from .tools.collection import ToolBatch
+from .tools.encoding import ImageEncoding
+from .history import CHARS_PER_TOKEN, MessageHistory, estimate_tokens
+from .images import get_image_store, image_ref_block, materialize_images
+from .metrics import get_metrics
+from .routing import ModelRouter, Route
+from .scheduler import anthropic_usage, get_scheduler, is_retryable
 
 from llama_index.core import SummaryIndex
 from llama_index.readers.web import SimpleWebPageReader
@@ -43,6 +65,11 @@ logging.getLogger().addHandler(logging.StreamHandler(stream=sys.stdout))
 ######
 
 # BETA_FLAG = "computer-use-2024-10-22"
+COMPUTER_USE_BETA_FLAG = "computer-use-2024-10-22"
+PROMPT_CACHING_BETA_FLAG = "prompt-caching-2024-07-31"
+BETAS = [COMPUTER_USE_BETA_FLAG, PROMPT_CACHING_BETA_FLAG]
+
+T = TypeVar("T")
 
 
 # class APIProvider(StrEnum):
@@ -92,6 +119,10 @@ WORKER_SYSTEM_PROMPT = f"""<SYSTEM_CAPABILITY>
 * You and your manager will have access to the screen of the computer.
 * When viewing a page, it can be helpful to zoom out so that you can see everything on the page. Alternatively, ensure you scroll down to see everything before deciding something isn't available.
 * When instruction is provided to you through the text editor, please read it carefully, and follow it along with the manager's plan to complete the task.
+* When you already know several GUI steps in a row, such as clicking and filling in the fields of a form, run them in one call with the computer_batch tool instead of one computer action at a time.
+* Start commands that take a while, such as builds, installs or downloads, as background jobs with the bash_jobs tool and keep working while they run.
+* Screenshots are downsized. When you need to read small text or make out details, look at that region with the computer_zoom tool rather than guessing.
+* A screenshot of a screen that has not changed may be replaced by a note, and a mostly unchanged screen sent as a crop of the changed area. When you need to see the whole screen again, call the screenshot action with "full": true.
 * The current date is {datetime.today().strftime('%A, %B %-d, %Y')}.
 </SYSTEM_CAPABILITY>
 
@@ -109,7 +140,7 @@ MANAGER_SYSTEM_PROMPT = f"""<SYSTEM_CAPABILITY>
 </SYSTEM_CAPABILITY>
 
 <IMPORTANT>
-* Please do not use any tools! Just provide a plan in text format for the worker agent to complete the task.
+* Please do not use the computer, bash or editor tools! When asked for a decision, record it with the manager_decision tool. Otherwise just provide a plan in text format for the worker agent to complete the task.
 </IMPORTANT>
 """
 
@@ -118,15 +149,13 @@ QA_SYSTEM_PROMPT = f"""<SYSTEM_CAPABILITY>
 * You are working with a worker agent and a manager. All three of you will have access to the screen of the computer.
 * You will review the worker agent's output and determine if the task defined by the original instruction is completed.
 * The current date is {datetime.today().strftime('%A, %B %-d, %Y')}.
-* Please output in JSON format with the following keys:
+* Please record your verdict with the qa_verdict tool:
     * `is_complete`: boolean indicating if the worker agent's output is correct and complete and meets the goal defined by the original instruction.
     * `feedback`: string providing feedback on the worker agent's output.
-* Here is an example JSON output::
-    {{"is_complete": true, "feedback": "The worker agent's output is correct and complete and meets the goal defined by the original instruction."}}
 </SYSTEM_CAPABILITY>
 
 <IMPORTANT>
-* Please do not use any tools! Just respond with a JSON output.
+* Please do not use any tools other than qa_verdict!
 </IMPORTANT>
 """
 
@@ -146,26 +175,23 @@ def _user_message_to_form_faq(description: str):
             f"\n\nPlease make sure only the JSON output is returned, and nothing else."
             )
 
-def _update_chatbot_with_new_faq(computer_use_client: Anthropic, tool_collection: ToolCollection, juji_design: JujiDesign, juji_chatbot_engagement_id: str, messages: list[str], description: str):
+async def _update_chatbot_with_new_faq(computer_use_client: AsyncAnthropic, router: ModelRouter, tool_collection: ToolCollection, juji_design: JujiDesign, juji_chatbot_engagement_id: str, messages: list[str], description: str):
     """Update the chatbot with new FAQ"""
 
     # use the messages and the description to create a new FAQ
     user_message = _user_message_to_form_faq(description)
     print("User message:", user_message)
-    faq_generation_response = computer_use_client.beta.messages.with_raw_response.create(
-        max_tokens=4096,
+    faq_generation_response = await _create_message(computer_use_client, router, role="faq",
         messages=messages + [{
             "role": "user", 
             "content": user_message
             }],
-        model="claude-3-5-sonnet-20241022",
         system="You are a helpful assistant that can help with tasks.",
-        tools=tool_collection.to_params(),
-        betas=["computer-use-2024-10-22"]
+        tool_collection=tool_collection,
     )
 
-    print("FAQ generation response:", faq_generation_response.parse())
-    faq_generation_result = faq_generation_response.parse()
+    faq_generation_result = await faq_generation_response.parse()
+    print("FAQ generation response:", faq_generation_result)
     
     faq_json = json.loads(faq_generation_result.content[0].text)
     print("FAQ JSON:", faq_json)
@@ -173,7 +199,7 @@ def _update_chatbot_with_new_faq(computer_use_client: Anthropic, tool_collection
     answer = faq_json.get('answer', "")
     if question and answer:
         print("Adding FAQ to Juji:", question, answer)
-        resp = juji_design.add_faq([question], 
+        resp = await asyncio.to_thread(juji_design.add_faq, [question], 
                       [answer], 
                       juji_chatbot_engagement_id,)
         print("Juji response:", resp)
@@ -212,31 +238,45 @@ def _init_chatbot(chatbot: Chatbot):
     _store_chatbot_messages(all_chatbot_messages, juji_messages, "Juji")
     return all_chatbot_messages, participation
 
-def _check_further_query_needed(all_chatbot_messages: list[str], query: str, text_query_client: OpenAI):
+async def _check_further_query_needed(all_chatbot_messages: list[str], query: str, text_query_client: AsyncOpenAI):
     user_message = _user_message_to_check_further(query, all_chatbot_messages)
-    response = text_query_client.chat.completions.create(
-        model="gpt-4o-mini",
-        response_format={"type": "json_object"},
-        messages=[{"role": "user", "content": user_message}],
+    start = time.perf_counter()
+    response = await get_scheduler("openai").call(
+        lambda: text_query_client.chat.completions.create(
+            model="gpt-4o-mini",
+            response_format={"type": "json_object"},
+            messages=[{"role": "user", "content": user_message}],
+        ),
+        input_tokens=len(user_message) // CHARS_PER_TOKEN,
+        usage=lambda response: (response.usage.prompt_tokens, response.usage.completion_tokens) if response.usage else (0, 0),
+    )
+    get_metrics().record_llm_call(
+        role="chatbot_followup",
+        model=response.model,
+        usage={
+            "input_tokens": response.usage.prompt_tokens,
+            "output_tokens": response.usage.completion_tokens,
+        } if response.usage else None,
+        wall_time=time.perf_counter() - start,
     )
     print("Text query response:", response)
     response_json = json.loads(response.choices[0].message.content)
     return response_json
 
-def _query_chatbot(participation: Participation, all_chatbot_messages: list[str], query: str, text_query_client: OpenAI, follow_up_query: bool = False):
+async def _query_chatbot(participation: Participation, all_chatbot_messages: list[str], query: str, text_query_client: AsyncOpenAI, follow_up_query: bool = False):
     """Query the chatbot for information about the task"""
     further_query_count = 0
     print("Querying Juji for info about: ", query)
 
     print("You:", query)
     _store_chatbot_messages(all_chatbot_messages, [query], "You")
-    juji_messages = participation.send_chat_msg(query, response_timeout=20)
+    juji_messages = await asyncio.to_thread(participation.send_chat_msg, query, response_timeout=20)
     # TODO: check if messages are empty
     _print_chatbot_messages(juji_messages, "Juji")
     _store_chatbot_messages(all_chatbot_messages, juji_messages, "Juji")
 
     if follow_up_query:
-        response_json = _check_further_query_needed(all_chatbot_messages, query, text_query_client)
+        response_json = await _check_further_query_needed(all_chatbot_messages, query, text_query_client)
     else:
         response_json = {"further query needed": False, "chatbot does not know": False, "query suggestion": ""}
 
@@ -244,98 +284,111 @@ def _query_chatbot(participation: Participation, all_chatbot_messages: list[str]
         print("You:", response_json.get("query suggestion"))
         further_query_count += 1
         _store_chatbot_messages(all_chatbot_messages, [response_json.get("query suggestion")], "You")
-        juji_messages = participation.send_chat_msg(response_json.get("query suggestion"), response_timeout=20)
+        juji_messages = await asyncio.to_thread(participation.send_chat_msg, response_json.get("query suggestion"), response_timeout=20)
         _print_chatbot_messages(juji_messages, "Juji")
         _store_chatbot_messages(all_chatbot_messages, juji_messages, "Juji")
-        response_json = _check_further_query_needed(all_chatbot_messages, query, text_query_client)
+        response_json = await _check_further_query_needed(all_chatbot_messages, query, text_query_client)
     
     print("End chatbot query")
 
     return all_chatbot_messages, participation
 
-def _check_query_to_chatbot_needed(computer_use_client: Anthropic, tool_collection: ToolCollection, model: str, messages: list[BetaMessageParam], manager_system: str, api_response_callback: Callable[[APIResponse[BetaMessage]], None], session_number: int):
-    """Check if further query to the chatbot is needed"""
-
-    user_message = {
-        "role": "user",
-        "content": (
-            f"Given the INSTRUCTION, previous steps, and the previous plan, "
-            f"Juji chatbot's response, please advise if further query to the chatbot is needed, "
-            f"and if so, provide a suggestion for a query to Juji."
-            f"Please respond in JSON format with the following keys: "
-            f"\n\t- \"further query needed\": boolean indicating if further query is needed"
-            f"\n\t- \"query suggestion\": string providing a suggestion for a query to Juji"
-            f"Here are some examples of JSON output:"
-            f"\n\t{{\"further query needed\": true, \"query suggestion\": \"What is the capital of France?\"}}"
-            f"\n\t{{\"further query needed\": false, \"query suggestion\": \"\"}}"
-            f"\n\nPlease make sure only the JSON output is returned, and nothing else."
-        )
-    }
-
-    raw_response = computer_use_client.beta.messages.with_raw_response.create(
-        max_tokens=1024,
+MANAGER_DECISION_TOOL: BetaToolParam = {
+    "name": "manager_decision",
+    "description": "Record the manager's decision on how the worker agent should continue.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "query_chatbot": {
+                "type": "boolean",
+                "description": "Whether the Juji chatbot should be asked for more information before the worker continues.",
+            },
+            "chatbot_query": {
+                "type": "string",
+                "description": "The query to send to the Juji chatbot, or an empty string.",
+            },
+            "human_intervention_needed": {
+                "type": "boolean",
+                "description": "Whether a human needs to help because there is not enough information to complete the task.",
+            },
+            "query_to_human": {
+                "type": "string",
+                "description": "The question to ask the human, or an empty string.",
+            },
+            "plan": {
+                "type": "string",
+                "description": "The updated plan for the worker agent, or an empty string if the current plan should be kept.",
+            },
+        },
+        "required": ["query_chatbot", "chatbot_query", "human_intervention_needed", "query_to_human", "plan"],
+    },
+}
+
+QA_VERDICT_TOOL: BetaToolParam = {
+    "name": "qa_verdict",
+    "description": "Record whether the worker agent has achieved the goal of the instruction.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "is_complete": {
+                "type": "boolean",
+                "description": "Whether the worker agent's output is correct and complete and meets the goal defined by the original instruction.",
+            },
+            "feedback": {
+                "type": "string",
+                "description": "Feedback on the worker agent's output.",
+            },
+        },
+        "required": ["is_complete", "feedback"],
+    },
+}
+
+async def _manager_decide(computer_use_client: AsyncAnthropic, tool_collection: ToolCollection, router: ModelRouter, messages: list[BetaMessageParam], manager_system: str, api_response_callback: Callable[[APIResponse[BetaMessage]], None], session_number: int, user_message: BetaMessageParam) -> dict[str, Any]:
+    """Ask the manager for a structured decision through a forced manager_decision tool call"""
+
+    raw_response = await _create_message(computer_use_client, router, role="manager",
         system=manager_system,
         messages=messages + [user_message],
-        tools=tool_collection.to_params(),
-        model=model,
-        betas=["computer-use-2024-10-22"]
+        extra_tools=[MANAGER_DECISION_TOOL],
+        tool_choice={"type": "tool", "name": MANAGER_DECISION_TOOL["name"]},
+        tool_collection=tool_collection,
     )
 
     api_response_callback(cast(APIResponse[BetaMessage], raw_response), role="manager", session_number=session_number) 
 
-    response = raw_response.parse()
-    response_json = json.loads(response.content[0].text)
-    further_query_needed = response_json.get('further query needed', False)
-    query_suggestion = response_json.get('query suggestion', "")
-    if further_query_needed:
-        print("Further query needed:", query_suggestion)
-    return query_suggestion
+    response = await raw_response.parse()
+    for content_block in response.content:
+        if content_block.type == "tool_use" and content_block.name == MANAGER_DECISION_TOOL["name"]:
+            return cast(dict[str, Any], content_block.input)
+    return {}
 
-def _check_if_human_intervention_needed(computer_use_client: Anthropic, tool_collection: ToolCollection, model: str, messages: list[BetaMessageParam], manager_system: str, api_response_callback: Callable[[APIResponse[BetaMessage]], None], session_number: int):
-    """Check if human intervention is needed"""
+async def _qa_check(computer_use_client: AsyncAnthropic, tool_collection: ToolCollection, router: ModelRouter, messages: list[BetaMessageParam], qa_system: str, api_response_callback: Callable[[APIResponse[BetaMessage]], None], step: int, session_number: int) -> dict[str, Any]:
+    """Ask QA whether the goal has been achieved through a forced qa_verdict tool call"""
 
-    user_message = {
-        "role": "user",
-        "content": (
-            f"Given the INSTRUCTION, previous steps, and the previous plan, "
-            f"Juji chatbot's response, please advise if human intervention is needed or"
-            f" if there is enough information to complete the task, "
-            f"and if so, provide a suggestion for a query to Juji."
-            f"Please respond in JSON format with the following keys: "
-            f"\n\t- \"human intervention needed\": boolean indicating if human intervention is needed"
-            f"\n\t- \"query to human\": string providing a query to human"
-            f"Here are some examples of JSON output:"
-            f"\n\t{{\"human intervention needed\": true, \"query to human\": \"How do I change the avatar of the chatbot?\"}}"
-            f"\n\t{{\"human intervention needed\": false, \"query to human\": \"\"}}"
-            f"\n\nPlease make sure only the JSON output is returned, and nothing else."
-        )
-    }
-
-    raw_response = computer_use_client.beta.messages.with_raw_response.create(
-        max_tokens=1024,
-        system=manager_system,
-        messages=messages + [user_message],
-        tools=tool_collection.to_params(),
-        model=model,
-        betas=["computer-use-2024-10-22"]
+    raw_response = await _create_message(computer_use_client, router, role="qa",
+        system=qa_system,
+        messages=messages + [{
+            "role": "user",
+            "content": "Has the instruction goal been achieved? Please record your verdict.",
+        }],
+        extra_tools=[QA_VERDICT_TOOL],
+        tool_choice={"type": "tool", "name": QA_VERDICT_TOOL["name"]},
+        tool_collection=tool_collection,
     )
 
-    api_response_callback(cast(APIResponse[BetaMessage], raw_response), role="manager", session_number=session_number) 
-
-    response = raw_response.parse()
-    response_json = json.loads(response.content[0].text)
-    human_intervention_needed = response_json.get('human intervention needed', False)
-    query_to_human = response_json.get('query to human', "")
-    if human_intervention_needed:
-        return query_to_human
-
+    api_response_callback(cast(APIResponse[BetaMessage], raw_response), step, role="qa", session_number=session_number)
 
+    response = await raw_response.parse()
+    for content_block in response.content:
+        if content_block.type == "tool_use" and content_block.name == QA_VERDICT_TOOL["name"]:
+            return cast(dict[str, Any], content_block.input)
+    return {}
 
 async def _manager_check_progress(
         messages: list[BetaMessageParam], 
-        computer_use_client: Anthropic, 
-        text_query_client: OpenAI,
-        model: str, 
+        computer_use_client: AsyncAnthropic, 
+        text_query_client: AsyncOpenAI,
+        router: ModelRouter, 
         manager_system: str, 
         api_response_callback: Callable[[APIResponse[BetaMessage]], None],
         tool_collection: ToolCollection,
@@ -351,43 +404,58 @@ async def _manager_check_progress(
         pass
     else:
         if session_number > 0:
-            # check if further query to Juji chatbot is needed
-            query_suggestion = _check_query_to_chatbot_needed(computer_use_client, tool_collection, model, messages, manager_system, api_response_callback, session_number)
-            if query_suggestion:
-                all_chatbot_messages, chatbot_participation = _query_chatbot(chatbot_participation, all_chatbot_messages, query_suggestion, text_query_client)
-
-                # check if the chatbot does not know the answer and if human intervention is needed
-                query_to_human = _check_if_human_intervention_needed(computer_use_client, tool_collection, model, messages, manager_system, api_response_callback, session_number)
-                if query_to_human:
-                    human_input = input("Human intervention needed. Please help with the following query: \"" + query_to_human + "\". Press Enter to continue...")
-                    if juji_api_key and juji_chatbot_engagement_id:
-                        juji_platform_url = juji_platform_url or DEFAULT_JUJI_PLATFORM_URL
-                        juji_design = JujiDesign(juji_api_key, juji_platform_url)
-                        to_update_chatbot = input("Do you want to update the chatbot with your instructions? (y/n)")
-                        if to_update_chatbot == "y":
-                            _update_chatbot_with_new_faq(computer_use_client, tool_collection, juji_design, juji_chatbot_engagement_id, [], f"The user intervened the agent with the following instructions: {to_update_chatbot}.")
- 
-                    user_message = {
+            # a single structured decision covers the chatbot query, human intervention and the plan
+            decision = await _manager_decide(computer_use_client, tool_collection, router, messages, manager_system, api_response_callback, session_number, {
+                "role": "user",
+                "content": (
+                    f"Given the INSTRUCTION, previous steps, the previous plan and "
+                    f"Juji chatbot's response, please decide how the worker agent should continue: "
+                    f"whether a further query to the Juji chatbot is needed{'' if chatbot_participation else ' (no chatbot is available)'}, "
+                    f"whether human intervention is needed because there is not enough information to complete the task, "
+                    f"and whether the plan needs to be updated."
+                )
+            })
+            if chatbot_participation and decision.get("query_chatbot") and decision.get("chatbot_query"):
+                print("Further query needed:", decision["chatbot_query"])
+                all_chatbot_messages, chatbot_participation = await _query_chatbot(chatbot_participation, all_chatbot_messages, decision["chatbot_query"], text_query_client)
+
+                # follow up only now that the chatbot has returned new information
+                chatbot_message = {
                     "role": "user",
                     "content": 
-                        (f"Given the INSTRUCTION and context, previous steps, the previous plan, "
-                        f"the following interaction history between you and Juji, and the human advise, "
+                        f"Given the INSTRUCTION and context, previous steps, the previous plan, and "
+                        f"the following interaction history between you and Juji, "
                         f"\n\ninteraction history between you and Juji: \"\"\"\n{all_chatbot_messages}\n\"\"\""
-                        f"\n\nhuman advise: \"\"\"\n{human_input}\n\"\"\""
-                        f"please adjust the plan for the agent to continue completing the task. Please do not use any tools."
-                        )
-                    }
-                else:
-                    user_message = {
-                        "role": "user",
-                        "content": 
-                            f"Given the INSTRUCTION and context, previous steps, the previous plan, and "
-                            f"the following interaction history between you and Juji, "
-                            f"\n\ninteraction history between you and Juji: \"\"\"\n{all_chatbot_messages}\n\"\"\""
-                            f"please adjust the plan for the agent to continue completing the task. Please do not use any tools."
-                    }
-            else:
-                return None
+                        f"please decide if human intervention is needed and adjust the plan for the agent to continue completing the task."
+                }
+                print("User message:", chatbot_message)
+                messages.append(chatbot_message)
+                decision = await _manager_decide(computer_use_client, tool_collection, router, messages, manager_system, api_response_callback, session_number, {
+                    "role": "user",
+                    "content": "Please record your decision. Do not query the chatbot again.",
+                })
+
+            query_to_human = decision.get("query_to_human")
+            if not (decision.get("human_intervention_needed") and query_to_human):
+                return decision.get("plan") or None
+
+            human_input = input("Human intervention needed. Please help with the following query: \"" + query_to_human + "\". Press Enter to continue...")
+            if juji_api_key and juji_chatbot_engagement_id:
+                juji_platform_url = juji_platform_url or DEFAULT_JUJI_PLATFORM_URL
+                juji_design = JujiDesign(juji_api_key, juji_platform_url)
+                to_update_chatbot = input("Do you want to update the chatbot with your instructions? (y/n)")
+                if to_update_chatbot == "y":
+                    await _update_chatbot_with_new_faq(computer_use_client, router, tool_collection, juji_design, juji_chatbot_engagement_id, [], f"The user intervened the agent with the following instructions: {human_input}.")
+
+            user_message = {
+                "role": "user",
+                "content": 
+                    (f"Given the INSTRUCTION and context, previous steps, the previous plan, "
+                    f"the interaction history between you and Juji, and the human advise, "
+                    f"\n\nhuman advise: \"\"\"\n{human_input}\n\"\"\""
+                    f"please adjust the plan for the agent to continue completing the task. Please do not use any tools."
+                    )
+            }
         else:
             # if Juji returns info, use it to generate the plan
             if all_chatbot_messages:
@@ -411,37 +479,32 @@ async def _manager_check_progress(
         # Call the API to get some planning and context
         print("User message:", user_message)
         messages.append(user_message)
-    raw_response = computer_use_client.beta.messages.with_raw_response.create(
-        max_tokens=1024,
+    raw_response = await _create_message(computer_use_client, router, role="manager",
         system=manager_system,
         messages=messages,
-        tools=tool_collection.to_params(),
-        model=model,
-        betas=["computer-use-2024-10-22"]
+        tool_collection=tool_collection,
     )
-    await asyncio.sleep(0)
 
     api_response_callback(cast(APIResponse[BetaMessage], raw_response), role="manager", session_number=session_number) 
 
-    response = raw_response.parse()
+    response = await raw_response.parse()
 
     if hasattr(response.content[0], "text"):
         return response.content[0].text
     else:
         return None
 
-def _manager_report_progress(
+async def _manager_report_progress(
     messages: list[BetaMessageParam], 
-    computer_use_client: Anthropic, 
-    model: str, 
+    computer_use_client: AsyncAnthropic, 
+    router: ModelRouter, 
     manager_system: str,
     api_response_callback: Callable[[APIResponse[BetaMessage]], None],
     tool_collection: ToolCollection,
 ):
     
     # Call the API to get some planning and context
-    raw_response = computer_use_client.beta.messages.with_raw_response.create(
-        max_tokens=1024,
+    raw_response = await _create_message(computer_use_client, router, role="manager",
         system=manager_system,
         messages=messages + [{
             "role": "user",
@@ -449,19 +512,269 @@ def _manager_report_progress(
                 f"Given the INSTRUCTION, what the worker agent has done, and the QA agent's assessment (if any), "
                 "please generate a short report on what has been done and whether the goal has been achieved.",
          }],
-        tools=tool_collection.to_params(),
-        model=model,
-        betas=["computer-use-2024-10-22"]
+        tool_collection=tool_collection,
     )
 
-    response = raw_response.parse()
+    response = await raw_response.parse()
     api_response_callback(None, role="manager", final_report=response.content[0].text) 
 
+async def _create_message(
+    computer_use_client: AsyncAnthropic,
+    router: ModelRouter,
+    *,
+    role: str,
+    system: str,
+    messages: list[BetaMessageParam],
+    tool_collection: ToolCollection,
+    extra_tools: list[BetaToolParam] | None = None,
+    max_tokens: int | None = None,
+    **params: Any,
+) -> AsyncAPIResponse[BetaMessage]:
+    """
+    Create a message with the model and settings routed for `role`, returning the raw
+    response, and record the call in the metrics. Roles that do not use the computer
+    tools get the history with tool blocks rendered as text, so the tool definitions
+    can be left out. Falls back to the route's secondary model when overloaded.
+    """
+    route = router.route(role)
+    tools = _cached_tool_params(tool_collection) if route.use_tools else []
+    tools += extra_tools or []
+    if tools:
+        params["tools"] = tools
+    if not route.use_tools:
+        messages = _flatten_tool_blocks(messages)
+
+    max_tokens = max_tokens or route.max_tokens
+    input_tokens = len(system) // CHARS_PER_TOKEN + sum(estimate_tokens(message) for message in messages)
+    messages = materialize_images(messages)
+    raw_response, model, wall_time = await _call_with_fallback(
+        route,
+        role,
+        lambda model: computer_use_client.beta.messages.with_raw_response.create(
+            model=model,
+            max_tokens=max_tokens,
+            system=_cached_system(system),
+            messages=messages,
+            betas=BETAS,
+            **params,
+        ),
+        input_tokens=input_tokens,
+        output_tokens=max_tokens,
+        usage=anthropic_usage,
+    )
+
+    response = await raw_response.parse()
+    get_metrics().record_llm_call(
+        role=role,
+        model=model,
+        usage=response.usage.model_dump(),
+        wall_time=wall_time,
+        request_bytes=len(raw_response.http_request.content),
+    )
+    print(f"### {role} call to {model} took {wall_time:.2f}s")
+    return raw_response
+
+
+async def _call_with_fallback(
+    route: Route,
+    role: str,
+    request: Callable[[str], Awaitable[T]],
+    *,
+    input_tokens: int,
+    output_tokens: int,
+    usage: Callable[[T], tuple[int, int]],
+) -> tuple[T, str, float]:
+    """
+    Run `request(model)` through the shared scheduler with each of the route's
+    models in turn, moving on to the fallback when a model is overloaded, and
+    record failed calls in the metrics. Returns the result, the model that
+    produced it and the time spent on that model.
+    """
+    scheduler = get_scheduler("anthropic")
+    metrics = get_metrics()
+    for model in route.models:
+        # an overloaded model with a fallback left is not retried, the fallback is used instead
+        has_fallback = model != route.models[-1]
+        start = time.perf_counter()
+        try:
+            result = await scheduler.call(
+                lambda: request(model),
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                usage=usage,
+                retryable=lambda e: is_retryable(e) and not (has_fallback and getattr(e, "status_code", None) == 529),
+            )
+        except APIStatusError as e:
+            metrics.record_llm_call(role=role, model=model, usage=None, wall_time=time.perf_counter() - start, error=type(e).__name__)
+            if e.status_code == 529 and has_fallback:
+                print(f"### {model} is overloaded, falling back for {role}")
+                continue
+            raise
+        except Exception as e:
+            metrics.record_llm_call(role=role, model=model, usage=None, wall_time=time.perf_counter() - start, error=type(e).__name__)
+            raise
+        return result, model, time.perf_counter() - start
+    raise AssertionError("the last model is never skipped")
+
+
+async def _compact_history(
+    messages: MessageHistory,
+    computer_use_client: AsyncAnthropic,
+    router: ModelRouter,
+    manager_system: str,
+    api_response_callback: Callable[[APIResponse[BetaMessage]], None],
+    tool_collection: ToolCollection,
+    session_number: int,
+    tokens_to_keep: int,
+):
+    """Replace the oldest turns of the history with a summary written by the manager."""
+    split = messages.compaction_split(tokens_to_keep)
+    if not split:
+        return
+
+    print(f"### Compacting {split} messages (~{messages.estimated_tokens} tokens in history)")
+    raw_response = await _create_message(computer_use_client, router, role="manager",
+        system=manager_system,
+        messages=list(messages[:split]) + [{
+            "role": "user",
+            "content":
+                f"The conversation above is about to be removed from the history to save space. "
+                "Please summarize it for the worker agent: the plan, what has been done so far, "
+                "what worked and what did not, and any facts (URLs, file paths, names, values) "
+                "needed to continue the task. Please do not use any tools.",
+        }],
+        tool_collection=tool_collection,
+        max_tokens=2048,
+    )
+
+    api_response_callback(cast(APIResponse[BetaMessage], raw_response), role="manager", session_number=session_number)
+
+    response = await raw_response.parse()
+    summary = "\n".join(block.text for block in response.content if block.type == "text")
+    messages.compact(split, {
+        "role": "user",
+        "content": f"Here is a summary of the earlier progress provided by the manager:\n{summary}",
+    })
+    print(f"### History compacted to ~{messages.estimated_tokens} tokens")
+
+
+async def _stream_worker_step(
+    computer_use_client: AsyncAnthropic,
+    tool_collection: ToolCollection,
+    *,
+    route: Route,
+    system: str,
+    messages: list[BetaMessageParam],
+    output_callback: Callable[[BetaContentBlock], None],
+    tool_output_callback: Callable[[ToolResult, str], None],
+) -> tuple[BetaMessage, ToolBatch, float | None]:
+    """
+    Stream a worker response and submit each tool_use block to the tool batch as
+    soon as its input is complete, instead of waiting for the whole message.
+    Returns the final message, the batch of tool calls and the time from request
+    to first tool action.
+
+    Requests go through the scheduler and the route's fallback model like any
+    other call, and are retried until a tool has started. A stream that fails
+    after that cannot be replayed, so the turn keeps the blocks received in full.
+    """
+    start = time.perf_counter()
+    batch = tool_collection.batch(on_result=tool_output_callback)
+    input_tokens = len(system) // CHARS_PER_TOKEN + sum(estimate_tokens(message) for message in messages)
+    messages = materialize_images(messages)
+
+    async def request(model: str) -> tuple[BetaMessage, int]:
+        async with computer_use_client.beta.messages.stream(
+            max_tokens=route.max_tokens,
+            messages=messages,
+            model=model,
+            system=_cached_system(system),
+            tools=_cached_tool_params(tool_collection),
+            betas=BETAS,
+        ) as stream:
+            request_bytes = len(stream.response.request.content)
+            completed: list[BetaContentBlock] = []
+            try:
+                async for event in stream:
+                    if event.type != "content_block_stop":
+                        continue
+                    content_block = stream.current_message_snapshot.content[event.index]
+                    completed.append(content_block)
+                    output_callback(content_block)
+                    if content_block.type == "tool_use":
+                        batch.submit(
+                            name=content_block.name,
+                            tool_input=cast(dict[str, Any], content_block.input),
+                            tool_use_id=content_block.id,
+                        )
+                return await stream.get_final_message(), request_bytes
+            except Exception as e:
+                if not len(batch):
+                    raise
+                print(f"### Worker stream failed after a tool started ({e}), keeping the completed blocks")
+                get_metrics().increment("worker_stream_interrupted_total")
+                return stream.current_message_snapshot.model_copy(
+                    update={"content": completed, "stop_reason": "tool_use"}
+                ), request_bytes
+
+    try:
+        (response, request_bytes), model, _ = await _call_with_fallback(
+            route,
+            "worker",
+            request,
+            input_tokens=input_tokens,
+            output_tokens=route.max_tokens,
+            usage=lambda result: (
+                result[0].usage.input_tokens + (result[0].usage.cache_creation_input_tokens or 0),
+                result[0].usage.output_tokens,
+            ),
+        )
+    except BaseException:
+        batch.cancel()
+        raise
+
+    metrics = get_metrics()
+    metrics.record_llm_call(
+        role="worker",
+        model=model,
+        usage=response.usage.model_dump(),
+        wall_time=time.perf_counter() - start,
+        request_bytes=request_bytes,
+    )
+
+    first_action_at = (
+        batch.first_started_at - start if batch.first_started_at is not None else None
+    )
+    if first_action_at is not None:
+        metrics.observe("time_to_first_action_seconds", first_action_at)
+        print(
+            f"### Time to first action: {first_action_at:.2f}s "
+            f"(response complete at {time.perf_counter() - start:.2f}s)"
+        )
+    return response, batch, first_action_at
+
+
+async def _collect_tool_results(batch: ToolBatch) -> list[BetaToolResultBlockParam]:
+    """Wait for a batch of tool calls and convert the results in tool_use order."""
+    results = await batch.results()
+    if len(batch) > 1:
+        timing = batch.timing
+        get_metrics().observe("tool_batch_wall_seconds", timing.wall_time)
+        get_metrics().observe("tool_batch_overlap_seconds", timing.overlap)
+        print(
+            f"### Tool batch: {len(batch)} calls in {timing.wall_time:.2f}s "
+            f"(serial {timing.serial_time:.2f}s, overlap {timing.overlap:.2f}s)"
+        )
+    return [
+        _make_api_tool_result(result, tool_use_id) for tool_use_id, result in results
+    ]
+
+
 async def sampling_loop(
     *,
     model: str,
-    computer_use_client: Anthropic,
-    text_query_client: OpenAI,
+    computer_use_client: AsyncAnthropic,
+    text_query_client: AsyncOpenAI,
     messages: list[BetaMessageParam],
     instruction: str,
     output_callback: Callable[[BetaContentBlock], None],
@@ -478,167 +791,327 @@ async def sampling_loop(
     total_sessions: int = 0,
     all_chatbot_messages: list[str] = [],
     chatbot_participation: Participation | None = None,
+    stream: bool = False,
+    context_token_budget: int | None = None,
+    router: ModelRouter | None = None,
+    capture_backend: CaptureBackend | str = "pyautogui",
+    screenshot_encoding: ImageEncoding | None = None,
+    unchanged_screenshot_threshold: int | None = 0,
+    region_diff_screenshots: float | None = None,
+    settle_after_actions: bool = False,
+    prefetch_screenshots: bool = True,
+    screenshot_overview_width: int = OVERVIEW_WIDTH,
+    slow_command_seconds: float | None = 30.0,
 ):
     """
     Agentic sampling loop for the assistant/tool interaction of computer use.
+
+    With `stream=True` the worker response is consumed through the streaming API
+    and each tool call starts as soon as its tool_use block has been received.
+
+    When the estimated size of the history exceeds `context_token_budget` tokens,
+    the oldest turns are replaced with a summary from the manager, keeping roughly
+    the most recent half of the budget verbatim.
+
+    `router` picks the model, max_tokens and tool set for each role. By default the
+    worker uses `model` and `max_tokens`, and the manager, QA and FAQ calls use a
+    fast model that falls back to `model` when overloaded.
+
+    `capture_backend` is the screen capture backend of the computer tool, or its
+    name (see `tools.capture`), and `screenshot_encoding` the format screenshots
+    are sent in (PNG by default). A screenshot of a screen that has not changed
+    since the last image sent is replaced by a short note, and with
+    `region_diff_screenshots` a mostly unchanged screen is sent as a crop of the
+    changed area; see `ComputerTool` for both settings. `settle_after_actions`
+    makes GUI actions wait for the screen to stop changing and return a
+    screenshot. With `prefetch_screenshots` a screenshot is captured and encoded
+    while the model works on its next turn, and used if it asks for one.
+    Screenshots are downsized to `screenshot_overview_width` pixels wide, and the
+    computer_zoom tool shows a region at full resolution. Bash commands running
+    for `slow_command_seconds` or longer are flagged in their result and metrics.
     """
+    router = router or ModelRouter.default(worker_model=model, worker_max_tokens=max_tokens)
     # print("#####total_sessions:", total_sessions)
     # print("#####messages:", messages)
+    # Callers that need to see the history while the loop runs should pass a
+    # MessageHistory, since a plain list is copied here.
+    if not isinstance(messages, MessageHistory):
+        messages = MessageHistory(messages)
+
+    computer_tool = ComputerTool(
+        capture_backend=capture_backend,
+        encoding=screenshot_encoding,
+        unchanged_threshold=unchanged_screenshot_threshold,
+        region_diff=region_diff_screenshots,
+        settle=settle_after_actions,
+        overview_width=screenshot_overview_width,
+    )
+    bash_pool = SessionPool(slow_command_seconds)
     tool_collection = ToolCollection(
-        ComputerTool(),
-        BashTool(),
+        computer_tool,
+        ComputerBatchTool(computer_tool),
+        ComputerZoomTool(computer_tool),
+        BashTool(pool=bash_pool),
+        BashJobsTool(bash_pool),
         EditTool(),
     )
 
-    system = (
-        f"{WORKER_SYSTEM_PROMPT}\n\n<INSTRUCTION>\n{instruction}\n</INSTRUCTION>"
-    )
+    try:
+        system = (
+            f"{WORKER_SYSTEM_PROMPT}\n\n<INSTRUCTION>\n{instruction}\n</INSTRUCTION>"
+        )
 
-    manager_system = (
-        f"{MANAGER_SYSTEM_PROMPT}\n\n<INSTRUCTION>\n{instruction}\n</INSTRUCTION>"
-    )
+        manager_system = (
+            f"{MANAGER_SYSTEM_PROMPT}\n\n<INSTRUCTION>\n{instruction}\n</INSTRUCTION>"
+        )
 
-    qa_system = (
-        f"{QA_SYSTEM_PROMPT}\n\n<INSTRUCTION>\n{instruction}\n</INSTRUCTION>"
-    )
-    # Overwrite the messages with the manager's plan
-    # messages=[]
-
-    if not human_intervention:
-        if rag_url:
-            documents = SimpleWebPageReader(html_to_text=True).load_data([rag_url])
-            index = SummaryIndex.from_documents(documents)
-            retriever = index.as_retriever()
-            nodes = retriever.retrieve(instruction)
-            relevent_context = "\n".join([node.get_content() for node in nodes] )
-            messages.append(
-                {
-                    "role": "user",
-                    "content": f"Here is some relevent context for the task:\n{relevent_context}"
-                }
-            )
-            print(relevent_context)
-        if chatbot_participation:
-            query2chatbot = "Do you know anything about: " + instruction
-            all_chatbot_messages, chatbot_participation = _query_chatbot(chatbot_participation, all_chatbot_messages, query2chatbot, text_query_client)
-    else:
-        if juji_api_key and juji_chatbot_engagement_id:
-            juji_platform_url = juji_platform_url or DEFAULT_JUJI_PLATFORM_URL
-            juji_design = JujiDesign(juji_api_key, juji_platform_url)
+        qa_system = (
+            f"{QA_SYSTEM_PROMPT}\n\n<INSTRUCTION>\n{instruction}\n</INSTRUCTION>"
+        )
+        # Overwrite the messages with the manager's plan
+        # messages=[]
+
+        if not human_intervention:
+            if rag_url:
+                documents = await asyncio.to_thread(SimpleWebPageReader(html_to_text=True).load_data, [rag_url])
+                index = SummaryIndex.from_documents(documents)
+                retriever = index.as_retriever()
+                nodes = retriever.retrieve(instruction)
+                relevent_context = "\n".join([node.get_content() for node in nodes] )
+                messages.append(
+                    {
+                        "role": "user",
+                        "content": f"Here is some relevent context for the task:\n{relevent_context}"
+                    }
+                )
+                print(relevent_context)
+            if chatbot_participation:
+                query2chatbot = "Do you know anything about: " + instruction
+                all_chatbot_messages, chatbot_participation = await _query_chatbot(chatbot_participation, all_chatbot_messages, query2chatbot, text_query_client)
+        else:
+            if juji_api_key and juji_chatbot_engagement_id:
+                juji_platform_url = juji_platform_url or DEFAULT_JUJI_PLATFORM_URL
+                juji_design = JujiDesign(juji_api_key, juji_platform_url)
         
 
-            to_update_chatbot = input("Do you want to update the chatbot with your instructions? (y/n)")
-            if to_update_chatbot == "y":
-                _update_chatbot_with_new_faq(computer_use_client, tool_collection, juji_design, juji_chatbot_engagement_id, [], f"The user intervened the agent with the following instructions: {instruction}.")
+                to_update_chatbot = input("Do you want to update the chatbot with your instructions? (y/n)")
+                if to_update_chatbot == "y":
+                    await _update_chatbot_with_new_faq(computer_use_client, router, tool_collection, juji_design, juji_chatbot_engagement_id, [], f"The user intervened the agent with the following instructions: {instruction}.")
  
 
-    running = True
-
-    while total_sessions < 10 and running:
+        running = True
 
-        manager_plan = await _manager_check_progress(messages, computer_use_client, text_query_client, model, manager_system, api_response_callback, tool_collection, session_number=total_sessions, all_chatbot_messages=all_chatbot_messages, chatbot_participation=chatbot_participation, human_intervention=human_intervention, juji_api_key=juji_api_key, juji_chatbot_engagement_id=juji_chatbot_engagement_id, juji_platform_url=juji_platform_url)
+        while total_sessions < 10 and running:
+            get_metrics().set_context(session=total_sessions)
 
-        if total_sessions == 0:
-            messages.append(
-                {
-                    "role": "user",
-                    "content": f"Given the INSTRUCTION, here is a plan provided by the manager:\n{manager_plan}"
-                    "\n\nPlease follow the plan to complete the task.",
-                }
-            )
+            manager_plan = await _manager_check_progress(messages, computer_use_client, text_query_client, router, manager_system, api_response_callback, tool_collection, session_number=total_sessions, all_chatbot_messages=all_chatbot_messages, chatbot_participation=chatbot_participation, human_intervention=human_intervention, juji_api_key=juji_api_key, juji_chatbot_engagement_id=juji_chatbot_engagement_id, juji_platform_url=juji_platform_url)
 
-        else:
-            # Manager plan does not always exist
-            if manager_plan:
+            if total_sessions == 0:
                 messages.append(
                     {
                         "role": "user",
-                        "content": f"Given the INSTRUCTION and what you have done so far, here is an updated plan provided by the manager:\n{manager_plan}"
+                        "content": f"Given the INSTRUCTION, here is a plan provided by the manager:\n{manager_plan}"
                         "\n\nPlease follow the plan to complete the task.",
                     }
                 )
 
-        count = 0
-
-        while count < 8:
-            if only_n_most_recent_images:
-                _maybe_filter_to_n_most_recent_images(messages, only_n_most_recent_images)
-
-            # Call the API
-            # we use raw_response to provide debug information to streamlit. Your
-            # implementation may be able call the SDK directly with:
-            # `response = client.messages.create(...)` instead.
-            # response = await computer_use_client.messages.create(
-            #     max_tokens=max_tokens,
-            #     messages=messages,
-            #     model=model,
-            #     system=system,
-            #     tools=tool_collection.to_params(),
-            #     betas=["computer-use-2024-10-22"],
-            # )
-            raw_response = computer_use_client.beta.messages.with_raw_response.create(
-                max_tokens=max_tokens,
-                messages=messages,
-                model=model,
-                system=system,
-                tools=tool_collection.to_params(),
-                betas=["computer-use-2024-10-22"],
-            )
-
-            api_response_callback(cast(APIResponse[BetaMessage], raw_response), count, session_number=total_sessions)
+            else:
+                # Manager plan does not always exist
+                if manager_plan:
+                    messages.append(
+                        {
+                            "role": "user",
+                            "content": f"Given the INSTRUCTION and what you have done so far, here is an updated plan provided by the manager:\n{manager_plan}"
+                            "\n\nPlease follow the plan to complete the task.",
+                        }
+                    )
 
-            response = raw_response.parse()
+            count = 0
+
+            while count < 8:
+                get_metrics().set_context(session=total_sessions, step=count)
+                if only_n_most_recent_images:
+                    _maybe_filter_to_n_most_recent_images(messages, only_n_most_recent_images)
+                if context_token_budget and messages.estimated_tokens > context_token_budget:
+                    await _compact_history(messages, computer_use_client, router, manager_system, api_response_callback, tool_collection, total_sessions, context_token_budget // 2)
+                if not messages.image_count:
+                    # the model cannot refer back to a screenshot it no longer sees
+                    computer_tool.forget_last_frame()
+                get_image_store().retain(messages.session_id, messages.image_refs())
+                _inject_prompt_caching(messages)
+
+                # Call the API
+                # we use raw_response to provide debug information to streamlit. Your
+                # implementation may be able call the SDK directly with:
+                # `response = client.messages.create(...)` instead.
+                # response = await computer_use_client.messages.create(
+                #     max_tokens=max_tokens,
+                #     messages=messages,
+                #     model=model,
+                #     system=system,
+                #     tools=tool_collection.to_params(),
+                #     betas=["computer-use-2024-10-22"],
+                # )
+                if stream:
+                    response, batch, _ = await _stream_worker_step(
+                        computer_use_client,
+                        tool_collection,
+                        route=router.route("worker"),
+                        system=system,
+                        messages=messages,
+                        output_callback=output_callback,
+                        tool_output_callback=tool_output_callback,
+                    )
 
-            messages.append(
-                {
-                    "role": "assistant",
-                    "content": cast(list[BetaContentBlockParam], response.content),
-                }
-            )
+                    api_response_callback(response, count, session_number=total_sessions)
 
-            tool_result_content: list[BetaToolResultBlockParam] = []
-            for content_block in cast(list[BetaContentBlock], response.content):
-                output_callback(content_block)
-                if content_block.type == "tool_use":
-                    result = await tool_collection.run(
-                        name=content_block.name,
-                        tool_input=cast(dict[str, Any], content_block.input),
+                    messages.append(
+                        {
+                            "role": "assistant",
+                            "content": cast(list[BetaContentBlockParam], response.content),
+                        }
                     )
-                    tool_result_content.append(
-                        _make_api_tool_result(result, content_block.id)
+                else:
+                    raw_response = await _create_message(computer_use_client, router, role="worker",
+                        messages=messages,
+                        system=system,
+                        tool_collection=tool_collection,
                     )
-                    tool_output_callback(result, content_block.id)
-
-            if not tool_result_content:
-                # Check with QA agent if goal is met
-                qa_response = computer_use_client.beta.messages.with_raw_response.create(
-                    max_tokens=max_tokens,
-                    messages=messages + [{
-                        "role": "user", 
-                        "content": f"Has the instruction goal been achieved? Please answer in JSON format."
-                    }],
-                    model=model,
-                    system=qa_system,
-                    tools=tool_collection.to_params(),
-                    betas=["computer-use-2024-10-22"]
-                )
-            
-                api_response_callback(cast(APIResponse[BetaMessage], qa_response), count, role="qa", session_number=total_sessions)
-                qa_result = qa_response.parse()
-                
-                qa_json = json.loads(qa_result.content[0].text)
-                if qa_json.get('is_complete', False):
-                    api_response_callback(None, is_done=True)
-                    messages.append({"content": qa_result.content[0].text, "role": "assistant"})  
-                    _manager_report_progress(messages, computer_use_client, model, manager_system, api_response_callback, tool_collection)
-                    return messages
-            messages.append({"content": tool_result_content, "role": "user"})
+
+                    api_response_callback(cast(APIResponse[BetaMessage], raw_response), count, session_number=total_sessions)
+
+                    response = await raw_response.parse()
+
+                    messages.append(
+                        {
+                            "role": "assistant",
+                            "content": cast(list[BetaContentBlockParam], response.content),
+                        }
+                    )
+
+                    batch = tool_collection.batch(on_result=tool_output_callback)
+                    for content_block in cast(list[BetaContentBlock], response.content):
+                        output_callback(content_block)
+                        if content_block.type == "tool_use":
+                            batch.submit(
+                                name=content_block.name,
+                                tool_input=cast(dict[str, Any], content_block.input),
+                                tool_use_id=content_block.id,
+                            )
+
+                tool_result_content = await _collect_tool_results(batch)
+
+                if not tool_result_content:
+                    # Check with QA agent if goal is met
+                    qa_verdict = await _qa_check(computer_use_client, tool_collection, router, messages, qa_system, api_response_callback, count, total_sessions)
+                    if qa_verdict.get('is_complete', False):
+                        api_response_callback(None, is_done=True)
+                        messages.append({"content": json.dumps(qa_verdict), "role": "assistant"})
+                        await _manager_report_progress(messages, computer_use_client, router, manager_system, api_response_callback, tool_collection)
+                        return messages
+                messages.append({"content": tool_result_content, "role": "user"})
+                if prefetch_screenshots:
+                    computer_tool.prefetch()
         
-            count += 1
+                count += 1
+
+            total_sessions += 1
+
+        await _manager_report_progress(messages, computer_use_client, router, manager_system, api_response_callback, tool_collection)
+    finally:
+        # shells and background jobs outlive the loop otherwise
+        await bash_pool.close()
 
-        total_sessions += 1
 
-    _manager_report_progress(messages, computer_use_client, model, manager_system, api_response_callback, tool_collection)
+def _cached_system(system: str) -> list[BetaTextBlockParam]:
+    """Wrap a system prompt in a text block with a stable cache breakpoint."""
+    return [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+
+
+def _cached_tool_params(tool_collection: ToolCollection) -> list[BetaToolUnionParam]:
+    """Tool definitions with a cache breakpoint after the last one."""
+    tool_params = tool_collection.to_params()
+    if tool_params:
+        tool_params[-1] = {**tool_params[-1], "cache_control": {"type": "ephemeral"}}
+    return tool_params
+
+
+def _flatten_tool_blocks(messages: list[BetaMessageParam]) -> list[BetaMessageParam]:
+    """
+    Render tool_use and tool_result blocks as text (keeping screenshots as images), so
+    the history can be sent without the tool definitions. Messages without tool
+    blocks are passed through unchanged.
+    """
+    flattened: list[BetaMessageParam] = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            flattened.append(message)
+            continue
+        blocks = []
+        changed = False
+        for block in content:
+            block_type = block["type"] if isinstance(block, dict) else block.type
+            if block_type == "tool_use":
+                if not isinstance(block, dict):
+                    block = block.model_dump()
+                blocks.append({"type": "text", "text": f"[Used tool {block['name']} with input {json.dumps(block['input'])}]"})
+                changed = True
+            elif block_type == "tool_result":
+                result_content = block.get("content") or []
+                if isinstance(result_content, str):
+                    result_content = [{"type": "text", "text": result_content}]
+                prefix = "[Tool error]" if block.get("is_error") else "[Tool result]"
+                blocks.append({"type": "text", "text": prefix})
+                blocks.extend(result_content)
+                if "cache_control" in block:
+                    blocks[-1] = {**blocks[-1], "cache_control": block["cache_control"]}
+                changed = True
+            else:
+                blocks.append(block)
+        flattened.append({**message, "content": blocks} if changed else message)
+    return flattened
+
+
+def _inject_prompt_caching(
+    messages: list[BetaMessageParam],
+    breakpoints: int = 2,
+):
+    """
+    Set a rolling cache breakpoint on the most recent `breakpoints` user turns and
+    drop the ones left on older turns, so that together with the system prompt and
+    tool breakpoints at most four are in use. Each step then reads the prefix
+    cached by the previous step.
+
+    Pruning a chunk of screenshots rewrites the messages they were in and so
+    invalidates the rolling breakpoints. For a MessageHistory that prunes its
+    images, one of the breakpoints therefore goes on its `cache_boundary`
+    instead, the end of the messages already pruned, which stays cached across
+    the next prune. Manager and QA calls go to their own model, with their own
+    system prompt, no tools and the tool blocks flattened, so they do not read
+    the worker's cache.
+    """
+    boundary = getattr(messages, "cache_boundary", None)
+    if boundary is not None:
+        breakpoints -= 1
+    for message in reversed(messages):
+        if message["role"] != "user":
+            continue
+        marked = message is boundary or breakpoints > 0
+        if isinstance(message["content"], str):
+            if not marked:
+                continue
+            message["content"] = [{"type": "text", "text": message["content"]}]
+        content = message["content"]
+        if not content:
+            continue
+        if message is boundary:
+            content[-1]["cache_control"] = {"type": "ephemeral"}  # type: ignore
+        elif breakpoints:
+            breakpoints -= 1
+            content[-1]["cache_control"] = {"type": "ephemeral"}  # type: ignore
+        elif "cache_control" in content[-1]:
+            del content[-1]["cache_control"]  # type: ignore
 
 
 def _maybe_filter_to_n_most_recent_images(
@@ -655,6 +1128,10 @@ def _maybe_filter_to_n_most_recent_images(
     if images_to_keep is None:
         return messages
 
+    if isinstance(messages, MessageHistory):
+        messages.prune_images(images_to_keep, min_removal_threshold)
+        return messages
+
     tool_result_blocks = cast(
         list[ToolResultBlockParam],
         [
@@ -700,20 +1177,26 @@ def _make_api_tool_result(
         is_error = True
         tool_result_content = _maybe_prepend_system_tool_result(result, result.error)
     else:
-        if result.output:
+        if result.output or result.system:
             tool_result_content.append(
                 {
                     "type": "text",
-                    "text": _maybe_prepend_system_tool_result(result, result.output),
+                    "text": _maybe_prepend_system_tool_result(
+                        result, result.output or ""
+                    ),
                 }
             )
-        if result.base64_image:
+        if result.image_ref:
+            tool_result_content.append(
+                image_ref_block(result.image_ref, result.media_type or "image/png")
+            )
+        elif result.base64_image:
             tool_result_content.append(
                 {
                     "type": "image",
                     "source": {
                         "type": "base64",
-                        "media_type": "image/png",
+                        "media_type": result.media_type or "image/png",
                         "data": result.base64_image,
                     },
                 }
@@ -0,0 +1,261 @@
+"""
+Structured metrics for LLM and tool calls made by the sampling loop.
+
+Every call is appended as one JSON object per line to an optional JSONL file, and
+aggregated into counters that can be exported as a Prometheus text-format
+snapshot or printed as a summary at the end of a run.
+"""
+
+import json
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any
+
+# (session, step) of the work currently running, inherited by tasks it spawns
+_context: ContextVar[tuple[int | None, int | None]] = ContextVar(
+    "metrics_context", default=(None, None)
+)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class MetricsRecorder:
+    """Records LLM calls, tool calls and ad-hoc counters for one run."""
+
+    prefix = "computer_use"
+
+    def __init__(self, jsonl_path: str | Path | None = None):
+        self.jsonl_path = Path(jsonl_path) if jsonl_path else None
+        self.counters: dict[str, dict[Labels, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+        self.gauges: dict[str, dict[Labels, float]] = defaultdict(dict)
+        self._jsonl = None
+
+    def set_context(self, *, session: int | None, step: int | None = None):
+        """Set the session and step that subsequent records are attributed to."""
+        _context.set((session, step))
+
+    def increment(self, name: str, value: float = 1, **labels: Any):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        self.counters[name][key] += value
+
+    def set_gauge(self, name: str, value: float, **labels: Any):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        self.gauges[name][key] = value
+
+    def observe(self, name: str, value: float, **labels: Any):
+        """Record a duration or size as a Prometheus summary (sum and count)."""
+        self.increment(f"{name}_sum", value, **labels)
+        self.increment(f"{name}_count", 1, **labels)
+
+    def record_llm_call(
+        self,
+        *,
+        role: str,
+        model: str,
+        usage: dict[str, Any] | None,
+        wall_time: float,
+        request_bytes: int | None = None,
+        error: str | None = None,
+    ):
+        usage = usage or {}
+        input_tokens = usage.get("input_tokens") or 0
+        output_tokens = usage.get("output_tokens") or 0
+        cache_read = usage.get("cache_read_input_tokens") or 0
+        cache_write = usage.get("cache_creation_input_tokens") or 0
+
+        self.increment("llm_requests_total", role=role, model=model, error=bool(error))
+        self.observe("llm_request_seconds", wall_time, role=role)
+        self.increment("llm_input_tokens_total", input_tokens, role=role)
+        self.increment("llm_output_tokens_total", output_tokens, role=role)
+        self.increment("llm_cache_read_tokens_total", cache_read, role=role)
+        self.increment("llm_cache_write_tokens_total", cache_write, role=role)
+        if request_bytes is not None:
+            self.increment("llm_request_bytes_total", request_bytes, role=role)
+
+        self._write(
+            {
+                "kind": "llm",
+                "role": role,
+                "model": model,
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "cache_read_input_tokens": cache_read,
+                "cache_creation_input_tokens": cache_write,
+                "wall_time": wall_time,
+                "request_bytes": request_bytes,
+                "error": error,
+            }
+        )
+
+    def record_tool_call(
+        self,
+        *,
+        tool: str,
+        wall_time: float,
+        output_bytes: int,
+        image_bytes: int,
+        error: bool,
+    ):
+        self.increment("tool_calls_total", tool=tool, error=error)
+        self.observe("tool_call_seconds", wall_time, tool=tool)
+        self.increment("tool_output_bytes_total", output_bytes, tool=tool)
+        self.increment("tool_image_bytes_total", image_bytes, tool=tool)
+
+        self._write(
+            {
+                "kind": "tool",
+                "tool": tool,
+                "wall_time": wall_time,
+                "output_bytes": output_bytes,
+                "image_bytes": image_bytes,
+                "error": error,
+            }
+        )
+
+    def record_command(
+        self,
+        *,
+        command: str,
+        exit_code: int | None,
+        wall_time: float,
+        output_bytes: int,
+        error_bytes: int,
+        slow: bool,
+    ):
+        """Record one bash command; slow commands are also counted separately."""
+        self.increment("bash_commands_total", failed=exit_code != 0)
+        self.observe("bash_command_seconds", wall_time)
+        self.increment("bash_output_bytes_total", output_bytes, stream="stdout")
+        self.increment("bash_output_bytes_total", error_bytes, stream="stderr")
+        if slow:
+            self.increment("bash_slow_commands_total")
+
+        self._write(
+            {
+                "kind": "bash",
+                "command": command,
+                "exit_code": exit_code,
+                "wall_time": wall_time,
+                "output_bytes": output_bytes,
+                "error_bytes": error_bytes,
+                "slow": slow,
+            }
+        )
+
+    def _write(self, record: dict[str, Any]):
+        if not self.jsonl_path:
+            return
+        if self._jsonl is None:
+            self.jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+            self._jsonl = open(self.jsonl_path, "a")
+        session, step = _context.get()
+        record = {"time": time.time(), "session": session, "step": step, **record}
+        self._jsonl.write(json.dumps(record) + "\n")
+        self._jsonl.flush()
+
+    def prometheus_text(self) -> str:
+        """Render all counters in the Prometheus text exposition format."""
+        lines = []
+        metrics = [(name, _metric_type(name), self.counters[name]) for name in self.counters]
+        metrics += [(name, "gauge", self.gauges[name]) for name in self.gauges]
+        for name, metric_type, values in sorted(metrics):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} {metric_type}")
+            for labels, value in sorted(values.items()):
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(
+                    f"{metric}{{{label_text}}} {value:g}" if label_text else f"{metric} {value:g}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str | Path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(self.prometheus_text())
+
+    def summary(self) -> str:
+        """A short human readable summary of where time and tokens went."""
+        rows = [
+            f"{'role':<10} {'calls':>6} {'seconds':>9} {'input':>8} {'cached':>8} {'output':>8}"
+        ]
+        requests = self._by_label("llm_requests_total", "role")
+        for role in sorted(requests):
+            rows.append(
+                f"{role:<10} {requests[role]:>6g} "
+                f"{self._by_label('llm_request_seconds_sum', 'role').get(role, 0):>9.1f} "
+                f"{self._by_label('llm_input_tokens_total', 'role').get(role, 0):>8g} "
+                f"{self._by_label('llm_cache_read_tokens_total', 'role').get(role, 0):>8g} "
+                f"{self._by_label('llm_output_tokens_total', 'role').get(role, 0):>8g}"
+            )
+        rows.append("")
+        rows.append(f"{'tool':<20} {'calls':>6} {'seconds':>9} {'bytes':>9}")
+        calls = self._by_label("tool_calls_total", "tool")
+        for tool in sorted(calls):
+            output_bytes = self._by_label("tool_output_bytes_total", "tool").get(tool, 0)
+            image_bytes = self._by_label("tool_image_bytes_total", "tool").get(tool, 0)
+            rows.append(
+                f"{tool:<20} {calls[tool]:>6g} "
+                f"{self._by_label('tool_call_seconds_sum', 'tool').get(tool, 0):>9.1f} "
+                f"{output_bytes + image_bytes:>9g}"
+            )
+        screenshots = []
+        unchanged = self._by_label("screenshots_unchanged_total", "")
+        if unchanged:
+            screenshots.append(
+                f"unchanged screenshots not resent: {sum(unchanged.values()):g} "
+                f"({sum(self._by_label('screenshot_bytes_saved_total', '').values()):g} bytes saved)"
+            )
+        prefetches = self._by_label("screenshot_prefetch_total", "result")
+        if prefetches:
+            hits = prefetches.get("hit", 0)
+            saved = sum(self._by_label("screenshot_prefetch_saved_seconds_sum", "").values())
+            screenshots.append(
+                f"screenshot prefetch hits: {hits:g}/{sum(prefetches.values()):g} "
+                f"({100 * hits / sum(prefetches.values()):.0f}%), {saved:.1f}s saved"
+            )
+        if screenshots:
+            rows += [""] + screenshots
+        commands = self._by_label("bash_commands_total", "failed")
+        if commands:
+            seconds = sum(self._by_label("bash_command_seconds_sum", "").values())
+            slow = sum(self._by_label("bash_slow_commands_total", "").values())
+            rows += [
+                "",
+                f"bash commands: {sum(commands.values()):g} in {seconds:.1f}s, "
+                f"{commands.get('True', 0):g} failed, {slow:g} slow",
+            ]
+        return "\n".join(rows)
+
+    def _by_label(self, name: str, label: str) -> dict[str, float]:
+        totals: dict[str, float] = defaultdict(float)
+        for labels, value in self.counters.get(name, {}).items():
+            totals[dict(labels).get(label, "")] += value
+        return totals
+
+    def close(self):
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+
+
+def _metric_type(name: str) -> str:
+    if name.endswith("_sum") or name.endswith("_count"):
+        return "untyped"
+    return "counter"
+
+
+_metrics = MetricsRecorder()
+
+
+def get_metrics() -> MetricsRecorder:
+    """The process-wide recorder used by the sampling loop and the tools."""
+    return _metrics
+
+
+def set_metrics(recorder: MetricsRecorder):
+    global _metrics
+    _metrics = recorder
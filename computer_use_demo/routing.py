@@ -0,0 +1,57 @@
+"""
+Per-role model routing for the worker, manager, QA and FAQ calls.
+"""
+
+from dataclasses import dataclass, field
+
+DEFAULT_WORKER_MODEL = "claude-3-5-sonnet-20241022"
+# fast model with vision, the manager and QA still look at screenshots
+DEFAULT_FAST_MODEL = "claude-3-haiku-20240307"
+
+
+@dataclass(frozen=True, kw_only=True)
+class Route:
+    """The model and request settings used for one role."""
+
+    model: str
+    max_tokens: int = 1024
+    # whether to send the computer/bash/edit tool definitions with the request
+    use_tools: bool = False
+    # model to retry with when the primary model is overloaded
+    fallback_model: str | None = None
+
+    @property
+    def models(self) -> list[str]:
+        return [self.model] + ([self.fallback_model] if self.fallback_model else [])
+
+
+@dataclass
+class ModelRouter:
+    """Maps a role ("worker", "manager", "qa", "faq") to its route."""
+
+    routes: dict[str, Route] = field(default_factory=dict)
+
+    @classmethod
+    def default(
+        cls,
+        worker_model: str = DEFAULT_WORKER_MODEL,
+        worker_max_tokens: int = 4096,
+        fast_model: str = DEFAULT_FAST_MODEL,
+    ) -> "ModelRouter":
+        fast = Route(model=fast_model, max_tokens=1024, fallback_model=worker_model)
+        return cls(
+            routes={
+                "worker": Route(
+                    model=worker_model, max_tokens=worker_max_tokens, use_tools=True
+                ),
+                "manager": fast,
+                "qa": fast,
+                "faq": fast,
+            }
+        )
+
+    def route(self, role: str) -> Route:
+        try:
+            return self.routes[role]
+        except KeyError:
+            raise ValueError(f"No model route for role: {role}") from None
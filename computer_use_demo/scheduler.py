@@ -0,0 +1,249 @@
+"""
+Shared request scheduler for LLM calls: token-bucket rate limits across concurrent
+agents, and retries with exponential backoff that honour `retry-after` headers.
+"""
+
+import asyncio
+import json
+import random
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any, TypeVar
+
+import anthropic
+import openai
+
+from .metrics import get_metrics
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class TokenBucket:
+    """A bucket that refills continuously at `per_minute` units per minute."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` units are available (0 if they already are)."""
+        self._refill()
+        # a single request larger than the bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        return max(amount - self.level, 0.0) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def refund(self, amount: float):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Rate limits, overloads, server errors and dropped connections are transient."""
+    if isinstance(exc, (anthropic.APIConnectionError, openai.APIConnectionError)):
+        return True
+    return getattr(exc, "status_code", None) in RETRYABLE_STATUS_CODES
+
+
+def retry_after(exc: BaseException) -> float | None:
+    """The delay requested by the server in a `retry-after` header, if any."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+class RequestScheduler:
+    """
+    Wraps every call to one provider. Calls wait in FIFO order until the request,
+    input token and output token buckets can cover them, then run with retries.
+    Output tokens are reserved up front from the request's max_tokens and the
+    unused part is refunded once the actual usage is known.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        requests_per_minute: float | None = None,
+        input_tokens_per_minute: float | None = None,
+        output_tokens_per_minute: float | None = None,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.input_tokens = (
+            TokenBucket(input_tokens_per_minute) if input_tokens_per_minute else None
+        )
+        self.output_tokens = (
+            TokenBucket(output_tokens_per_minute) if output_tokens_per_minute else None
+        )
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.queue_depth = 0
+        self._lock: asyncio.Lock | None = None
+        self._lock_loop: asyncio.AbstractEventLoop | None = None
+
+    def _get_lock(self) -> asyncio.Lock:
+        # main.py starts a new event loop after every interruption
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+    async def throttle(self, input_tokens: int = 0, output_tokens: int = 0):
+        """Wait until the rate limits allow a request of the given size, then take it."""
+        metrics = get_metrics()
+        start = time.perf_counter()
+        self.queue_depth += 1
+        metrics.set_gauge("scheduler_queue_depth", self.queue_depth, provider=self.name)
+        limits = [
+            (bucket, amount)
+            for bucket, amount in (
+                (self.requests, 1),
+                (self.input_tokens, input_tokens),
+                (self.output_tokens, output_tokens),
+            )
+            if bucket is not None
+        ]
+        try:
+            async with self._get_lock():
+                while limits and (wait := max(b.wait_time(a) for b, a in limits)) > 0:
+                    await asyncio.sleep(wait)
+                for bucket, amount in limits:
+                    bucket.consume(amount)
+        finally:
+            self.queue_depth -= 1
+            metrics.set_gauge("scheduler_queue_depth", self.queue_depth, provider=self.name)
+            metrics.observe("scheduler_wait_seconds", time.perf_counter() - start, provider=self.name)
+
+    def settle(
+        self,
+        *,
+        reserved_input_tokens: int = 0,
+        reserved_output_tokens: int = 0,
+        input_tokens: int = 0,
+        output_tokens: int = 0,
+    ):
+        """Correct the buckets once the actual usage of a request is known."""
+        for bucket, reserved, actual in (
+            (self.input_tokens, reserved_input_tokens, input_tokens),
+            (self.output_tokens, reserved_output_tokens, output_tokens),
+        ):
+            if bucket is None:
+                continue
+            if actual < reserved:
+                bucket.refund(reserved - actual)
+            else:
+                bucket.consume(actual - reserved)
+
+    def backoff_delay(self, attempt: int, exc: BaseException | None = None) -> float:
+        """Exponential backoff with full jitter, or the server's retry-after if longer."""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        requested = retry_after(exc) if exc is not None else None
+        if requested is not None:
+            delay = max(delay, min(requested, self.max_delay))
+        return delay
+
+    async def wait_before_retry(self, attempt: int, exc: BaseException):
+        """Sleep before retry number `attempt + 1` of a request that failed with `exc`."""
+        delay = self.backoff_delay(attempt, exc)
+        get_metrics().increment(
+            "scheduler_retries_total",
+            provider=self.name,
+            status=getattr(exc, "status_code", type(exc).__name__),
+        )
+        print(f"### {self.name} request failed ({exc}), retry {attempt + 1} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    async def call(
+        self,
+        fn: Callable[[], Awaitable[T]],
+        *,
+        input_tokens: int = 0,
+        output_tokens: int = 0,
+        usage: Callable[[T], tuple[int, int]] | None = None,
+        retryable: Callable[[BaseException], bool] = is_retryable,
+    ) -> T:
+        """
+        Run `fn` under the rate limits, retrying transient failures. `usage` maps the
+        result to its actual (input, output) tokens for settling the buckets.
+        """
+        attempt = 0
+        while True:
+            await self.throttle(input_tokens, output_tokens)
+            # a failed or cancelled call gives back its whole reservation
+            actual_input = actual_output = 0
+            try:
+                result = await fn()
+                if usage is not None:
+                    actual_input, actual_output = usage(result)
+                else:
+                    actual_input, actual_output = input_tokens, output_tokens
+                return result
+            except Exception as e:
+                if attempt >= self.max_retries or not retryable(e):
+                    raise
+                error = e
+            finally:
+                self.settle(
+                    reserved_input_tokens=input_tokens,
+                    reserved_output_tokens=output_tokens,
+                    input_tokens=actual_input,
+                    output_tokens=actual_output,
+                )
+            await self.wait_before_retry(attempt, error)
+            attempt += 1
+
+_schedulers: dict[str, RequestScheduler] = {}
+
+
+def get_scheduler(provider: str) -> RequestScheduler:
+    """The process-wide scheduler shared by every agent calling `provider`."""
+    if provider not in _schedulers:
+        _schedulers[provider] = RequestScheduler(provider)
+    return _schedulers[provider]
+
+
+def set_scheduler(provider: str, scheduler: RequestScheduler):
+    _schedulers[provider] = scheduler
+
+
+def anthropic_usage(raw_response: Any) -> tuple[int, int]:
+    """(input, output) tokens of a raw Anthropic response. Cache reads are left out
+    since they do not count towards the input token rate limit. Reads the body
+    directly, as parsing an async response has to be awaited."""
+    usage = json.loads(raw_response.http_response.text).get("usage") or {}
+    return (
+        (usage.get("input_tokens") or 0) + (usage.get("cache_creation_input_tokens") or 0),
+        usage.get("output_tokens") or 0,
+    )
@@ -1,14 +1,25 @@
 from .base import CLIResult, ToolResult
-from .bash import BashTool
+from .bash import BashTool, SessionPool
+from .bash_jobs import BashJobsTool
+from .capture import CaptureBackend, FakeScreen, get_capture_backend
 from .collection import ToolCollection
 from .computer import ComputerTool
+from .computer_batch import ComputerBatchTool
+from .computer_zoom import ComputerZoomTool
 from .edit import EditTool
 
 __all__ = [
+    BashJobsTool,
     BashTool,
+    CaptureBackend,
     CLIResult,
+    ComputerBatchTool,
     ComputerTool,
+    ComputerZoomTool,
     EditTool,
+    FakeScreen,
+    get_capture_backend,
+    SessionPool,
     ToolCollection,
     ToolResult,
 ]
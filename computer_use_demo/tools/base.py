@@ -19,6 +19,15 @@ class BaseAnthropicTool(metaclass=ABCMeta):
     ) -> BetaToolUnionParam:
         raise NotImplementedError
 
+    def resources(self, tool_input: dict[str, Any]) -> tuple[set[str], set[str]]:
+        """
+        Returns the (shared, exclusive) resources a call with the given input uses.
+        Calls that touch the same resource, with at least one of them holding it
+        exclusively, run in the order they were issued; other calls may overlap.
+        By default every call holds the tool itself exclusively.
+        """
+        return set(), {self.to_params()["name"]}
+
 
 @dataclass(kw_only=True, frozen=True)
 class ToolResult:
@@ -27,6 +36,10 @@ class ToolResult:
     output: str | None = None
     error: str | None = None
     base64_image: str | None = None
+    # key of an image in the image store, used instead of base64_image
+    image_ref: str | None = None
+    # media type of the image, PNG when not set
+    media_type: str | None = None
     system: str | None = None
 
     def __bool__(self):
@@ -46,6 +59,8 @@ class ToolResult:
             output=combine_fields(self.output, other.output),
             error=combine_fields(self.error, other.error),
             base64_image=combine_fields(self.base64_image, other.base64_image, False),
+            image_ref=combine_fields(self.image_ref, other.image_ref, False),
+            media_type=self.media_type or other.media_type,
             system=combine_fields(self.system, other.system),
         )
 
@@ -54,9 +69,17 @@ class ToolResult:
         return replace(self, **kwargs)
 
 
+@dataclass(kw_only=True, frozen=True)
 class CLIResult(ToolResult):
     """A ToolResult that can be rendered as a CLI output."""
 
+    exit_code: int | None = None
+    # wall time of the command in seconds
+    duration: float | None = None
+    # sizes of the full stdout and stderr, before clipping
+    output_bytes: int | None = None
+    error_bytes: int | None = None
+
 
 class ToolFailure(ToolResult):
     """A ToolResult that represents a failure."""
@@ -1,53 +1,199 @@
 import asyncio
+import itertools
 import os
-from typing import ClassVar, Literal
+import secrets
+import signal
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Any, BinaryIO, ClassVar, Literal
 
 from anthropic.types.beta import BetaToolBash20241022Param
 
+from ..metrics import get_metrics
 from .base import BaseAnthropicTool, CLIResult, ToolError, ToolResult
 
 
+class _OutputCapture:
+    """
+    The output of one command on one stream, in bounded memory: the first
+    `head_size` and last `tail_size` bytes are kept, and once the output is longer
+    than both together all of it is written to a temporary file.
+    """
+
+    def __init__(self, head_size: int, tail_size: int):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+        self.lines = 0
+        self.path: str | None = None
+        self._file: BinaryIO | None = None
+
+    @property
+    def truncated(self) -> bool:
+        return self.total > self.head_size + self.tail_size
+
+    def write(self, data: bytes | bytearray):
+        if not data:
+            return
+        self.total += len(data)
+        self.lines += data.count(b"\n")
+        if self._file is None and self.truncated:
+            # everything so far is still in memory
+            fd, self.path = tempfile.mkstemp(prefix="bash-output-", suffix=".log")
+            self._file = os.fdopen(fd, "wb")
+            self._file.write(self.head)
+            self._file.write(self.tail)
+        if self._file is not None:
+            self._file.write(data)
+        head = max(self.head_size - len(self.head), 0)
+        self.head += data[:head]
+        self.tail += data[head:]
+        if len(self.tail) > self.tail_size:
+            del self.tail[: -self.tail_size]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def text(self) -> str:
+        if not self.truncated:
+            return (self.head + self.tail).decode(errors="replace")
+        omitted = self.total - len(self.head) - len(self.tail)
+        return (
+            self.head.decode(errors="replace")
+            + f"\n<output clipped: {omitted} bytes omitted>\n"
+            + self.tail.decode(errors="replace")
+        )
+
+    def summary(self, stream: str) -> str:
+        return (
+            f"{stream} was {self.total} bytes in {self.lines} lines, only the first "
+            f"{len(self.head)} and last {len(self.tail)} bytes are shown; the full "
+            f"{stream} is in {self.path}, search it with grep -n or view parts of "
+            "it with sed -n."
+        )
+
+
 class _BashSession:
-    """A session of a bash shell."""
+    """
+    A session of a bash shell.
+
+    Each command is followed by a sentinel line with a random token on both stdout
+    and stderr, the one on stdout carrying the command's exit status. The output
+    is read as it arrives, and only the newly read bytes are searched for the
+    sentinel, so a command returns as soon as it finishes and long outputs are
+    scanned once. The output kept in memory is bounded, see `_OutputCapture`.
+    Commands run one at a time; concurrent calls wait for the running one.
+
+    The shell runs with job control on, so every command gets its own process
+    group, and a command that times out is interrupted through it while the shell
+    and its state survive. After every command the working directory and exported
+    variables are saved to a checkpoint, which `restore` applies to a new shell.
+    """
 
     _started: bool
     _process: asyncio.subprocess.Process
 
     command: str = "/bin/bash"
-    _output_delay: float = 0.2  # seconds
+    _read_size: int = 1 << 20  # bytes
+    _head_size: int = 8000  # bytes of each stream kept from the start
+    _tail_size: int = 8000  # bytes of each stream kept from the end
     _timeout: float = 120.0  # seconds
-    _sentinel: str = "<<exit>>"
+    _interrupt_grace: float = 2.0  # seconds a timed out command gets per signal
 
-    def __init__(self):
+    def __init__(self, slow_command_seconds: float | None = None):
+        # commands that take longer are flagged in the result and the metrics
+        self.slow_command_seconds = slow_command_seconds
         self._started = False
-        self._timed_out = False
+        self._lock = asyncio.Lock()
+        self._start_lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        # output read past the sentinel of the previous command, per stream
+        self._pending: dict[asyncio.StreamReader, bytearray] = {}
+        # full outputs of clipped commands, removed when the session stops
+        self._spill_files: list[str] = []
+        # created when the shell starts, and removed when it stops
+        self._checkpoint_path: str | None = None
 
-    async def start(self):
-        if self._started:
-            return
+    async def start(self, checkpoint: str | None = None):
+        """
+        Start the shell and apply `checkpoint`, see `checkpoint`. Concurrent calls
+        wait for the first one to finish.
+        """
+        async with self._start_lock:
+            if self._started:
+                return
 
-        self._process = await asyncio.create_subprocess_shell(
-            self.command,
-            preexec_fn=os.setsid,
-            shell=True,
-            bufsize=0,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
+            # exec rather than through sh, so that the process is the shell itself
+            # and its children are the commands it runs
+            self._process = await asyncio.create_subprocess_exec(
+                self.command,
+                preexec_fn=os.setsid,
+                bufsize=0,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            assert self._process.stdin
+            # an interrupted command must not take the shell down with it
+            self._process.stdin.write(b"set -m; trap : INT\n")
+            await self._process.stdin.drain()
 
-        self._started = True
+            if self._checkpoint_path is None:
+                fd, self._checkpoint_path = tempfile.mkstemp(prefix="bash-state-", suffix=".sh")
+                os.close(fd)
+            self._started = True
+            if checkpoint:
+                # sourced from the file rather than sent as a command, and left out
+                # of the metrics, since the exported variables may hold secrets
+                with open(self._checkpoint_path, "w") as f:
+                    f.write(checkpoint)
+                await self._run(f". {self._checkpoint_path}", self._timeout, record=False)
+
+    async def close(self):
+        """Kill the jobs of the shell, which have process groups of their own, and stop it."""
+        if self._started and self._process.returncode is None:
+            await self._signal_jobs(signal.SIGKILL)
+            self.stop()
+            await self._process.wait()
+        elif self._started:
+            self.stop()
 
     def stop(self):
         """Terminate the bash shell."""
         if not self._started:
             raise ToolError("Session has not started.")
+        paths = list(self._spill_files)
+        if self._checkpoint_path is not None:
+            paths.append(self._checkpoint_path)
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._spill_files.clear()
+        self._checkpoint_path = None
         if self._process.returncode is not None:
             return
         self._process.terminate()
 
-    async def run(self, command: str):
-        """Execute a command in the bash shell."""
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    async def run(self, command: str, timeout: float | None = None):
+        """Execute a command in the bash shell, within `timeout` or `_timeout` seconds."""
+        async with self._lock:
+            try:
+                return await self._run(command, timeout or self._timeout)
+            finally:
+                self.last_used = time.monotonic()
+
+    async def _run(self, command: str, timeout: float, record: bool = True):
         if not self._started:
             raise ToolError("Session has not started.")
         if self._process.returncode is not None:
@@ -55,56 +201,369 @@ class _BashSession:
                 system="tool must be restarted",
                 error=f"bash has exited with returncode {self._process.returncode}",
             )
-        if self._timed_out:
-            raise ToolError(
-                f"timed out: bash has not returned in {self._timeout} seconds and must be restarted",
-            )
 
         # we know these are not None because we created the process with PIPEs
         assert self._process.stdin
         assert self._process.stdout
         assert self._process.stderr
 
-        # send command to the process
+        # the sentinel is printed in two parts, so that it does not appear in the
+        # shell's trace of the command when `set -x` is on
+        token = secrets.token_hex(16)
+        sentinel = f"<<exit:{token}>>".encode()
+        print_sentinel = f"printf '%s%s%s\\n' '<<exit:' '{token}>>'"
+        # builtins only, and out of the `set -x` trace
+        checkpoint = (
+            f"{{ printf 'cd -- %q\\n' \"$PWD\"; export -p; }} "
+            f"> {self._checkpoint_path} 2>/dev/null"
+        )
+        start = time.perf_counter()
         self._process.stdin.write(
-            command.encode() + f"; echo '{self._sentinel}'\n".encode()
+            f'{command}\n{print_sentinel} "$?"; {checkpoint}; {print_sentinel} "" >&2\n'.encode()
         )
         await self._process.stdin.drain()
 
         # read output from the process, until the sentinel is found
+        stdout = _OutputCapture(self._head_size, self._tail_size)
+        stderr = _OutputCapture(self._head_size, self._tail_size)
+        reads = asyncio.gather(
+            self._read_until(self._process.stdout, sentinel, stdout),
+            self._read_until(self._process.stderr, sentinel, stderr),
+        )
+        timed_out = False
         try:
-            async with asyncio.timeout(self._timeout):
-                while True:
-                    await asyncio.sleep(self._output_delay)
-                    # if we read directly from stdout/stderr, it will wait forever for
-                    # EOF. use the StreamReader buffer directly instead.
-                    output = (
-                        self._process.stdout._buffer.decode()  # pyright: ignore[reportAttributeAccessIssue]
-                    )
-                    if self._sentinel in output:
-                        # strip the sentinel and break
-                        output = output[: output.index(self._sentinel)]
-                        break
-        except asyncio.TimeoutError:
-            self._timed_out = True
-            raise ToolError(
-                f"timed out: bash has not returned in {self._timeout} seconds and must be restarted",
-            ) from None
+            try:
+                async with asyncio.timeout(timeout):
+                    status, error_status = await asyncio.shield(reads)
+            except asyncio.TimeoutError:
+                timed_out = True
+                status, error_status = await self._interrupt(reads, timeout)
+        finally:
+            for capture in (stdout, stderr):
+                capture.close()
+                if capture.path is not None:
+                    self._spill_files.append(capture.path)
+        duration = time.perf_counter() - start
+        if status is None or error_status is None:
+            returncode = await self._process.wait()
+            return ToolResult(
+                system="tool must be restarted",
+                error=f"bash has exited with returncode {returncode}",
+            )
 
+        output = stdout.text()
         if output.endswith("\n"):
             output = output[:-1]
-
-        error = (
-            self._process.stderr._buffer.decode()  # pyright: ignore[reportAttributeAccessIssue]
-        )
+        error = stderr.text()
+        if token in error:
+            # drop the shell's trace of the sentinel commands
+            error = "".join(
+                line for line in error.splitlines(keepends=True) if token not in line
+            )
         if error.endswith("\n"):
             error = error[:-1]
 
-        # clear the buffers so that the next output can be read correctly
-        self._process.stdout._buffer.clear()  # pyright: ignore[reportAttributeAccessIssue]
-        self._process.stderr._buffer.clear()  # pyright: ignore[reportAttributeAccessIssue]
+        exit_code = int(status) if status.isdigit() else None
+        slow = (
+            self.slow_command_seconds is not None
+            and duration >= self.slow_command_seconds
+        )
+        if record:
+            get_metrics().record_command(
+                command=command,
+                exit_code=exit_code,
+                wall_time=duration,
+                output_bytes=stdout.total,
+                error_bytes=stderr.total,
+                slow=slow,
+            )
 
-        return CLIResult(output=output, error=error)
+        notes = [f"exit status {exit_code}, {duration:.2f}s"]
+        if slow:
+            notes[0] += " (slow command)"
+        if timed_out:
+            get_metrics().increment("bash_timeouts_total", recovered="interrupted")
+            notes.insert(
+                0,
+                f"timed out: the command had not returned in {timeout:g} seconds and "
+                "was interrupted. The shell kept its working directory and variables.",
+            )
+        notes += [
+            capture.summary(name)
+            for name, capture in (("stdout", stdout), ("stderr", stderr))
+            if capture.truncated
+        ]
+        return CLIResult(
+            output=output,
+            error=error,
+            system="\n".join(notes),
+            exit_code=exit_code,
+            duration=duration,
+            output_bytes=stdout.total,
+            error_bytes=stderr.total,
+        )
+
+    async def _interrupt(
+        self, reads: "asyncio.Future[list[bytes | None]]", timeout: float
+    ) -> list[bytes | None]:
+        """
+        Stop a timed out command by signalling the process groups of the shell's
+        jobs, SIGINT first and SIGKILL if that does not do it, and wait for the
+        sentinels. If the command still runs, e.g. a loop in the shell itself, the
+        shell is replaced by one restored from the checkpoint.
+        """
+        start = time.perf_counter()
+        for signum in (signal.SIGINT, signal.SIGKILL):
+            await self._signal_jobs(signum)
+            try:
+                return await asyncio.wait_for(
+                    asyncio.shield(reads), self._interrupt_grace
+                )
+            except asyncio.TimeoutError:
+                pass
+        reads.cancel()
+        # the cancelled reads are not awaited
+        reads.add_done_callback(lambda f: f.cancelled() or f.exception())
+        await self._restart()
+        get_metrics().increment("bash_timeouts_total", recovered="restarted")
+        get_metrics().observe(
+            "bash_timeout_recovery_seconds", time.perf_counter() - start
+        )
+        raise ToolError(
+            f"timed out: bash had not returned in {timeout:g} seconds and could not "
+            "be interrupted, so it was restarted with its working directory and "
+            "exported variables restored",
+        )
+
+    async def _signal_jobs(self, signum: int, parent: int | None = None):
+        """Send `signum` to the process groups of the shell's jobs."""
+        pgrep = await asyncio.create_subprocess_exec(
+            "pgrep", "-P", str(parent or self._process.pid), stdout=asyncio.subprocess.PIPE
+        )
+        children, _ = await pgrep.communicate()
+        for pid in map(int, children.split()):
+            try:
+                if os.getpgid(pid) != self._process.pid:
+                    os.killpg(os.getpgid(pid), signum)
+                    continue
+                # a subshell, e.g. of a command substitution, and what it runs
+                await self._signal_jobs(signum, pid)
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def checkpoint(self) -> str | None:
+        """Commands that restore the working directory and exported variables."""
+        if self._checkpoint_path is None:
+            return None
+        try:
+            with open(self._checkpoint_path) as f:
+                return f.read() or None
+        except OSError:
+            return None
+
+    async def _restart(self):
+        """Replace the shell with a new one, restored from the checkpoint."""
+        checkpoint = self.checkpoint()
+        if self._process.returncode is None:
+            await self._signal_jobs(signal.SIGKILL)
+            self._process.kill()
+            await self._process.wait()
+        self._pending.clear()
+        self._started = False
+        await self.start(checkpoint)
+
+    async def _read_until(
+        self, stream: asyncio.StreamReader, sentinel: bytes, capture: _OutputCapture
+    ) -> bytes | None:
+        """
+        Read `stream` into `capture` up to the line starting with `sentinel`, and
+        return the rest of that line. Returns None if the shell exits first.
+        """
+        buffer = self._pending.pop(stream, bytearray())
+        # bytes that may be the start of a sentinel split across two reads
+        keep = len(sentinel) - 1
+        while (index := buffer.find(sentinel)) == -1:
+            if len(buffer) > keep:
+                capture.write(buffer[:-keep])
+                del buffer[:-keep]
+            chunk = await stream.read(self._read_size)
+            if not chunk:
+                return None
+            buffer += chunk
+        capture.write(buffer[:index])
+        del buffer[:index]
+        while (end := buffer.find(b"\n")) == -1:
+            chunk = await stream.read(self._read_size)
+            if not chunk:
+                return None
+            buffer += chunk
+        self._pending[stream] = buffer[end + 1 :]
+        return bytes(buffer[len(sentinel) : end])
+
+
+@dataclass
+class BashJob:
+    """A command running in the background in a session of a `SessionPool`."""
+
+    id: str
+    command: str
+    session: str
+    # stdout and stderr of the command, as it runs
+    log_path: str
+    task: asyncio.Task[ToolResult]
+    started_at: float = field(default_factory=time.monotonic)
+    finished_at: float | None = None
+
+    @property
+    def running(self) -> bool:
+        return not self.task.done()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def result(self) -> ToolResult | None:
+        """The result of the command once it has finished, output aside."""
+        if self.running:
+            return None
+        if self.task.cancelled():
+            return ToolResult(error="the job was cancelled")
+        try:
+            return self.task.result()
+        except ToolError as e:
+            return ToolResult(error=e.message)
+        except Exception as e:
+            return ToolResult(error=f"the job failed: {type(e).__name__}: {e}")
+
+    def tail(self, lines: int, max_bytes: int = _BashSession._tail_size) -> str:
+        """The last `lines` lines of the output so far, at most `max_bytes` of it."""
+        try:
+            with open(self.log_path, "rb") as f:
+                size = f.seek(0, os.SEEK_END)
+                f.seek(max(size - max_bytes, 0))
+                data = f.read()
+        except OSError:
+            return ""
+        return b"\n".join(data.splitlines()[-lines:]).decode(errors="replace")
+
+
+class SessionPool:
+    """
+    Named bash sessions, created on first use. Sessions other than the default
+    one are stopped once they have been idle for `idle_seconds`.
+
+    New sessions start in the working directory and with the exported variables
+    of the default session. `start_job` runs a command in the background and
+    returns immediately. A job runs in its own session unless one is named, with
+    its output written to a log file, and may take up to `job_timeout` seconds.
+    """
+
+    default_session = "default"
+
+    def __init__(
+        self,
+        slow_command_seconds: float | None = None,
+        idle_seconds: float = 600.0,
+        job_timeout: float = 3600.0,
+    ):
+        self.slow_command_seconds = slow_command_seconds
+        self.idle_seconds = idle_seconds
+        self.job_timeout = job_timeout
+        self.sessions: dict[str, _BashSession] = {}
+        self.jobs: dict[str, BashJob] = {}
+        self._job_ids = itertools.count(1)
+
+    async def session(
+        self, name: str | None = None, checkpoint: str | None = None
+    ) -> _BashSession:
+        """
+        The session called `name`, started if it does not exist yet. A new session
+        starts from `checkpoint`, by default that of the default session.
+        """
+        self.reap_idle()
+        name = name or self.default_session
+        session = self.sessions.get(name)
+        if session is None:
+            default = self.sessions.get(self.default_session)
+            if checkpoint is None and default is not None:
+                checkpoint = default.checkpoint()
+            # registered before it starts, so that concurrent calls share the shell
+            session = self.sessions[name] = _BashSession(self.slow_command_seconds)
+        await session.start(checkpoint)
+        session.last_used = time.monotonic()
+        return session
+
+    async def restart(self, name: str | None = None) -> _BashSession:
+        """Replace a session with a new shell in the old one's directory and environment."""
+        old = self.sessions.get(name or self.default_session)
+        checkpoint = old.checkpoint() if old is not None else None
+        self.stop(name or self.default_session)
+        return await self.session(name, checkpoint)
+
+    def stop(self, name: str):
+        session = self.sessions.pop(name, None)
+        if session is not None and session._started:
+            session.stop()
+
+    def reap_idle(self) -> list[str]:
+        """Stop the sessions that have been idle too long, returning their names."""
+        now = time.monotonic()
+        idle = [
+            name
+            for name, session in self.sessions.items()
+            if name != self.default_session
+            and not session.busy
+            and now - session.last_used > self.idle_seconds
+        ]
+        for name in idle:
+            self.stop(name)
+        return idle
+
+    async def start_job(self, command: str, session: str | None = None) -> BashJob:
+        job_id = f"job-{next(self._job_ids)}"
+        session = session or job_id
+        if session == self.default_session:
+            raise ToolError("the default session belongs to the bash tool, use another one")
+        self.check_idle(session)
+        shell = await self.session(session)
+        fd, log_path = tempfile.mkstemp(prefix=f"bash-{job_id}-", suffix=".log")
+        os.close(fd)
+        # braces run the command in the session's shell, so it can change its state
+        task = asyncio.create_task(
+            shell.run(f"{{ {command}\n}} > {log_path} 2>&1", self.job_timeout)
+        )
+        job = BashJob(job_id, command, session, log_path, task)
+        task.add_done_callback(lambda _: self._finish(job))
+        self.jobs[job_id] = job
+        get_metrics().increment("bash_jobs_total")
+        return job
+
+    def check_idle(self, session: str):
+        """Raise if a job is running in `session`, rather than wait for it."""
+        for job in self.jobs.values():
+            if job.session == session and job.running:
+                raise ToolError(
+                    f"session {session} is running {job.id}, poll it or use another session"
+                )
+
+    def _finish(self, job: BashJob):
+        job.finished_at = time.monotonic()
+        get_metrics().observe("bash_job_seconds", job.elapsed)
+
+    async def close(self):
+        """Stop every session with the jobs running in it, and remove the job logs."""
+        for job in self.jobs.values():
+            job.task.cancel()
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        for session in sessions:
+            await session.close()
+        for job in self.jobs.values():
+            try:
+                os.remove(job.log_path)
+            except OSError:
+                pass
 
 
 class BashTool(BaseAnthropicTool):
@@ -113,32 +572,38 @@ class BashTool(BaseAnthropicTool):
     The tool parameters are defined by Anthropic and are not editable.
     """
 
-    _session: _BashSession | None
+    pool: SessionPool
     name: ClassVar[Literal["bash"]] = "bash"
     api_type: ClassVar[Literal["bash_20241022"]] = "bash_20241022"
 
-    def __init__(self):
-        self._session = None
+    def __init__(
+        self, slow_command_seconds: float | None = 30.0, pool: SessionPool | None = None
+    ):
+        """
+        Commands run in the default session of `pool`, which other tools can share,
+        see `BashJobsTool`. Commands running for `slow_command_seconds` or longer
+        are flagged as slow.
+        """
+        self.pool = pool or SessionPool(slow_command_seconds)
         super().__init__()
 
+    def resources(self, tool_input: dict[str, Any]) -> tuple[set[str], set[str]]:
+        return set(), {f"bash:{self.pool.default_session}"}
+
     async def __call__(
         self, command: str | None = None, restart: bool = False, **kwargs
     ):
         print("### Running bash command:", command)
         if restart:
-            if self._session:
-                self._session.stop()
-            self._session = _BashSession()
-            await self._session.start()
-
-            return ToolResult(system="tool has been restarted.")
+            await self.pool.restart()
 
-        if self._session is None:
-            self._session = _BashSession()
-            await self._session.start()
+            return ToolResult(
+                system="tool has been restarted, with the working directory and "
+                "exported variables of the previous shell."
+            )
 
         if command is not None:
-            return await self._session.run(command)
+            return await (await self.pool.session()).run(command)
 
         raise ToolError("no command provided.")
 
@@ -0,0 +1,174 @@
+import asyncio
+import time
+from typing import Any, Literal
+
+from anthropic.types.beta import BetaToolParam
+
+from .base import BaseAnthropicTool, CLIResult, ToolError, ToolResult
+from .bash import BashJob, SessionPool
+
+Operation = Literal["start", "run", "poll", "tail", "list"]
+
+DEFAULT_TAIL_LINES = 20
+MAX_WAIT_SECONDS = 60.0
+
+
+class BashJobsTool(BaseAnthropicTool):
+    """
+    A custom tool for the session pool behind the bash tool: runs commands in
+    named sessions and long commands as background jobs, so a build or download
+    does not hold up the rest of the shell work.
+    """
+
+    name: Literal["bash_jobs"] = "bash_jobs"
+
+    def __init__(self, pool: SessionPool):
+        self.pool = pool
+        super().__init__()
+
+    def to_params(self) -> BetaToolParam:
+        return {
+            "name": self.name,
+            "description": (
+                "Run shell commands in named bash sessions and in the background, "
+                "next to the bash tool's own session. start runs a long command, such "
+                "as a build, download or server, as a background job and returns its "
+                "job id at once; check on it later with poll, which can wait for it, "
+                "or tail, and keep working in the meantime. run runs a command in a "
+                "named session and returns its output. list shows the sessions and "
+                "jobs. A new session starts in the bash tool's working directory "
+                "with its exported variables, and then keeps its own; idle sessions "
+                "are closed after a while."
+            ),
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "operation": {
+                        "type": "string",
+                        "enum": ["start", "run", "poll", "tail", "list"],
+                    },
+                    "command": {
+                        "type": "string",
+                        "description": "The command for start and run.",
+                    },
+                    "session": {
+                        "type": "string",
+                        "description": (
+                            "Session name for start and run. start uses a new "
+                            "session by default."
+                        ),
+                    },
+                    "job": {
+                        "type": "string",
+                        "description": "Job id for poll and tail.",
+                    },
+                    "lines": {
+                        "type": "integer",
+                        "description": (
+                            f"Output lines for poll and tail, {DEFAULT_TAIL_LINES} "
+                            "by default."
+                        ),
+                    },
+                    "wait": {
+                        "type": "number",
+                        "description": (
+                            "Seconds poll waits for the job to finish, at most "
+                            f"{MAX_WAIT_SECONDS:g}."
+                        ),
+                    },
+                },
+                "required": ["operation"],
+            },
+        }
+
+    def resources(self, tool_input: dict[str, Any]) -> tuple[set[str], set[str]]:
+        """Commands hold their session; looking at jobs needs nothing."""
+        session = tool_input.get("session")
+        if tool_input.get("operation") in ("start", "run") and session:
+            return set(), {f"bash:{session}"}
+        return set(), set()
+
+    async def __call__(
+        self,
+        *,
+        operation: Operation | None = None,
+        command: str | None = None,
+        session: str | None = None,
+        job: str | None = None,
+        lines: int | None = None,
+        wait: float | None = None,
+        **kwargs,
+    ):
+        lines = lines or DEFAULT_TAIL_LINES
+        if operation == "start":
+            if not command:
+                raise ToolError("command is required for start")
+            started = await self.pool.start_job(command, session)
+            return ToolResult(
+                output=(
+                    f"Started {started.id} in session {started.session}. Its output "
+                    f"is written to {started.log_path}; check on it with poll or tail."
+                )
+            )
+        if operation == "run":
+            if not command or not session:
+                raise ToolError("command and session are required for run")
+            if session == self.pool.default_session:
+                raise ToolError("use the bash tool for the default session")
+            self.pool.check_idle(session)
+            return await (await self.pool.session(session)).run(command)
+        if operation in ("poll", "tail"):
+            found = self.pool.jobs.get(job or "")
+            if found is None:
+                raise ToolError(f"no job {job!r}, see list")
+            try:
+                if operation == "tail":
+                    return ToolResult(output=found.tail(lines))
+                return await self._poll(found, lines, wait)
+            except ToolError:
+                raise
+            except Exception as e:
+                return ToolResult(error=f"{operation} of {found.id} failed: {type(e).__name__}: {e}")
+        if operation == "list":
+            return ToolResult(output=self._list())
+        raise ToolError(f"Invalid operation: {operation}")
+
+    async def _poll(self, job: BashJob, lines: int, wait: float | None) -> ToolResult:
+        try:
+            wait = min(float(wait or 0), MAX_WAIT_SECONDS)
+        except (TypeError, ValueError):
+            raise ToolError("wait must be a number") from None
+        if wait > 0 and job.running:
+            await asyncio.wait([job.task], timeout=wait)
+
+        result = job.result()
+        if result is None:
+            status = f"{job.id} is still running after {job.elapsed:.1f}s."
+        elif isinstance(result, CLIResult) and result.exit_code is not None:
+            status = (
+                f"{job.id} finished with exit status {result.exit_code} after "
+                f"{job.elapsed:.1f}s."
+            )
+        else:
+            status = f"{job.id} failed after {job.elapsed:.1f}s: {result.error}"
+        tail = job.tail(lines)
+        return ToolResult(
+            output=f"{status}\nLast {lines} lines of {job.log_path}:\n{tail}"
+            if tail
+            else f"{status}\nNo output yet."
+        )
+
+    def _list(self) -> str:
+        now = time.monotonic()
+        rows = ["Sessions:"]
+        for name, session in self.pool.sessions.items():
+            state = "busy" if session.busy else f"idle for {now - session.last_used:.0f}s"
+            rows.append(f"  {name}: {state}")
+        rows.append("Jobs:" if self.pool.jobs else "No jobs.")
+        for job in self.pool.jobs.values():
+            state = "running" if job.running else "finished"
+            rows.append(
+                f"  {job.id} in {job.session}, {state} after {job.elapsed:.1f}s: "
+                f"{job.command}"
+            )
+        return "\n".join(rows)
@@ -0,0 +1,319 @@
+"""
+Screen capture backends for the computer tool.
+
+Every backend returns the full screen as an RGB PIL image. `grab` is blocking and
+is run off the event loop by the caller; backends are safe to call from any
+thread.
+"""
+
+import ctypes
+import ctypes.util
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+
+from PIL import Image
+
+
+class CaptureBackend(metaclass=ABCMeta):
+    """Grabs frames of the screen the computer tool operates on."""
+
+    name: str
+
+    @abstractmethod
+    def size(self) -> tuple[int, int]:
+        """The screen size in the coordinate system used by mouse actions."""
+        ...
+
+    @abstractmethod
+    def grab(self) -> Image.Image:
+        """Capture the whole screen. The image may be larger than `size()` on HiDPI screens."""
+        ...
+
+    def close(self):
+        pass
+
+
+class PyAutoGUICapture(CaptureBackend):
+    """Captures through `pyautogui.screenshot`, which uses `screencapture` on MacOS."""
+
+    name = "pyautogui"
+
+    def size(self) -> tuple[int, int]:
+        import pyautogui
+
+        width, height = pyautogui.size()
+        return int(width), int(height)
+
+    def grab(self) -> Image.Image:
+        import pyautogui
+
+        return pyautogui.screenshot().convert("RGB")
+
+
+class MssCapture(CaptureBackend):
+    """
+    Captures through `mss`, which reads the frame buffer in-process instead of
+    spawning a helper per screenshot. Requires `pip install mss`.
+    """
+
+    name = "mss"
+
+    def __init__(self, monitor: int = 1):
+        try:
+            import mss
+        except ImportError as e:
+            raise ImportError(
+                "The mss capture backend requires the mss package: pip install mss"
+            ) from e
+        self._mss = mss
+        self.monitor = monitor
+        # mss handles are bound to the thread that created them
+        self._local = threading.local()
+
+    def _sct(self):
+        sct = getattr(self._local, "sct", None)
+        if sct is None:
+            sct = self._local.sct = self._mss.mss()
+        return sct
+
+    def size(self) -> tuple[int, int]:
+        monitor = self._sct().monitors[self.monitor]
+        return monitor["width"], monitor["height"]
+
+    def grab(self) -> Image.Image:
+        shot = self._sct().grab(self._sct().monitors[self.monitor])
+        return Image.frombytes("RGB", shot.size, shot.bgra, "raw", "BGRX")
+
+    def close(self):
+        sct = getattr(self._local, "sct", None)
+        if sct is not None:
+            sct.close()
+            self._local.sct = None
+
+
+class _XImage(ctypes.Structure):
+    _fields_ = [
+        ("width", ctypes.c_int),
+        ("height", ctypes.c_int),
+        ("xoffset", ctypes.c_int),
+        ("format", ctypes.c_int),
+        ("data", ctypes.c_void_p),
+        ("byte_order", ctypes.c_int),
+        ("bitmap_unit", ctypes.c_int),
+        ("bitmap_bit_order", ctypes.c_int),
+        ("bitmap_pad", ctypes.c_int),
+        ("depth", ctypes.c_int),
+        ("bytes_per_line", ctypes.c_int),
+        ("bits_per_pixel", ctypes.c_int),
+        ("red_mask", ctypes.c_ulong),
+        ("green_mask", ctypes.c_ulong),
+        ("blue_mask", ctypes.c_ulong),
+    ]
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ("shmseg", ctypes.c_ulong),
+        ("shmid", ctypes.c_int),
+        ("shmaddr", ctypes.c_void_p),
+        ("readOnly", ctypes.c_int),
+    ]
+
+
+class X11ShmCapture(CaptureBackend):
+    """
+    Captures an X11 display with the MIT-SHM extension: the server copies each
+    frame into a shared memory segment that is allocated once, so no pixel data
+    goes through the X socket. Linux only, needs libX11 and libXext.
+    """
+
+    name = "x11shm"
+
+    _ZPIXMAP = 2
+    _IPC_PRIVATE = 0
+    _IPC_CREAT = 0o1000
+    _IPC_RMID = 0
+
+    def __init__(self, display: str | None = None):
+        x11_path = ctypes.util.find_library("X11")
+        xext_path = ctypes.util.find_library("Xext")
+        if not x11_path or not xext_path:
+            raise OSError("The x11shm capture backend requires libX11 and libXext")
+        self._x11 = x11 = ctypes.CDLL(x11_path)
+        self._xext = xext = ctypes.CDLL(xext_path)
+        self._libc = libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+        x11.XOpenDisplay.restype = ctypes.c_void_p
+        x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        x11.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        x11.XRootWindow.restype = ctypes.c_ulong
+        x11.XRootWindow.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDefaultVisual.restype = ctypes.c_void_p
+        x11.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDisplayWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDisplayHeight.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.restype = ctypes.POINTER(_XImage)
+        xext.XShmCreateImage.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_uint,
+            ctypes.c_int,
+            ctypes.c_void_p,
+            ctypes.POINTER(_XShmSegmentInfo),
+            ctypes.c_uint,
+            ctypes.c_uint,
+        ]
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(_XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_ulong,
+            ctypes.POINTER(_XImage),
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_ulong,
+        ]
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+        self._display = x11.XOpenDisplay(display.encode() if display else None)
+        if not self._display:
+            raise OSError(f"Cannot open X display {display or '$DISPLAY'}")
+        if not xext.XShmQueryExtension(self._display):
+            x11.XCloseDisplay(self._display)
+            raise OSError("The X server does not support the MIT-SHM extension")
+
+        screen = x11.XDefaultScreen(self._display)
+        self._root = x11.XRootWindow(self._display, screen)
+        self._width = x11.XDisplayWidth(self._display, screen)
+        self._height = x11.XDisplayHeight(self._display, screen)
+
+        self._shminfo = _XShmSegmentInfo()
+        self._image = xext.XShmCreateImage(
+            self._display,
+            x11.XDefaultVisual(self._display, screen),
+            x11.XDefaultDepth(self._display, screen),
+            self._ZPIXMAP,
+            None,
+            ctypes.byref(self._shminfo),
+            self._width,
+            self._height,
+        )
+        if not self._image:
+            x11.XCloseDisplay(self._display)
+            raise OSError("XShmCreateImage failed")
+        image = self._image.contents
+        if image.bits_per_pixel != 32:
+            x11.XCloseDisplay(self._display)
+            raise OSError(f"Unsupported X11 pixel format: {image.bits_per_pixel} bpp")
+
+        self._buffer_size = image.bytes_per_line * image.height
+        self._shminfo.shmid = libc.shmget(
+            self._IPC_PRIVATE, self._buffer_size, self._IPC_CREAT | 0o600
+        )
+        if self._shminfo.shmid < 0:
+            x11.XCloseDisplay(self._display)
+            raise OSError(ctypes.get_errno(), "shmget failed")
+        self._shminfo.shmaddr = libc.shmat(self._shminfo.shmid, None, 0)
+        image.data = self._shminfo.shmaddr
+        self._shminfo.readOnly = 0
+        xext.XShmAttach(self._display, ctypes.byref(self._shminfo))
+        x11.XSync(self._display, 0)
+        # the segment is freed once both sides have detached
+        libc.shmctl(self._shminfo.shmid, self._IPC_RMID, None)
+
+        # Xlib is not thread safe without XInitThreads
+        self._lock = threading.Lock()
+
+    def size(self) -> tuple[int, int]:
+        return self._width, self._height
+
+    def grab(self) -> Image.Image:
+        with self._lock:
+            if not self._display:
+                raise OSError("The x11shm capture backend is closed")
+            if not self._xext.XShmGetImage(
+                self._display, self._root, self._image, 0, 0, ctypes.c_ulong(-1).value
+            ):
+                raise OSError("XShmGetImage failed")
+            data = ctypes.string_at(self._shminfo.shmaddr, self._buffer_size)
+        return Image.frombuffer(
+            "RGB",
+            (self._width, self._height),
+            data,
+            "raw",
+            "BGRX",
+            self._image.contents.bytes_per_line,
+            1,
+        )
+
+    def close(self):
+        with self._lock:
+            if not self._display:
+                return
+            self._xext.XShmDetach(self._display, ctypes.byref(self._shminfo))
+            self._x11.XCloseDisplay(self._display)
+            self._libc.shmdt(self._shminfo.shmaddr)
+            self._display = None
+
+
+class FakeScreen(CaptureBackend):
+    """
+    An in-memory screen for running the computer tool without a display. Draw on
+    `image` (or replace it) to change what the next screenshot shows.
+    """
+
+    name = "fake"
+
+    def __init__(self, width: int = 1280, height: int = 800, color: str = "white"):
+        self.image = Image.new("RGB", (width, height), color)
+        self.grabs = 0
+        self._lock = threading.Lock()
+
+    def size(self) -> tuple[int, int]:
+        return self.image.size
+
+    def grab(self) -> Image.Image:
+        with self._lock:
+            self.grabs += 1
+            return self.image.copy()
+
+
+CAPTURE_BACKENDS: dict[str, type[CaptureBackend]] = {
+    backend.name: backend
+    for backend in (PyAutoGUICapture, MssCapture, X11ShmCapture, FakeScreen)
+}
+
+
+def get_capture_backend(name: str) -> CaptureBackend:
+    """Instantiate a capture backend by name ("pyautogui", "mss", "x11shm" or "fake")."""
+    try:
+        return CAPTURE_BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown capture backend: {name}") from None
+
+
+def benchmark(backend: CaptureBackend, frames: int = 30) -> dict[str, float]:
+    """Grab `frames` screenshots back to back and report latency and throughput."""
+    backend.grab()  # warm up
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(frames):
+        grab_start = time.perf_counter()
+        backend.grab()
+        latencies.append(time.perf_counter() - grab_start)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "mean_ms": 1000 * sum(latencies) / frames,
+        "p95_ms": 1000 * latencies[min(frames - 1, int(frames * 0.95))],
+        "fps": frames / elapsed,
+    }
@@ -1,9 +1,15 @@
 """Collection classes for managing multiple tools."""
 
+import asyncio
+import time
+from collections.abc import Callable
+from dataclasses import dataclass, field
 from typing import Any
 
 from anthropic.types.beta import BetaToolUnionParam
 
+from ..images import base64_size, get_image_store
+from ..metrics import get_metrics
 from .base import (
     BaseAnthropicTool,
     ToolError,
@@ -25,6 +31,21 @@ class ToolCollection:
         return [tool.to_params() for tool in self.tools]
 
     async def run(self, *, name: str, tool_input: dict[str, Any]) -> ToolResult:
+        start = time.perf_counter()
+        result = await self._run(name=name, tool_input=tool_input)
+        image_bytes = len(result.base64_image or "")
+        if result.image_ref:
+            image_bytes += base64_size(len(get_image_store().get(result.image_ref)))
+        get_metrics().record_tool_call(
+            tool=name,
+            wall_time=time.perf_counter() - start,
+            output_bytes=len(result.output or "") + len(result.error or ""),
+            image_bytes=image_bytes,
+            error=bool(result.error),
+        )
+        return result
+
+    async def _run(self, *, name: str, tool_input: dict[str, Any]) -> ToolResult:
         tool = self.tool_map.get(name)
         if not tool:
             return ToolFailure(error=f"Tool {name} is invalid")
@@ -32,3 +53,114 @@ class ToolCollection:
             return await tool(**tool_input)
         except ToolError as e:
             return ToolFailure(error=e.message)
+
+    def batch(
+        self, on_result: Callable[[ToolResult, str], None] | None = None
+    ) -> "ToolBatch":
+        """Start a batch of tool calls that are scheduled by the resources they use."""
+        return ToolBatch(self, on_result=on_result)
+
+
+@dataclass
+class BatchTiming:
+    """Latency of one batch of tool calls."""
+
+    wall_time: float = 0.0
+    tool_times: dict[str, float] = field(default_factory=dict)
+
+    @property
+    def serial_time(self) -> float:
+        """The time the batch would have taken had every call run back to back."""
+        return sum(self.tool_times.values())
+
+    @property
+    def overlap(self) -> float:
+        return max(self.serial_time - self.wall_time, 0.0)
+
+
+class ToolBatch:
+    """
+    Dependency-aware scheduler for the tool calls of one assistant turn.
+
+    Calls are submitted in tool_use order and start immediately unless an earlier
+    call in the batch conflicts with them on a resource (see
+    `BaseAnthropicTool.resources`), in which case they wait for it. GUI actions
+    therefore stay strictly ordered while file and shell work can overlap.
+    """
+
+    def __init__(
+        self,
+        collection: ToolCollection,
+        on_result: Callable[[ToolResult, str], None] | None = None,
+    ):
+        self.collection = collection
+        self.on_result = on_result
+        self.timing = BatchTiming()
+        self.first_started_at: float | None = None
+        self._tasks: list[tuple[str, asyncio.Task[ToolResult]]] = []
+        self._writers: dict[str, asyncio.Task[ToolResult]] = {}
+        self._readers: dict[str, list[asyncio.Task[ToolResult]]] = {}
+        self._submitted_at: float | None = None
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def submit(self, *, name: str, tool_input: dict[str, Any], tool_use_id: str):
+        """Schedule a tool call behind the earlier calls it conflicts with."""
+        if self._submitted_at is None:
+            self._submitted_at = time.perf_counter()
+
+        tool = self.collection.tool_map.get(name)
+        shared, exclusive = tool.resources(tool_input) if tool else (set(), set())
+
+        waits: set[asyncio.Task[ToolResult]] = set()
+        for key in exclusive:
+            waits.update(self._readers.get(key, []))
+            if key in self._writers:
+                waits.add(self._writers[key])
+        for key in shared:
+            if key in self._writers:
+                waits.add(self._writers[key])
+
+        task = asyncio.create_task(self._run(name, tool_input, tool_use_id, waits))
+        for key in exclusive:
+            self._writers[key] = task
+            self._readers[key] = []
+        for key in shared:
+            self._readers.setdefault(key, []).append(task)
+        self._tasks.append((tool_use_id, task))
+
+    async def _run(
+        self,
+        name: str,
+        tool_input: dict[str, Any],
+        tool_use_id: str,
+        waits: set[asyncio.Task[ToolResult]],
+    ) -> ToolResult:
+        if waits:
+            await asyncio.wait(waits)
+        start = time.perf_counter()
+        if self.first_started_at is None:
+            self.first_started_at = start
+        result = await self.collection.run(name=name, tool_input=tool_input)
+        self.timing.tool_times[tool_use_id] = time.perf_counter() - start
+        if self.on_result:
+            self.on_result(result, tool_use_id)
+        return result
+
+    async def results(self) -> list[tuple[str, ToolResult]]:
+        """Wait for every call and return the results in tool_use order."""
+        try:
+            results = [
+                (tool_use_id, await task) for tool_use_id, task in self._tasks
+            ]
+        except BaseException:
+            self.cancel()
+            raise
+        if self._submitted_at is not None:
+            self.timing.wall_time = time.perf_counter() - self._submitted_at
+        return results
+
+    def cancel(self):
+        for _, task in self._tasks:
+            task.cancel()
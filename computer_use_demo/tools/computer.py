@@ -1,18 +1,26 @@
 import asyncio
-import base64
-import io
+import time
 from enum import StrEnum
-from typing import Literal, TypedDict
+from typing import Any, Literal, TypedDict
 import pyautogui
+from PIL import Image
 from anthropic.types.beta import BetaToolComputerUse20241022Param
 
+from ..images import base64_size, get_image_store
+from ..metrics import get_metrics
 from .base import BaseAnthropicTool, ToolError, ToolResult
+from .capture import CaptureBackend, get_capture_backend
+from .encoding import ImageEncoding, encode_image
+from .frames import changed_region, frame_hash, hash_distance, settle_frame
+from .keyboard import (
+    TYPING_DELAY_MS,
+    KeyboardBackend,
+    PyAutoGUIKeyboard,
+    enter_text,
+)
 
 OUTPUT_DIR = "/tmp/outputs"
 
-TYPING_DELAY_MS = 12
-TYPING_GROUP_SIZE = 50
-
 Action = Literal[
     "key",
     "type",
@@ -24,8 +32,26 @@ Action = Literal[
     "double_click",
     "screenshot",
     "cursor_position",
+    "zoom",
 ]
 
+# actions that can change what is on the screen
+SETTLE_ACTIONS = {
+    "key",
+    "type",
+    "mouse_move",
+    "left_click",
+    "left_click_drag",
+    "right_click",
+    "middle_click",
+    "double_click",
+}
+
+# default width of the screenshots the model sees, see `ComputerTool`
+OVERVIEW_WIDTH = 1024
+# longest side of a zoomed image; larger regions are downscaled to it
+ZOOM_MAX_SIZE = 1280
+
 
 class ScalingSource(StrEnum):
     COMPUTER = "computer"
@@ -38,10 +64,6 @@ class ComputerToolOptions(TypedDict):
     display_number: int | None
 
 
-def chunks(s: str, chunk_size: int) -> list[str]:
-    return [s[i : i + chunk_size] for i in range(0, len(s), chunk_size)]
-
-
 class ComputerTool(BaseAnthropicTool):
     """
     A tool that allows the agent to interact with the screen, keyboard, and mouse of the current computer.
@@ -68,35 +90,134 @@ class ComputerTool(BaseAnthropicTool):
     def to_params(self) -> BetaToolComputerUse20241022Param:
         return {"name": self.name, "type": self.api_type, **self.options}
 
-    def __init__(self):
+    def __init__(
+        self,
+        capture_backend: CaptureBackend | str = "pyautogui",
+        encoding: ImageEncoding | None = None,
+        unchanged_threshold: int | None = 0,
+        region_diff: float | None = None,
+        full_frame_interval: int = 5,
+        settle: bool = False,
+        settle_interval: float = 0.1,
+        keyboard: KeyboardBackend | None = None,
+        overview_width: int = OVERVIEW_WIDTH,
+    ):
+        """
+        Screenshots are downsized to at most `overview_width` pixels wide, which is
+        enough to find windows and controls, and the model's coordinates are in that
+        overview. The zoom action returns a region of the screen at full resolution,
+        for reading small text.
+
+        `unchanged_threshold` controls when a screenshot is replaced by a note that
+        the screen has not changed since the last image sent: 0 compares frames
+        exactly, a positive value is the largest perceptual hash distance (out of
+        256 bits) still treated as unchanged, and None always sends the image.
+
+        With `region_diff` set, a screenshot whose changed area is at most that
+        fraction of the screen is sent as a crop of the changed region, together
+        with its bounding box in API coordinates. At least every
+        `full_frame_interval`-th screenshot is a full frame.
+
+        With `settle` enabled, every action that can change the screen waits until
+        two frames captured `settle_interval` seconds apart match, for at most
+        `_screenshot_delay` seconds, and returns a screenshot with its result.
+
+        Long text is pasted through the `keyboard` backend's clipboard rather than
+        typed, and typed text is checked against the screen chunk by chunk, see
+        `keyboard.enter_text`.
+        """
         super().__init__()
 
-        self.width = int(pyautogui.size()[0])
-        self.height = int(pyautogui.size()[1])
+        self.encoding = encoding or ImageEncoding()
+        self.unchanged_threshold = unchanged_threshold
+        self.region_diff = region_diff
+        self.full_frame_interval = full_frame_interval
+        self._last_frame_hash: int | None = None
+        self._last_image_bytes = 0
+        # last frame the model has seen, at the target size, for region diffs
+        self._last_frame: Image.Image | None = None
+        self._screenshots_since_full = 0
+        self.settle = settle
+        self.settle_interval = settle_interval
+        self.keyboard = keyboard or PyAutoGUIKeyboard()
+        # background capture started by `prefetch`
+        self._prefetch: asyncio.Task[tuple[int, bytes, float]] | None = None
+
+        if isinstance(capture_backend, str):
+            capture_backend = get_capture_backend(capture_backend)
+        self.capture = capture_backend
+
+        self.width, self.height = self.capture.size()
 
         self.display_num = None  # Not used on MacOS
 
-        MAX_WIDTH = 1280  # Max screenshot width
-        if self.width > MAX_WIDTH:
-            self.scale_factor = MAX_WIDTH / self.width
-            self.target_width = MAX_WIDTH
+        if self.width > overview_width:
+            self.scale_factor = overview_width / self.width
+            self.target_width = overview_width
             self.target_height = int(self.height * self.scale_factor)
         else:
             self.scale_factor = 1.0
             self.target_width = self.width
             self.target_height = self.height
 
+    def resources(self, tool_input: dict[str, Any]) -> tuple[set[str], set[str]]:
+        """All GUI actions share one screen, so they always run in order."""
+        return set(), {"gui"}
+
     async def __call__(
         self,
         *,
         action: Action,
         text: str | None = None,
         coordinate: list[int] | None = None,
+        region: list[int] | None = None,
+        full: bool = False,
         **kwargs,
     ):
+        result = await self.act(
+            action=action, text=text, coordinate=coordinate, region=region, full=full
+        )
+        if not self.settle or action not in SETTLE_ACTIONS:
+            return result
+
+        settle_time, settled = await self.wait_for_settle()
+        get_metrics().observe("gui_settle_seconds", settle_time, action=action)
+        if not settled:
+            get_metrics().increment("gui_settle_timeouts_total", action=action)
+        screenshot = await self.screenshot()
+        status = (
+            f"Screen settled after {settle_time:.2f}s."
+            if settled
+            else f"Screen still changing after {settle_time:.2f}s."
+        )
+        return screenshot.replace(
+            output="\n".join(
+                part for part in (result.output, status, screenshot.output) if part
+            )
+        )
+
+    async def act(
+        self,
+        *,
+        action: Action,
+        text: str | None = None,
+        coordinate: list[int] | None = None,
+        region: list[int] | None = None,
+        full: bool = False,
+    ) -> ToolResult:
         print(
-            f"### Performing action: {action}{f", text: {text}" if text else ''}{f", coordinate: {coordinate}" if coordinate else ''}"
+            f"### Performing action: {action}{f", text: {text}" if text else ''}{f", coordinate: {coordinate}" if coordinate else ''}{f", region: {region}" if region else ''}"
         )
+        if action in SETTLE_ACTIONS:
+            self.discard_prefetch()
+        if action == "zoom":
+            if text is not None or coordinate is not None:
+                raise ToolError("only region is accepted for zoom")
+            return await self.zoom(region)
+        if region is not None:
+            raise ToolError(f"region is not accepted for {action}")
+        if full and action != "screenshot":
+            raise ToolError(f"full is not accepted for {action}")
         if action in ("mouse_move", "left_click_drag"):
             if coordinate is None:
                 raise ToolError(f"coordinate is required for {action}")
@@ -159,12 +280,31 @@ class ComputerTool(BaseAnthropicTool):
                     # Add more special keys as needed
                 }
                 key_sequence = [special_keys.get(key, key) for key in key_sequence]
-                await asyncio.to_thread(pyautogui.hotkey, *key_sequence)
+                await asyncio.to_thread(self.keyboard.hotkey, *key_sequence)
                 return ToolResult(output=f"Key combination '{text}' pressed.")
             elif action == "type":
-                await asyncio.to_thread(
-                    pyautogui.write, text, interval=TYPING_DELAY_MS / 1000.0
+                start = time.perf_counter()
+                strategy, failed = await asyncio.to_thread(
+                    enter_text,
+                    self.keyboard,
+                    text,
+                    TYPING_DELAY_MS / 1000.0,
+                    lambda: frame_hash(self.capture.grab()),
                 )
+                get_metrics().observe(
+                    "text_entry_seconds", time.perf_counter() - start, strategy=strategy
+                )
+                get_metrics().increment(
+                    "text_entry_chars_total", len(text), strategy=strategy
+                )
+                if failed:
+                    raise ToolError(
+                        f"Typed the text except for these parts, which contain characters "
+                        f"without a key and could not be pasted, or did not show up on the "
+                        f"screen, in which case typing stopped: {failed}"
+                    )
+                if strategy == "paste":
+                    return ToolResult(output=f"Pasted text: {text}")
                 return ToolResult(output=f"Typed text: {text}")
 
         if action in (
@@ -180,7 +320,7 @@ class ComputerTool(BaseAnthropicTool):
                 raise ToolError(f"coordinate is not accepted for {action}")
 
             if action == "screenshot":
-                return await self.screenshot()
+                return await self.screenshot(full)
             elif action == "cursor_position":
                 x, y = pyautogui.position()
                 x, y = self.scale_coordinates(ScalingSource.COMPUTER, int(x), int(y))
@@ -198,21 +338,247 @@ class ComputerTool(BaseAnthropicTool):
 
         raise ToolError(f"Invalid action: {action}")
 
-    async def screenshot(self):
-        """Take a screenshot of the current screen and return the base64 encoded image."""
-        # Capture screenshot using PyAutoGUI
-        screenshot = await asyncio.to_thread(pyautogui.screenshot)
+    async def zoom(self, region: list[int] | None) -> ToolResult:
+        """
+        A full resolution image of `region`, [x0, y0, x1, y1] in the coordinates of
+        the overview screenshots.
+        """
+        if (
+            not isinstance(region, list)
+            or len(region) != 4
+            or not all(isinstance(i, int) and i >= 0 for i in region)
+        ):
+            raise ToolError("region must be a list of 4 non-negative integers")
+        x0, y0, x1, y1 = region
+        if x1 <= x0 or y1 <= y0:
+            raise ToolError("region must be [x0, y0, x1, y1] with x0 < x1 and y0 < y1")
+        if x1 > self.target_width or y1 > self.target_height:
+            raise ToolError(
+                f"region must lie within the {self.target_width}x{self.target_height} screen"
+            )
+
+        left, top = self.scale_coordinates(ScalingSource.API, x0, y0)
+        right, bottom = self.scale_coordinates(ScalingSource.API, x1, y1)
+        frame = await asyncio.to_thread(self.capture.grab)
+        # HiDPI screens capture more pixels than the mouse coordinate space
+        x_pixels, y_pixels = frame.width / self.width, frame.height / self.height
+        crop = frame.crop(
+            (
+                round(left * x_pixels),
+                round(top * y_pixels),
+                min(round(right * x_pixels), frame.width),
+                min(round(bottom * y_pixels), frame.height),
+            )
+        )
+        scale = min(ZOOM_MAX_SIZE / max(crop.size), 1.0)
+        size = (max(round(crop.width * scale), 1), max(round(crop.height * scale), 1))
+
+        start = time.perf_counter()
+        image = await encode_image(crop, self.encoding, size)
+        get_metrics().observe(
+            "screenshot_encode_seconds",
+            time.perf_counter() - start,
+            format=self.encoding.format,
+        )
+        get_metrics().increment("screenshots_zoomed_total")
+        width, height = size
+        return ToolResult(
+            output=(
+                f"This {width}x{height} image shows the region from x={x0}, y={y0} to "
+                f"x={x1}, y={y1} of the screen, magnified {width / (x1 - x0):.1f} "
+                f"times. A point (px, py) in the image is at x = {x0} + px * "
+                f"{x1 - x0} / {width}, y = {y0} + py * {y1 - y0} / {height} on the screen."
+            ),
+            image_ref=get_image_store().put(image, self.encoding.media_type),
+            media_type=self.encoding.media_type,
+        )
+
+    async def screenshot(self, full: bool = False):
+        """
+        Take a screenshot of the current screen and return the base64 encoded image.
+        `full` sends the whole screen even if it has not changed since the last
+        screenshot, or would be sent as a crop in region diff mode.
+        """
+        prefetch, self._prefetch = self._prefetch, None
+        try:
+            return await self._screenshot(full, prefetch)
+        finally:
+            if prefetch is not None:
+                prefetch.cancel()
+
+    async def _screenshot(
+        self, full: bool, prefetch: asyncio.Task[tuple[int, bytes, float]] | None
+    ) -> ToolResult:
+        start = time.perf_counter()
+        screenshot = await asyncio.to_thread(self.capture.grab)
+        get_metrics().observe(
+            "screen_capture_seconds",
+            time.perf_counter() - start,
+            backend=self.capture.name,
+        )
+        frame = screenshot
+
+        current_hash = None
+        if self.unchanged_threshold is not None:
+            current_hash = await asyncio.to_thread(
+                frame_hash, screenshot, self.unchanged_threshold == 0
+            )
+            if (
+                not full
+                and self._last_frame_hash is not None
+                and hash_distance(current_hash, self._last_frame_hash)
+                <= self.unchanged_threshold
+            ):
+                get_metrics().increment("screenshots_unchanged_total")
+                get_metrics().increment(
+                    "screenshot_bytes_saved_total", self._last_image_bytes
+                )
+                return ToolResult(
+                    output="The screen has not changed since the previous screenshot."
+                )
+
+        # HiDPI screens capture more pixels than the mouse coordinate space
+        size = (self.target_width, self.target_height) if self._scaling_enabled else None
+        if self.region_diff is not None:
+            if size is not None and screenshot.size != size:
+                screenshot = await asyncio.to_thread(screenshot.resize, size)
+            if not full:
+                result = await self._region_screenshot(screenshot)
+                if result is not None:
+                    self._last_frame_hash = current_hash
+                    return result
+
+        image = await self._use_prefetch(prefetch, frame) if prefetch else None
+        if image is None:
+            start = time.perf_counter()
+            image = await encode_image(screenshot, self.encoding, size)
+            get_metrics().observe(
+                "screenshot_encode_seconds",
+                time.perf_counter() - start,
+                format=self.encoding.format,
+            )
 
-        if self._scaling_enabled and self.scale_factor < 1.0:
-            screenshot = screenshot.resize((self.target_width, self.target_height))
+        self._last_frame_hash = current_hash
+        self._last_image_bytes = base64_size(len(image))
+        if self.region_diff is not None:
+            self._last_frame = screenshot
+            self._screenshots_since_full = 0
+        return ToolResult(
+            image_ref=get_image_store().put(image, self.encoding.media_type),
+            media_type=self.encoding.media_type,
+        )
 
-        img_buffer = io.BytesIO()
-        # Save the image to an in-memory buffer
-        screenshot.save(img_buffer, format="PNG", optimize=True)
-        img_buffer.seek(0)
-        base64_image = base64.b64encode(img_buffer.read()).decode()
+    def prefetch(self):
+        """
+        Capture and encode a screenshot in the background, to be returned by the next
+        `screenshot` call if the screen has not changed by then.
+        """
+        self.discard_prefetch()
+        self._prefetch = asyncio.create_task(self._prefetch_screenshot())
+
+    def discard_prefetch(self):
+        if self._prefetch is not None:
+            self._prefetch.cancel()
+            self._prefetch = None
+
+    async def _prefetch_screenshot(self) -> tuple[int, bytes, float]:
+        """The exact hash and encoding of a fresh frame, and the time encoding took."""
+        frame = await asyncio.to_thread(self.capture.grab)
+        start = time.perf_counter()
+        size = (self.target_width, self.target_height) if self._scaling_enabled else None
+        image = await encode_image(frame, self.encoding, size)
+        encode_time = time.perf_counter() - start
+        return await asyncio.to_thread(frame_hash, frame), image, encode_time
+
+    async def _use_prefetch(
+        self, prefetch: asyncio.Task[tuple[int, bytes, float]], frame: Image.Image
+    ) -> bytes | None:
+        """The prefetched encoding if it shows the same pixels as `frame`."""
+        start = time.perf_counter()
+        try:
+            prefetched_hash, image, encode_time = await prefetch
+        except Exception:
+            return None
+        hit = prefetched_hash == await asyncio.to_thread(frame_hash, frame)
+        get_metrics().increment(
+            "screenshot_prefetch_total", result="hit" if hit else "miss"
+        )
+        if not hit:
+            return None
+        get_metrics().observe(
+            "screenshot_prefetch_saved_seconds",
+            max(encode_time - (time.perf_counter() - start), 0.0),
+        )
+        return image
+
+    async def _region_screenshot(self, frame: Image.Image) -> ToolResult | None:
+        """A crop of the area changed since the last frame sent, or None to send a full frame."""
+        previous = self._last_frame
+        if (
+            previous is None
+            or previous.size != frame.size
+            or self._screenshots_since_full + 1 >= self.full_frame_interval
+        ):
+            return None
+        region = await asyncio.to_thread(changed_region, previous, frame)
+        if region is None:
+            return None
+        left, top, right, bottom = region
+        if (right - left) * (bottom - top) > self.region_diff * frame.width * frame.height:
+            return None
+
+        start = time.perf_counter()
+        image = await encode_image(frame.crop(region), self.encoding)
+        get_metrics().observe(
+            "screenshot_encode_seconds",
+            time.perf_counter() - start,
+            format=self.encoding.format,
+        )
+        get_metrics().increment("screenshots_cropped_total")
+        get_metrics().increment(
+            "screenshot_bytes_saved_total",
+            max(self._last_image_bytes - base64_size(len(image)), 0),
+        )
 
-        return ToolResult(base64_image=base64_image)
+        self._last_frame = frame
+        self._screenshots_since_full += 1
+        return ToolResult(
+            output=(
+                "Only part of the screen changed since the previous screenshot. "
+                f"This image shows the region from x={left}, y={top} to x={right}, "
+                f"y={bottom} of the {frame.width}x{frame.height} screen; add "
+                f"({left}, {top}) to positions in the image to get screen "
+                "coordinates. The rest of the screen is unchanged."
+            ),
+            image_ref=get_image_store().put(image, self.encoding.media_type),
+            media_type=self.encoding.media_type,
+        )
+
+    async def wait_for_settle(self, timeout: float | None = None) -> tuple[float, bool]:
+        """
+        Capture low resolution frames every `settle_interval` seconds until two in a
+        row match or `timeout` (default `_screenshot_delay`) expires. Returns the
+        time waited and whether the screen settled.
+        """
+        timeout = self._screenshot_delay if timeout is None else timeout
+        start = time.perf_counter()
+        previous = None
+        while True:
+            frame = await asyncio.to_thread(
+                lambda: settle_frame(self.capture.grab())
+            )
+            elapsed = time.perf_counter() - start
+            if frame == previous:
+                return elapsed, True
+            if elapsed >= timeout:
+                return elapsed, False
+            previous = frame
+            await asyncio.sleep(min(self.settle_interval, timeout - elapsed))
+
+    def forget_last_frame(self):
+        """Send the next screenshot in full, e.g. once the model can no longer see the last one."""
+        self._last_frame_hash = None
+        self._last_frame = None
 
     def scale_coordinates(self, source: ScalingSource, x: int, y: int):
         """Scale coordinates between the assistant's coordinate system and the real screen coordinates."""
@@ -0,0 +1,139 @@
+import asyncio
+import time
+from typing import Any, Literal, get_args
+
+from anthropic.types.beta import BetaToolParam
+
+from ..metrics import get_metrics
+from .base import BaseAnthropicTool, ToolError
+from .computer import Action, ComputerTool
+
+# every computer action except the ones that return an image; one screenshot is
+# taken at the end
+BATCH_ACTIONS = [
+    action for action in get_args(Action) if action not in ("screenshot", "zoom")
+]
+MAX_WAIT_SECONDS = 10.0
+
+
+class ComputerBatchTool(BaseAnthropicTool):
+    """
+    A custom tool that runs an ordered list of computer actions in one call and
+    returns a single result with one final screenshot, so a sequence of clicks and
+    keystrokes costs one model round trip instead of one per action.
+    """
+
+    name: Literal["computer_batch"] = "computer_batch"
+
+    def __init__(self, computer: ComputerTool):
+        self.computer = computer
+        super().__init__()
+
+    def to_params(self) -> BetaToolParam:
+        return {
+            "name": self.name,
+            "description": (
+                "Run several computer actions in order in a single call, e.g. to click "
+                "a field, type into it and press tab, for every field of a form. Uses "
+                "the same actions, text and coordinates as the computer tool, so clicks "
+                "happen at the mouse position set by a preceding mouse_move. Stops at "
+                "the first action that fails. Returns the time each action took and "
+                "one screenshot taken after the last action, a full frame if "
+                "full_screenshot is true. Use it when you already know every step; "
+                "use the computer tool when you need to look at the screen between "
+                "steps."
+            ),
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "actions": {
+                        "type": "array",
+                        "minItems": 1,
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "action": {"type": "string", "enum": BATCH_ACTIONS},
+                                "text": {"type": "string"},
+                                "coordinate": {
+                                    "type": "array",
+                                    "items": {"type": "integer"},
+                                    "minItems": 2,
+                                    "maxItems": 2,
+                                },
+                                "wait": {
+                                    "type": "number",
+                                    "description": (
+                                        "Seconds to wait after the action, at most "
+                                        f"{MAX_WAIT_SECONDS:g}."
+                                    ),
+                                },
+                            },
+                            "required": ["action"],
+                        },
+                    },
+                    "full_screenshot": {
+                        "type": "boolean",
+                        "description": (
+                            "Send the whole screen, even if it has not changed or only "
+                            "part of it has."
+                        ),
+                    },
+                },
+                "required": ["actions"],
+            },
+        }
+
+    def resources(self, tool_input: dict[str, Any]) -> tuple[set[str], set[str]]:
+        """Shares the screen with the computer tool, see `ComputerTool.resources`."""
+        return set(), {"gui"}
+
+    async def __call__(
+        self,
+        *,
+        actions: list[dict[str, Any]] | None = None,
+        full_screenshot: bool = False,
+        **kwargs,
+    ):
+        if not actions:
+            raise ToolError("actions must be a non-empty list")
+
+        lines = []
+        failure = None
+        batch_start = time.perf_counter()
+        for index, step in enumerate(actions, start=1):
+            action = step.get("action") if isinstance(step, dict) else None
+            if action not in BATCH_ACTIONS:
+                failure = f"Action {index} failed: invalid action {action!r}"
+                break
+            try:
+                wait = min(float(step.get("wait") or 0), MAX_WAIT_SECONDS)
+            except (TypeError, ValueError):
+                failure = f"Action {index} ({action}) failed: wait must be a number"
+                break
+            start = time.perf_counter()
+            try:
+                result = await self.computer.act(
+                    action=action, text=step.get("text"), coordinate=step.get("coordinate")
+                )
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                elif self.computer.settle:
+                    await self.computer.wait_for_settle()
+            except ToolError as e:
+                failure = f"Action {index} ({action}) failed: {e.message}"
+                break
+            elapsed = time.perf_counter() - start
+            get_metrics().observe("batch_action_seconds", elapsed, action=action)
+            lines.append(f"{index}. {action}: {result.output} ({elapsed:.2f}s)")
+
+        if failure:
+            lines.append(f"{failure}. The remaining actions were not run.")
+        else:
+            lines.append(
+                f"All {len(actions)} actions completed in "
+                f"{time.perf_counter() - batch_start:.2f}s."
+            )
+        screenshot = await self.computer.screenshot(bool(full_screenshot))
+        if screenshot.output:
+            lines.append(screenshot.output)
+        return screenshot.replace(output="\n".join(lines))
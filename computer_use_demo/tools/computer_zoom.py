@@ -0,0 +1,52 @@
+from typing import Any, Literal
+
+from anthropic.types.beta import BetaToolParam
+
+from .base import BaseAnthropicTool
+from .computer import ComputerTool
+
+
+class ComputerZoomTool(BaseAnthropicTool):
+    """
+    A custom tool for the computer tool's zoom action, which the computer use tool
+    definition has no parameters for. Screenshots stay at the cheap overview
+    resolution and detail is sent only for the regions the model asks about.
+    """
+
+    name: Literal["computer_zoom"] = "computer_zoom"
+
+    def __init__(self, computer: ComputerTool):
+        self.computer = computer
+        super().__init__()
+
+    def to_params(self) -> BetaToolParam:
+        return {
+            "name": self.name,
+            "description": (
+                "Look at a region of the screen at full resolution, e.g. to read small "
+                "text or tell similar icons apart. The region uses the same coordinates "
+                "as the computer tool's screenshots, which are downsized. Returns an "
+                "image of the region and how to map positions in it back to screen "
+                "coordinates for the computer tool."
+            ),
+            "input_schema": {
+                "type": "object",
+                "properties": {
+                    "region": {
+                        "type": "array",
+                        "description": "[x0, y0, x1, y1], the top left and bottom right corners.",
+                        "items": {"type": "integer"},
+                        "minItems": 4,
+                        "maxItems": 4,
+                    },
+                },
+                "required": ["region"],
+            },
+        }
+
+    def resources(self, tool_input: dict[str, Any]) -> tuple[set[str], set[str]]:
+        """Only looks at the screen, so zooms can run together but not during GUI actions."""
+        return {"gui"}, set()
+
+    async def __call__(self, *, region: list[int] | None = None, **kwargs):
+        return await self.computer.act(action="zoom", region=region)
@@ -1,6 +1,6 @@
 from collections import defaultdict
 from pathlib import Path
-from typing import Literal, get_args
+from typing import Any, Literal, get_args
 
 from anthropic.types.beta import BetaToolTextEditor20241022Param
 
@@ -38,6 +38,13 @@ class EditTool(BaseAnthropicTool):
             "type": self.api_type,
         }
 
+    def resources(self, tool_input: dict[str, Any]) -> tuple[set[str], set[str]]:
+        """Views share a file, every other command holds it exclusively."""
+        key = f"file:{Path(str(tool_input.get('path', '')))}"
+        if tool_input.get("command") == "view":
+            return {key}, set()
+        return set(), {key}
+
     async def __call__(
         self,
         *,
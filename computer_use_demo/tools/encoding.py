@@ -0,0 +1,130 @@
+"""
+Screenshot encoding for the computer tool.
+
+Resizing and compressing a frame takes tens of milliseconds, so it
+runs in a small thread pool instead of on the event loop thread. Pillow releases
+the GIL while it compresses, so the pool also lets several agents encode at once.
+"""
+
+import asyncio
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Literal
+
+from PIL import Image, ImageDraw
+
+from ..images import base64_size
+
+ImageFormat = Literal["png", "jpeg", "webp"]
+
+MEDIA_TYPES: dict[str, str] = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="screenshot-encode")
+
+
+@dataclass(frozen=True, kw_only=True)
+class ImageEncoding:
+    """How screenshots are compressed before they are sent to the API."""
+
+    format: ImageFormat = "png"
+    # zlib level for PNG, 0 (fastest) to 9 (smallest)
+    compress_level: int = 6
+    # quality for JPEG and WebP, 1 to 100
+    quality: int = 80
+
+    @classmethod
+    def parse(cls, spec: str) -> "ImageEncoding":
+        """Parse "png", "png:1", "jpeg:75" or "webp:80"."""
+        format, _, level = spec.lower().partition(":")
+        if format == "jpg":
+            format = "jpeg"
+        if format not in MEDIA_TYPES:
+            raise ValueError(f"Unsupported screenshot format: {format}")
+        if not level:
+            return cls(format=format)
+        if format == "png":
+            return cls(format=format, compress_level=int(level))
+        return cls(format=format, quality=int(level))
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.format]
+
+    def encode(self, image: Image.Image) -> bytes:
+        buffer = io.BytesIO()
+        if self.format == "png":
+            image.save(buffer, format="PNG", compress_level=self.compress_level)
+        elif self.format == "jpeg":
+            image.convert("RGB").save(buffer, format="JPEG", quality=self.quality)
+        else:
+            image.save(buffer, format="WEBP", quality=self.quality, method=4)
+        return buffer.getvalue()
+
+
+def _encode(
+    image: Image.Image, encoding: ImageEncoding, size: tuple[int, int] | None
+) -> bytes:
+    if size is not None and image.size != size:
+        image = image.resize(size)
+    return encoding.encode(image)
+
+
+async def encode_image(
+    image: Image.Image,
+    encoding: ImageEncoding,
+    size: tuple[int, int] | None = None,
+) -> bytes:
+    """Resize `image` to `size` if given and return it encoded, off the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor, _encode, image, encoding, size
+    )
+
+
+def sample_desktop_frame(width: int = 1280, height: int = 800) -> Image.Image:
+    """A synthetic desktop with a menu bar, windows and text, for benchmarks."""
+    image = Image.new("RGB", (width, height), (58, 110, 165))
+    draw = ImageDraw.Draw(image)
+    for y in range(0, height, 4):
+        shade = 90 + 60 * y // height
+        draw.line([(0, y), (width, y)], fill=(40, shade, 150 + shade // 3), width=4)
+    draw.rectangle([0, 0, width, 24], fill=(236, 236, 236))
+    for i, (x, y, w, h) in enumerate(
+        [(80, 60, 700, 500), (420, 180, 760, 520), (160, 420, 520, 330)]
+    ):
+        draw.rectangle([x, y, x + w, y + h], fill=(250, 250, 250), outline=(160, 160, 160))
+        draw.rectangle([x, y, x + w, y + 28], fill=(220, 220, 225))
+        for line in range(40, h - 20, 18):
+            text = f"window {i} line {line // 18}: the quick brown fox jumps over the lazy dog"
+            draw.text((x + 12, y + line), text[: w // 7], fill=(30, 30, 30))
+    draw.rectangle([width // 4, height - 60, 3 * width // 4, height - 8], fill=(210, 210, 215))
+    return image
+
+
+BENCHMARK_ENCODINGS = [
+    ImageEncoding(format="png", compress_level=1),
+    ImageEncoding(format="png", compress_level=6),
+    ImageEncoding(format="png", compress_level=9),
+    ImageEncoding(format="jpeg", quality=60),
+    ImageEncoding(format="jpeg", quality=85),
+    ImageEncoding(format="webp", quality=60),
+    ImageEncoding(format="webp", quality=85),
+]
+
+
+def benchmark(
+    images: list[Image.Image], encodings: list[ImageEncoding] = BENCHMARK_ENCODINGS
+) -> list[tuple[ImageEncoding, float, int]]:
+    """Mean encode time in seconds and mean payload bytes (base64) per encoding."""
+    results = []
+    for encoding in encodings:
+        start = time.perf_counter()
+        total_bytes = sum(base64_size(len(_encode(image, encoding, None))) for image in images)
+        elapsed = time.perf_counter() - start
+        results.append((encoding, elapsed / len(images), total_bytes // len(images)))
+    return results
@@ -0,0 +1,62 @@
+"""
+Comparison of captured screen frames, used to avoid sending the model images it
+has already seen.
+"""
+
+import hashlib
+
+from PIL import Image, ImageChops
+
+# a 16x16 difference hash, 256 bits
+PERCEPTUAL_HASH_SIZE = 16
+
+
+def frame_hash(image: Image.Image, exact: bool = True) -> int:
+    """
+    Hash of a frame. The exact hash changes with any pixel; the perceptual hash is a
+    difference hash that changes little for small changes, compare it with
+    `hash_distance`.
+    """
+    if exact:
+        return int.from_bytes(hashlib.blake2b(image.tobytes(), digest_size=16).digest())
+    size = PERCEPTUAL_HASH_SIZE
+    pixels = list(image.convert("L").resize((size + 1, size)).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hash_distance(a: int, b: int) -> int:
+    """Number of differing bits between two hashes."""
+    return (a ^ b).bit_count()
+
+
+def settle_frame(image: Image.Image, factor: int = 8) -> bytes:
+    """A low resolution grayscale thumbnail of a frame, for checking whether the screen is still changing."""
+    width, height = image.size
+    return image.convert("L").resize((max(width // factor, 1), max(height // factor, 1))).tobytes()
+
+
+def changed_region(
+    previous: Image.Image, current: Image.Image, padding: int = 8
+) -> tuple[int, int, int, int] | None:
+    """
+    Bounding box (left, top, right, bottom) of the pixels that differ between two
+    frames of the same size, grown by `padding` pixels of context, or None if the
+    frames are identical.
+    """
+    bbox = ImageChops.difference(previous, current).getbbox()
+    if bbox is None:
+        return None
+    left, top, right, bottom = bbox
+    width, height = current.size
+    return (
+        max(left - padding, 0),
+        max(top - padding, 0),
+        min(right + padding, width),
+        min(bottom + padding, height),
+    )
@@ -0,0 +1,267 @@
+"""
+Keyboard and clipboard backends for the computer tool, and bulk text entry.
+
+Typing sends one key event per character, so long text is pasted through the
+clipboard instead, restoring the previous clipboard contents afterwards. Only
+text can be restored, so nothing is pasted while the clipboard holds an image,
+files or rich text. Short text, and text that cannot be pasted, is typed in
+chunks; each chunk is checked first and a chunk with characters the keyboard
+cannot type is pasted on its own. Typed chunks can be verified against the
+screen, so that typing stops once keystrokes no longer show up.
+"""
+
+import platform
+import re
+import shutil
+import subprocess
+import time
+from abc import ABCMeta, abstractmethod
+from collections.abc import Callable
+
+TYPING_DELAY_MS = 12
+TYPING_GROUP_SIZE = 50
+# text at least this long is pasted rather than typed
+PASTE_MIN_CHARS = 100
+# time the focused application gets to read the clipboard before it is restored
+PASTE_SETTLE_SECONDS = 0.2
+# time the focused application gets to draw a typed chunk before it counts as lost
+VERIFY_SETTLE_SECONDS = 0.1
+# clipboard types that hold plain text, or describe the clipboard rather than hold data
+MAC_TEXT_TYPES = {"«class utf8»", "«class ut16»", "string", "Unicode text"}
+X11_TEXT_TARGETS = {
+    "TARGETS",
+    "TIMESTAMP",
+    "MULTIPLE",
+    "SAVE_TARGETS",
+    "UTF8_STRING",
+    "STRING",
+    "TEXT",
+    "COMPOUND_TEXT",
+}
+
+
+def chunks(s: str, chunk_size: int) -> list[str]:
+    return [s[i : i + chunk_size] for i in range(0, len(s), chunk_size)]
+
+
+class KeyboardBackend(metaclass=ABCMeta):
+    """Sends key events and reads and writes the clipboard. All methods block."""
+
+    name: str
+
+    @abstractmethod
+    def can_type(self, text: str) -> bool:
+        """Whether every character of `text` has a key."""
+        ...
+
+    @abstractmethod
+    def write(self, text: str, interval: float):
+        ...
+
+    @abstractmethod
+    def hotkey(self, *keys: str):
+        ...
+
+    def paste_keys(self) -> tuple[str, ...]:
+        return ("command", "v") if platform.system() == "Darwin" else ("ctrl", "v")
+
+    def clipboard_is_text(self) -> bool:
+        """Whether the clipboard holds nothing but plain text, so restoring its text
+        after a paste loses nothing."""
+        return False
+
+    def get_clipboard(self) -> str | None:
+        """The clipboard text, or None if the clipboard cannot be used."""
+        return None
+
+    def set_clipboard(self, text: str) -> bool:
+        """Replace the clipboard text, returning whether that succeeded."""
+        return False
+
+
+class PyAutoGUIKeyboard(KeyboardBackend):
+    """Key events through pyautogui, clipboard through pbcopy/pbpaste or xclip."""
+
+    name = "pyautogui"
+
+    def __init__(self):
+        if platform.system() == "Darwin":
+            self._copy, self._paste = ["pbcopy"], ["pbpaste"]
+        else:
+            self._copy = ["xclip", "-selection", "clipboard"]
+            self._paste = ["xclip", "-selection", "clipboard", "-o"]
+        self.has_clipboard = shutil.which(self._copy[0]) is not None
+
+    def can_type(self, text: str) -> bool:
+        import pyautogui
+
+        # pyautogui.write silently skips characters that have no key
+        return all(pyautogui.isValidKey(c) for c in text)
+
+    def write(self, text: str, interval: float):
+        import pyautogui
+
+        pyautogui.write(text, interval=interval)
+
+    def hotkey(self, *keys: str):
+        import pyautogui
+
+        pyautogui.hotkey(*keys)
+
+    def clipboard_is_text(self) -> bool:
+        if not self.has_clipboard:
+            return False
+        if platform.system() == "Darwin":
+            result = subprocess.run(
+                ["osascript", "-e", "clipboard info"], capture_output=True, timeout=5
+            )
+            # e.g. "«class PNGf», 1024, «class utf8», 12, Unicode text, 24"
+            types = re.findall(r"([^,]+), \d+", result.stdout.decode(errors="replace"))
+            allowed = MAC_TEXT_TYPES
+        else:
+            result = subprocess.run(
+                self._paste + ["-t", "TARGETS"], capture_output=True, timeout=5
+            )
+            types = result.stdout.decode(errors="replace").split()
+            allowed = X11_TEXT_TARGETS
+        if result.returncode != 0:
+            return False
+        return all(
+            t.strip() in allowed or t.strip().startswith("text/plain") for t in types
+        )
+
+    def get_clipboard(self) -> str | None:
+        if not self.has_clipboard:
+            return None
+        result = subprocess.run(self._paste, capture_output=True, timeout=5)
+        if result.returncode != 0:
+            return None
+        return result.stdout.decode(errors="replace")
+
+    def set_clipboard(self, text: str) -> bool:
+        if not self.has_clipboard:
+            return False
+        result = subprocess.run(self._copy, input=text.encode(), timeout=5)
+        return result.returncode == 0
+
+
+class FakeKeyboard(KeyboardBackend):
+    """
+    An in-memory keyboard: typed and pasted text is appended to `typed`.
+    `key_time` simulates the cost of one key event and `clipboard_time` that of
+    one clipboard read or write. Characters in `untypeable` have no key, and
+    setting `clipboard` to None makes the clipboard unavailable. `clipboard_data`
+    stands for an image, files or rich text on the clipboard, which setting the
+    clipboard text replaces.
+    """
+
+    name = "fake"
+
+    def __init__(
+        self, key_time: float = 0.0, clipboard_time: float = 0.0, untypeable: str = ""
+    ):
+        self.typed = ""
+        self.clipboard: str | None = ""
+        self.clipboard_data: object | None = None
+        self.key_time = key_time
+        self.clipboard_time = clipboard_time
+        self.untypeable = set(untypeable)
+
+    def can_type(self, text: str) -> bool:
+        return not self.untypeable.intersection(text)
+
+    def write(self, text: str, interval: float):
+        time.sleep(len(text) * (self.key_time + interval))
+        self.typed += "".join(c for c in text if c not in self.untypeable)
+
+    def hotkey(self, *keys: str):
+        time.sleep(len(keys) * self.key_time)
+        if keys == self.paste_keys() and self.clipboard:
+            self.typed += self.clipboard
+
+    def clipboard_is_text(self) -> bool:
+        time.sleep(self.clipboard_time)
+        return self.clipboard is not None and self.clipboard_data is None
+
+    def get_clipboard(self) -> str | None:
+        time.sleep(self.clipboard_time)
+        return self.clipboard
+
+    def set_clipboard(self, text: str) -> bool:
+        time.sleep(self.clipboard_time)
+        if self.clipboard is None:
+            return False
+        self.clipboard = text
+        self.clipboard_data = None
+        return True
+
+
+def paste_text(keyboard: KeyboardBackend, text: str) -> bool:
+    """
+    Paste `text` through the clipboard and restore its previous contents. Returns
+    False without touching the clipboard when it holds anything but text.
+    """
+    if not keyboard.clipboard_is_text():
+        return False
+    previous = keyboard.get_clipboard()
+    if previous is None or not keyboard.set_clipboard(text):
+        return False
+    try:
+        keyboard.hotkey(*keyboard.paste_keys())
+        # the application reads the clipboard asynchronously
+        time.sleep(PASTE_SETTLE_SECONDS)
+    finally:
+        keyboard.set_clipboard(previous)
+    return True
+
+
+def type_chunked(
+    keyboard: KeyboardBackend,
+    text: str,
+    interval: float = TYPING_DELAY_MS / 1000,
+    screen_state: Callable[[], object] | None = None,
+) -> list[str]:
+    """
+    Type `text` in chunks of TYPING_GROUP_SIZE characters. A chunk the keyboard
+    cannot type is pasted instead. With `screen_state`, e.g. a hash of the screen,
+    each chunk is verified by the state changing while it is entered; typing
+    stops at the first chunk that leaves the screen unchanged, as the keystrokes
+    most likely went to another window. Returns the chunks that could not be
+    entered, and the unverified chunk with the rest of the text.
+    """
+    failed = []
+    text_chunks = chunks(text, TYPING_GROUP_SIZE)
+    before = screen_state() if screen_state is not None else None
+    for index, chunk in enumerate(text_chunks):
+        if keyboard.can_type(chunk):
+            keyboard.write(chunk, interval)
+        elif not paste_text(keyboard, chunk):
+            failed.append(chunk)
+            continue
+        if screen_state is None:
+            continue
+        after = screen_state()
+        if after == before:
+            time.sleep(VERIFY_SETTLE_SECONDS)
+            after = screen_state()
+        if after == before:
+            return failed + text_chunks[index:]
+        before = after
+    return failed
+
+
+def enter_text(
+    keyboard: KeyboardBackend,
+    text: str,
+    interval: float = TYPING_DELAY_MS / 1000,
+    screen_state: Callable[[], object] | None = None,
+) -> tuple[str, list[str]]:
+    """
+    Enter `text` with the fastest strategy that works: paste when it is at least
+    PASTE_MIN_CHARS long, chunked typing otherwise or when pasting fails, verified
+    with `screen_state` if given. Returns the strategy used and the chunks that
+    could not be entered.
+    """
+    if len(text) >= PASTE_MIN_CHARS and paste_text(keyboard, text):
+        return "paste", []
+    return "type", type_chunked(keyboard, text, interval, screen_state)
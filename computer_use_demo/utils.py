@@ -3,9 +3,10 @@ from pathlib import Path
 import os
 import base64
 import json
+from computer_use_demo.images import get_image_store
 from computer_use_demo.tools import ToolResult
 from anthropic.types.beta import BetaMessage
-from anthropic import APIResponse
+from anthropic import AsyncAPIResponse
 
 
 def save_messages(messages):
@@ -41,15 +42,46 @@ def tool_output_callback(result: ToolResult, tool_use_id: str):
         print(f"> Tool Output [{tool_use_id}]:", result.output)
     if result.error:
         print(f"!!! Tool Error [{tool_use_id}]:", result.error)
-    if result.base64_image:
+    if result.image_ref:
+        store = get_image_store()
+        media_type = result.media_type or "image/png"
+        path = store.path(result.image_ref, media_type)
+        if path is None:
+            # the store is in memory only, write the bytes it holds
+            os.makedirs("screenshots", exist_ok=True)
+            path = Path("screenshots") / f"screenshot_{tool_use_id}.{media_type.split('/')[-1]}"
+            path.write_bytes(store.get(result.image_ref))
+        print(f"Took screenshot {path}")
+    elif result.base64_image:
         # Save the image to a file if needed
         os.makedirs("screenshots", exist_ok=True)
         image_data = result.base64_image
-        with open(f"screenshots/screenshot_{tool_use_id}.png", "wb") as f:
+        extension = (result.media_type or "image/png").split("/")[-1]
+        with open(f"screenshots/screenshot_{tool_use_id}.{extension}", "wb") as f:
             f.write(base64.b64decode(image_data))
-        print(f"Took screenshot screenshot_{tool_use_id}.png")
+        print(f"Took screenshot screenshot_{tool_use_id}.{extension}")
 
-def api_response_callback(response: APIResponse[BetaMessage], step: int=None, role: str = "worker", is_done: bool = False, final_report: str = None, session_number: int = None):
+def _response_content(response: AsyncAPIResponse[BetaMessage] | BetaMessage):
+    """Return the content blocks of a raw API response or of a streamed message."""
+    if isinstance(response, BetaMessage):
+        return response.model_dump(mode="json")["content"]
+    return json.loads(response.http_response.text)["content"]
+
+def _response_usage(response: AsyncAPIResponse[BetaMessage] | BetaMessage):
+    """Return the token usage of a raw API response or of a streamed message."""
+    if isinstance(response, BetaMessage):
+        return response.usage.model_dump()
+    return json.loads(response.http_response.text).get("usage", {})
+
+def _format_usage(usage: dict):
+    return (
+        f"input: {usage.get('input_tokens') or 0}, "
+        f"cache read: {usage.get('cache_read_input_tokens') or 0}, "
+        f"cache write: {usage.get('cache_creation_input_tokens') or 0}, "
+        f"output: {usage.get('output_tokens') or 0}"
+    )
+
+def api_response_callback(response: AsyncAPIResponse[BetaMessage] | BetaMessage, step: int=None, role: str = "worker", is_done: bool = False, final_report: str = None, session_number: int = None):
     if is_done:
         print("\n---------------\nQA think it is Done")
         return
@@ -66,14 +98,16 @@ def api_response_callback(response: APIResponse[BetaMessage], step: int=None, ro
                 print(
                     "\n---------------\nSession: ", session_number+1, " | Manager",
                     "\nAPI Response:\n",
-                    json.dumps(json.loads(response.text)["content"], indent=4),  # type: ignore
+                    json.dumps(_response_content(response), indent=4),
+                    "\nUsage:", _format_usage(_response_usage(response)),
                     "\n",
                 )
         elif role == "qa":
             print(
                 "\n---------------\nSession: ", session_number+1, " | QA",
                 "\nAPI Response:\n",
-                json.dumps(json.loads(response.text)["content"], indent=4),  # type: ignore
+                json.dumps(_response_content(response), indent=4),
+                "\nUsage:", _format_usage(_response_usage(response)),
                 "\n",
             )
         elif role == "worker":
@@ -81,7 +115,8 @@ def api_response_callback(response: APIResponse[BetaMessage], step: int=None, ro
                 "\n---------------\nSession: ", session_number+1, " Step:",
                 step+1,
                 "\nAPI Response:\n",
-                json.dumps(json.loads(response.text)["content"], indent=4),  # type: ignore
+                json.dumps(_response_content(response), indent=4),
+                "\nUsage:", _format_usage(_response_usage(response)),
                 "\n",
             )
         else:
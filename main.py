@@ -4,9 +4,16 @@ import sys
 import dotenv
 import signal
 
-from anthropic import Anthropic
-from openai import OpenAI
+from anthropic import AsyncAnthropic
+from openai import AsyncOpenAI
 from computer_use_demo.loop import sampling_loop, _init_chatbot
+from computer_use_demo.history import MessageHistory
+from computer_use_demo.images import ImageStore, set_image_store
+from computer_use_demo.metrics import MetricsRecorder, set_metrics
+from computer_use_demo.scheduler import RequestScheduler, set_scheduler
+from computer_use_demo.tools import get_capture_backend
+from computer_use_demo.tools.computer import OVERVIEW_WIDTH
+from computer_use_demo.tools.encoding import ImageEncoding
 from anthropic.types.beta import BetaMessageParam
 
 from computer_use_demo.utils import save_messages, load_messages, remove_checkpoints, output_callback, tool_output_callback, api_response_callback
@@ -23,7 +30,8 @@ if api_key == "YOUR_API_KEY_HERE":
     raise ValueError(
         "Please first set your API key in the ANTHROPIC_API_KEY environment variable or in the .env file."
     )
-computer_use_client = Anthropic(api_key=api_key)
+# retries are handled by the shared request scheduler
+computer_use_client = AsyncAnthropic(api_key=api_key, max_retries=0)
 
 # Set up OpenAI API key
 openai_api_key = os.getenv("OPENAI_API_KEY", "YOUR_API_KEY_HERE")
@@ -31,7 +39,29 @@ if openai_api_key == "YOUR_API_KEY_HERE":
     raise ValueError(
         "Please first set your API key in the OPENAI_API_KEY environment variable or in the .env file."
     )
-text_query_client = OpenAI(api_key=openai_api_key)
+text_query_client = AsyncOpenAI(api_key=openai_api_key, max_retries=0)
+
+# Optional rate limits of your Anthropic tier, shared by all agents in this process
+def _limit(name):
+    value = os.getenv(name)
+    return float(value) if value else None
+
+set_scheduler(
+    "anthropic",
+    RequestScheduler(
+        "anthropic",
+        requests_per_minute=_limit("ANTHROPIC_REQUESTS_PER_MINUTE"),
+        input_tokens_per_minute=_limit("ANTHROPIC_INPUT_TOKENS_PER_MINUTE"),
+        output_tokens_per_minute=_limit("ANTHROPIC_OUTPUT_TOKENS_PER_MINUTE"),
+    ),
+)
+
+# Screen capture backend of the computer tool: "pyautogui" (default), "mss" or "x11shm"
+capture_backend = get_capture_backend(os.getenv("SCREEN_CAPTURE_BACKEND", "pyautogui"))
+# Screenshot format sent to the model, e.g. "png:6" (default), "png:1", "jpeg:75" or "webp:80"
+screenshot_encoding = ImageEncoding.parse(os.getenv("SCREENSHOT_FORMAT", "png"))
+# Width of the screenshots the model sees; it zooms in for details
+screenshot_overview_width = int(os.getenv("SCREENSHOT_WIDTH", OVERVIEW_WIDTH))
 
 # # Set up your AgentOps API key
 # agentops_api_key = os.getenv("AGENTOPS_API_KEY", "YOUR_API_KEY_HERE")
@@ -96,7 +126,7 @@ async def main(messages: list[BetaMessageParam] = None, human_intervention: bool
         if saved_messages:
             print("Found saved progress. Would you like to continue? (y/n)")
             if input().lower() == 'y':
-                messages = saved_messages
+                messages.extend(saved_messages)
                 print("Continuing from saved progress...")
             else:
                 print("Starting fresh...")
@@ -118,13 +148,18 @@ async def main(messages: list[BetaMessageParam] = None, human_intervention: bool
         tool_output_callback=tool_output_callback,
         api_response_callback=api_response_callback,
         only_n_most_recent_images=10,
+        context_token_budget=100000,
         max_tokens=4096,
         juji_api_key=juji_api_key,
         juji_chatbot_engagement_id=juji_chatbot_engagement_id,
         juji_platform_url=juji_platform_url,
         human_intervention=human_intervention,
         all_chatbot_messages=all_chatbot_messages,
-        chatbot_participation=chatbot_participation
+        chatbot_participation=chatbot_participation,
+        stream=True,
+        capture_backend=capture_backend,
+        screenshot_encoding=screenshot_encoding,
+        screenshot_overview_width=screenshot_overview_width,
     )
 
     # Save final messages
@@ -132,13 +167,17 @@ async def main(messages: list[BetaMessageParam] = None, human_intervention: bool
 
 
 if __name__ == "__main__":
+    metrics = MetricsRecorder(jsonl_path="metrics/metrics.jsonl")
+    set_metrics(metrics)
+    # screenshots are written once to screenshots/ and referenced by the checkpoints
+    set_image_store(ImageStore(directory="screenshots"))
     if chatbot_link:
         chatbot = Chatbot(chatbot_link)
         all_chatbot_messages, chatbot_participation = _init_chatbot(chatbot)
     else:
         all_chatbot_messages = None
         chatbot_participation = None
-    messages = []
+    messages = MessageHistory()
     human_intervention = False
     while True:
         try:
@@ -157,6 +196,12 @@ if __name__ == "__main__":
             else:
                 messages.append({"content": f"The human user intervened.\n\nplease adjust the plan for the agent to continue completing the task. Please do not use any tools.", "role": "user"})
 
+    metrics.write_prometheus("metrics/metrics.prom")
+    metrics.close()
+    print("\n================\nMetrics summary\n")
+    print(metrics.summary())
+    print("\nFull metrics saved to metrics/metrics.jsonl and metrics/metrics.prom")
+
     # except Exception as e:
     #     print(f"Encountered Error:\n{e}")
 
@@ -0,0 +1,93 @@
+import json
+import threading
+import time
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+import pytest
+
+
+def message(content: list[dict[str, Any]], model: str = "stub", **usage: int) -> dict[str, Any]:
+    """A Messages API response body."""
+    return {
+        "id": "msg_stub",
+        "type": "message",
+        "role": "assistant",
+        "model": model,
+        "content": content,
+        "stop_reason": "tool_use" if any(b["type"] == "tool_use" for b in content) else "end_turn",
+        "stop_sequence": None,
+        "usage": {"input_tokens": 1000, "output_tokens": 50, **usage},
+    }
+
+
+class StubAPI:
+    """
+    A local stand-in for the Messages API. `reply` maps each request body to
+    (status, headers, body); a dict body is sent as JSON and a list of bytes is
+    streamed chunk by chunk, `chunk_delay` seconds apart. Every request waits
+    `latency` seconds first and is recorded in `requests` with its arrival time.
+    """
+
+    def __init__(self):
+        self.latency = 0.0
+        self.chunk_delay = 0.0
+        self.reply: Callable[[dict[str, Any]], tuple[int, dict[str, str], Any]] = (
+            lambda body: (200, {}, message([{"type": "text", "text": "ok"}]))
+        )
+        self.requests: list[tuple[float, dict[str, Any]]] = []
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+                api.requests.append((time.monotonic(), body))
+                time.sleep(api.latency)
+                status, headers, payload = api.reply(body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if isinstance(payload, list):
+                    self.send_header("content-type", "text/event-stream")
+                    self.send_header("connection", "close")
+                    self.end_headers()
+                    for chunk in payload:
+                        self.wfile.write(chunk)
+                        self.wfile.flush()
+                        time.sleep(api.chunk_delay)
+                    self.close_connection = True
+                    return
+                data = json.dumps(payload).encode()
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def handle(self):
+                # clients that give up on a request, e.g. when it is cancelled
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_api():
+    api = StubAPI()
+    yield api
+    api.close()
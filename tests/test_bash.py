@@ -0,0 +1,195 @@
+import asyncio
+import json
+import os
+import resource
+import time
+
+import pytest
+
+from computer_use_demo.metrics import MetricsRecorder, get_metrics, set_metrics
+from computer_use_demo.tools.base import ToolError
+from computer_use_demo.tools.bash import BashJob, SessionPool, _BashSession
+from computer_use_demo.tools.bash_jobs import BashJobsTool
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def session_run(*commands: str, timeout: float | None = None):
+    session = _BashSession()
+    await session.start()
+    try:
+        return [await session.run(command, timeout) for command in commands]
+    finally:
+        await session.close()
+
+
+def test_commands_return_as_soon_as_they_finish():
+    async def main():
+        session = _BashSession()
+        await session.start()
+        start = time.perf_counter()
+        for _ in range(50):
+            await session.run("true")
+        elapsed = time.perf_counter() - start
+        await session.close()
+        return elapsed
+
+    assert run(main()) / 50 < 0.05
+
+
+def test_exit_status_output_and_error():
+    ok, failed = run(session_run("echo out; echo err >&2", "exit_with() { return $1; }; exit_with 3"))
+    assert (ok.output, ok.error, ok.exit_code) == ("out", "err", 0)
+    assert failed.exit_code == 3
+    assert "exit status 3" in failed.system
+
+
+def test_large_output_is_clipped_and_spilled_in_bounded_memory():
+    size = 200 * 1024 * 1024
+
+    async def main():
+        session = _BashSession()
+        await session.start()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = await session.run(f"yes 'the quick brown fox' | head -c {size}")
+        growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        spilled = os.path.getsize(session._spill_files[-1])
+        path = session._spill_files[-1]
+        await session.close()
+        return result, growth, spilled, path
+
+    result, growth_kb, spilled, path = run(main())
+    assert f"stdout was {size} bytes" in result.system
+    assert "<output clipped:" in result.output
+    assert len(result.output) < 20_000
+    assert spilled == size
+    assert growth_kb < 100 * 1024
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize(
+    "command, max_recovery",
+    [
+        # interrupted by SIGINT
+        ("sleep 60", 1.0),
+        # needs SIGKILL after the grace period
+        ("python3 -c 'import signal, time; signal.signal(signal.SIGINT, signal.SIG_IGN); time.sleep(60)'", 3.0),
+        # runs in the shell itself, which is replaced
+        ("while :; do :; done", 5.0),
+    ],
+)
+def test_timeouts_recover_quickly_and_keep_the_shell_state(tmp_path, command, max_recovery):
+    async def main():
+        session = _BashSession()
+        await session.start()
+        await session.run(f"cd {tmp_path} && export RECOVERY_STATE=kept")
+        start = time.perf_counter()
+        try:
+            await session.run(command, timeout=1.0)
+        except ToolError:
+            pass
+        recovery = time.perf_counter() - start - 1.0
+        result = await session.run("echo $PWD $RECOVERY_STATE")
+        await session.close()
+        return recovery, result
+
+    recovery, result = run(main())
+    assert recovery < max_recovery
+    assert result.output == f"{tmp_path} kept"
+
+
+def test_background_jobs_run_concurrently_and_are_cleaned_up():
+    async def main():
+        pool = SessionPool()
+        await (await pool.session()).run("export JOB_STATE=inherited")
+        start = time.perf_counter()
+        jobs = [await pool.start_job(f"sleep 1; echo $JOB_STATE {i}") for i in range(3)]
+        await asyncio.gather(*(job.task for job in jobs))
+        elapsed = time.perf_counter() - start
+        outputs = [job.tail(1) for job in jobs]
+        logs = [job.log_path for job in jobs]
+        await pool.close()
+        return elapsed, outputs, logs, {job.id for job in jobs}
+
+    elapsed, outputs, logs, ids = run(main())
+    assert elapsed < 2.5
+    assert outputs == [f"inherited {i}" for i in range(3)]
+    assert len(ids) == 3
+    assert not any(os.path.exists(path) for path in logs)
+
+
+@pytest.fixture
+def metrics_path(tmp_path):
+    previous = get_metrics()
+    recorder = MetricsRecorder(tmp_path / "metrics.jsonl")
+    set_metrics(recorder)
+    yield recorder.jsonl_path
+    recorder.close()
+    set_metrics(previous)
+
+
+def test_restored_state_is_kept_out_of_the_metrics(tmp_path, metrics_path):
+    secret = "sk-" + "x" * 40
+
+    async def main():
+        pool = SessionPool()
+        await (await pool.session()).run(f"cd {tmp_path} && export API_KEY={secret}")
+        start = time.perf_counter()
+        restarted = await pool.restart()
+        recovery = time.perf_counter() - start
+        restored = await restarted.run("echo $PWD $API_KEY")
+        # a new session starts from the checkpoint of the default one
+        other = await (await pool.session("other")).run("echo $API_KEY")
+        # and so does a shell replaced after a timeout
+        with pytest.raises(ToolError):
+            await restarted.run("while :; do :; done", timeout=0.5)
+        recovered = await restarted.run("echo $API_KEY")
+        await pool.close()
+        return recovery, restored, other, recovered
+
+    recovery, restored, other, recovered = run(main())
+    assert recovery < 1.0
+    assert restored.output == f"{tmp_path} {secret}"
+    assert other.output == recovered.output == secret
+    # only the commands that were run, not the restores
+    commands = [json.loads(line)["command"] for line in metrics_path.read_text().splitlines()]
+    assert commands == [f"cd {tmp_path} && export API_KEY={secret}", "echo $PWD $API_KEY", "echo $API_KEY", "echo $API_KEY"]
+    assert secret not in metrics_path.read_text().split("\n", 1)[1]
+
+
+def test_checkpoint_file_exists_only_while_the_shell_runs():
+    async def main():
+        session = _BashSession()
+        unstarted = session._checkpoint_path
+        await session.start()
+        path = session._checkpoint_path
+        exists = os.path.exists(path)
+        await session.close()
+        return unstarted, path, exists
+
+    unstarted, path, exists = run(main())
+    assert unstarted is None and exists
+    assert not os.path.exists(path)
+
+
+def test_job_failures_are_returned_as_errors():
+    async def main():
+        pool = SessionPool()
+        tool = BashJobsTool(pool)
+        job = await pool.start_job("echo done")
+        await job.task
+        tail = await tool(operation="tail", job=job.id, lines="two")
+
+        async def crash():
+            raise RuntimeError("shell went away")
+
+        failed = BashJob("job-x", "true", "job-x", job.log_path, asyncio.create_task(crash()))
+        await asyncio.wait([failed.task])
+        await pool.close()
+        return tail, failed.result()
+
+    tail, failed = run(main())
+    assert tail.error and "TypeError" in tail.error
+    assert failed.error == "the job failed: RuntimeError: shell went away"
@@ -0,0 +1,32 @@
+import pytest
+from PIL import ImageDraw
+
+from computer_use_demo.tools.capture import (
+    CAPTURE_BACKENDS,
+    FakeScreen,
+    benchmark,
+    get_capture_backend,
+)
+
+
+def test_fake_screen_returns_copies_of_its_image():
+    screen = get_capture_backend("fake")
+    frame = screen.grab()
+    ImageDraw.Draw(screen.image).point((0, 0), fill="black")
+    assert frame.getpixel((0, 0)) == (255, 255, 255)
+    assert screen.grab().getpixel((0, 0)) == (0, 0, 0)
+    assert screen.grabs == 2 and screen.size() == (1280, 800)
+
+
+def test_benchmark_reports_latency_and_throughput():
+    screen = FakeScreen()
+    result = benchmark(screen, frames=10)
+    assert screen.grabs == 11
+    assert 0 < result["mean_ms"] <= result["p95_ms"]
+    assert result["fps"] > 0
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        get_capture_backend("vnc")
+    assert set(CAPTURE_BACKENDS) == {"pyautogui", "mss", "x11shm", "fake"}
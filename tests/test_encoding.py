@@ -0,0 +1,48 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+
+from computer_use_demo.images import base64_size
+from computer_use_demo.tools.encoding import (
+    BENCHMARK_ENCODINGS,
+    ImageEncoding,
+    benchmark,
+    encode_image,
+    sample_desktop_frame,
+)
+
+
+@pytest.mark.parametrize(
+    "spec, encoding",
+    [
+        ("png", ImageEncoding()),
+        ("png:1", ImageEncoding(compress_level=1)),
+        ("jpg:75", ImageEncoding(format="jpeg", quality=75)),
+        ("webp", ImageEncoding(format="webp")),
+    ],
+)
+def test_parse(spec, encoding):
+    assert ImageEncoding.parse(spec) == encoding
+
+
+def test_parse_rejects_unknown_formats():
+    with pytest.raises(ValueError):
+        ImageEncoding.parse("gif")
+
+
+def test_encode_image_resizes_off_the_event_loop():
+    data = asyncio.run(encode_image(sample_desktop_frame(2560, 1600), ImageEncoding(), (1280, 800)))
+    assert Image.open(io.BytesIO(data)).size == (1280, 800)
+
+
+def test_lossy_encodings_are_smaller_than_png():
+    results = {
+        (encoding.format, encoding.compress_level, encoding.quality): size
+        for encoding, seconds, size in benchmark([sample_desktop_frame()], BENCHMARK_ENCODINGS)
+    }
+    png = results[("png", 6, 80)]
+    assert results[("jpeg", 6, 60)] < png and results[("webp", 6, 60)] < png
+    assert results[("png", 9, 80)] <= results[("png", 1, 80)]
+    assert base64_size(3) == 4 and base64_size(4) == 8
@@ -0,0 +1,86 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image, ImageDraw
+
+from computer_use_demo.images import get_image_store
+from computer_use_demo.tools.capture import FakeScreen
+from computer_use_demo.tools.computer import ComputerTool
+from computer_use_demo.tools.computer_batch import ComputerBatchTool
+from computer_use_demo.tools.encoding import sample_desktop_frame
+from computer_use_demo.tools.frames import changed_region, frame_hash, hash_distance
+
+CHANGES = {
+    "caret": lambda draw: draw.line([(600, 400), (600, 428)], fill="black", width=2),
+    "typed word": lambda draw: draw.text((640, 800), "hello world", fill="black"),
+    "button hover": lambda draw: draw.rectangle([1200, 1400, 1400, 1460], fill="blue"),
+    "menu": lambda draw: draw.rectangle([80, 48, 520, 600], fill=(245, 245, 245)),
+}
+
+
+def test_changed_region_bounds_every_changed_pixel():
+    before = Image.new("RGB", (200, 100), "white")
+    after = before.copy()
+    ImageDraw.Draw(after).rectangle([50, 20, 59, 29], fill="black")
+
+    left, top, right, bottom = changed_region(before, after, 0)
+
+    assert (left, top, right, bottom) == (50, 20, 60, 30)
+    assert changed_region(before, before.copy(), 0) is None
+
+
+def test_frame_hash_tells_small_changes_apart():
+    frame = sample_desktop_frame()
+    changed = frame.copy()
+    ImageDraw.Draw(changed).line([(10, 10), (10, 20)], fill="black")
+    assert frame_hash(frame) == frame_hash(frame.copy())
+    assert frame_hash(frame) != frame_hash(changed)
+    assert hash_distance(frame_hash(frame, exact=False), frame_hash(changed, exact=False)) <= 4
+
+
+@pytest.mark.parametrize("name", CHANGES)
+def test_region_diff_sends_exactly_the_changed_area(name):
+    async def run():
+        screen = FakeScreen()
+        screen.image = sample_desktop_frame(2560, 1600)
+        tool = ComputerTool(capture_backend=screen, region_diff=0.25, full_frame_interval=10)
+        size = (tool.target_width, tool.target_height)
+        store = get_image_store()
+        full_bytes = len(store.get((await tool.screenshot()).image_ref))
+
+        previous = screen.image.resize(size)
+        CHANGES[name](ImageDraw.Draw(screen.image))
+        current = screen.image.resize(size)
+        result = await tool.screenshot()
+        return result, store.get(result.image_ref), previous, current, full_bytes
+
+    result, data, previous, current, full_bytes = asyncio.run(run())
+    crop = Image.open(io.BytesIO(data))
+    left, top, right, bottom = changed_region(previous, current)
+
+    assert crop.size == (right - left, bottom - top)
+    assert f"from x={left}, y={top} to x={right}, y={bottom}" in result.output
+    assert crop.tobytes() == current.crop((left, top, right, bottom)).tobytes()
+    assert len(data) < full_bytes
+
+
+def test_full_screenshots_skip_the_unchanged_note_and_the_crop():
+    async def run():
+        screen = FakeScreen()
+        screen.image = sample_desktop_frame(2560, 1600)
+        tool = ComputerTool(capture_backend=screen, region_diff=0.25, full_frame_interval=10)
+        await tool(action="screenshot")
+        unchanged = await tool(action="screenshot")
+        full_unchanged = await tool(action="screenshot", full=True)
+        CHANGES["caret"](ImageDraw.Draw(screen.image))
+        batch = await ComputerBatchTool(tool)(actions=[{"action": "cursor_position"}], full_screenshot=True)
+        return tool, unchanged, full_unchanged, batch
+
+    tool, unchanged, full_unchanged, batch = asyncio.run(run())
+    store = get_image_store()
+    size = (tool.target_width, tool.target_height)
+    assert unchanged.image_ref is None and "has not changed" in unchanged.output
+    for result in (full_unchanged, batch):
+        assert Image.open(io.BytesIO(store.get(result.image_ref))).size == size
+        assert "Only part of the screen" not in (result.output or "")
@@ -0,0 +1,120 @@
+import copy
+import time
+
+import pytest
+
+from computer_use_demo.history import MessageHistory, estimate_tokens
+
+# the full scan lives in the loop, whose RAG dependencies are not in requirements.txt
+pytest.importorskip("llama_index.readers.web")
+
+from computer_use_demo.loop import _inject_prompt_caching, _maybe_filter_to_n_most_recent_images
+
+IMAGES_TO_KEEP = 10
+
+
+def step_messages(step: int) -> list[dict]:
+    return [
+        {
+            "role": "assistant",
+            "content": [
+                {"type": "text", "text": f"Step {step}: taking a screenshot."},
+                {"type": "tool_use", "id": f"toolu_{step}", "name": "computer", "input": {"action": "screenshot"}},
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "tool_result",
+                    "tool_use_id": f"toolu_{step}",
+                    "content": [
+                        {"type": "text", "text": "Took a screenshot."},
+                        {"type": "image", "source": {"type": "image_ref", "media_type": "image/png", "ref": f"{step:064x}"}},
+                    ],
+                }
+            ],
+        },
+    ]
+
+
+def session(messages: list, prune, steps: int) -> float:
+    """Seconds spent pruning after every step of a session."""
+    elapsed = 0.0
+    for step in range(steps):
+        messages.extend(step_messages(step))
+        start = time.perf_counter()
+        prune(messages, IMAGES_TO_KEEP)
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+@pytest.mark.parametrize("steps", [9, 10, 25, 100])
+def test_prune_images_matches_the_full_scan(steps):
+    scanned, indexed = [], MessageHistory()
+    session(scanned, _maybe_filter_to_n_most_recent_images, steps)
+    session(indexed, MessageHistory.prune_images, steps)
+
+    assert list(indexed) == scanned
+    expected_images = steps if steps < IMAGES_TO_KEEP else IMAGES_TO_KEEP + (steps - IMAGES_TO_KEEP) % 10
+    assert indexed.image_count == expected_images
+    assert indexed.estimated_tokens == sum(estimate_tokens(message) for message in scanned)
+
+
+def test_prune_images_cost_does_not_grow_with_the_history():
+    scanned, indexed = [], MessageHistory()
+    scan_time = session(scanned, _maybe_filter_to_n_most_recent_images, 2000)
+    index_time = session(indexed, MessageHistory.prune_images, 2000)
+    assert scan_time / index_time > 20, (scan_time, index_time)
+
+
+def test_index_survives_other_mutations():
+    history = MessageHistory(step_messages(0) + step_messages(1))
+    history.pop()
+    assert history.image_count == 1
+    history.insert(0, {"role": "user", "content": "start"})
+    del history[0]
+    history[1:] = step_messages(2)[1:]
+    assert history.image_count == 1
+    assert history.estimated_tokens == sum(estimate_tokens(message) for message in history)
+
+
+def test_compaction_split_keeps_tool_results_with_their_tool_use():
+    history = MessageHistory([{"role": "user", "content": "Do the task."}])
+    for step in range(20):
+        history.extend(step_messages(step))
+
+    for tokens_to_keep in (0, 1000, 5000, 20_000):
+        split = history.compaction_split(tokens_to_keep)
+        if split:
+            assert history[split]["role"] == "assistant"
+            assert sum(estimate_tokens(m) for m in history[split:]) <= tokens_to_keep
+
+
+def without_cache_control(value):
+    if isinstance(value, dict):
+        return {k: without_cache_control(v) for k, v in value.items() if k != "cache_control"}
+    if isinstance(value, list):
+        return [without_cache_control(v) for v in value]
+    return value
+
+
+def test_a_cached_prefix_survives_every_prune_after_the_first():
+    history = MessageHistory([{"role": "user", "content": "Do the task."}])
+    previous, previous_marked = None, []
+    for step in range(50):
+        history.extend(step_messages(step))
+        history.prune_images(IMAGES_TO_KEEP)
+        _inject_prompt_caching(history)
+        marked = [
+            index
+            for index, message in enumerate(history)
+            if isinstance(message["content"], list) and "cache_control" in message["content"][-1]
+        ]
+        request = without_cache_control(copy.deepcopy(list(history)))
+
+        assert len(marked) <= 2
+        if step > 2 * IMAGES_TO_KEEP:
+            # a breakpoint of the previous request still marks the same bytes
+            assert any(previous[: index + 1] == request[: index + 1] for index in previous_marked), step
+        previous, previous_marked = request, marked
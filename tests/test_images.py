@@ -0,0 +1,116 @@
+import base64
+import pickle
+import tracemalloc
+
+import pytest
+from PIL import ImageDraw
+
+from computer_use_demo.history import MessageHistory
+from computer_use_demo.images import ImageStore, image_ref_block, materialize_images
+from computer_use_demo.tools.encoding import ImageEncoding, sample_desktop_frame
+
+STEPS = 30
+
+
+@pytest.fixture(scope="module")
+def frames() -> list[bytes]:
+    encoding = ImageEncoding()
+    background = sample_desktop_frame()
+    frames = []
+    for step in range(STEPS):
+        frame = background.copy()
+        ImageDraw.Draw(frame).text((100, 100 + 5 * step), f"step {step}", fill="black")
+        frames.append(encoding.encode(frame))
+    return frames
+
+
+def session(frames: list[bytes], use_store: bool) -> tuple[int, int]:
+    """
+    Bytes retained after a session pruned to the 10 most recent screenshots, with
+    a request built at every step as the sampling loop does, and the size of the
+    pickled history.
+    """
+    store = ImageStore()
+    messages = MessageHistory()
+    tracemalloc.start()
+    for step, data in enumerate(frames):
+        # a fresh copy, as the encoder would return
+        data = bytes(bytearray(data))
+        if use_store:
+            image = image_ref_block(store.put(data, "image/png"), "image/png")
+        else:
+            image = {
+                "type": "image",
+                "source": {"type": "base64", "media_type": "image/png", "data": base64.b64encode(data).decode()},
+            }
+        messages.append(
+            {"role": "assistant", "content": [{"type": "tool_use", "id": f"t{step}", "name": "computer", "input": {"action": "screenshot"}}]}
+        )
+        messages.append({"role": "user", "content": [{"type": "tool_result", "tool_use_id": f"t{step}", "content": [image]}]})
+        messages.prune_images(10)
+        if use_store:
+            store.retain(messages.session_id, messages.image_refs())
+            request = materialize_images(messages, store)
+        else:
+            request = list(messages)
+        del request
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if use_store:
+        assert len(store) == messages.image_count
+    return retained, len(pickle.dumps(messages))
+
+
+def test_store_keeps_a_fraction_of_the_base64_history(frames):
+    embedded, embedded_checkpoint = session(frames, use_store=False)
+    stored, stored_checkpoint = session(frames, use_store=True)
+    # raw bytes instead of base64 text
+    assert stored < 0.8 * embedded
+    assert stored_checkpoint < embedded_checkpoint / 100
+
+
+def test_materialize_images_inlines_references_only_in_the_request():
+    store = ImageStore()
+    key = store.put(b"png bytes", "image/png")
+    messages = [{"role": "user", "content": [{"type": "tool_result", "tool_use_id": "t", "content": [image_ref_block(key, "image/png")]}]}]
+
+    request = materialize_images(messages, store)
+
+    assert request[0]["content"][0]["content"][0]["source"] == {
+        "type": "base64",
+        "media_type": "image/png",
+        "data": base64.b64encode(b"png bytes").decode(),
+    }
+    assert messages[0]["content"][0]["content"][0]["source"]["type"] == "image_ref"
+
+
+def test_retain_drops_images_no_history_refers_to():
+    store = ImageStore()
+    first, second = store.put(b"first", "image/png"), store.put(b"second", "image/png")
+    store.retain("a", {first, second})
+    store.retain("b", {second})
+    store.retain("a", {second})
+    assert len(store) == 1 and store.get(second) == b"second"
+    store.retain("a", set())
+    store.retain("b", set())
+    assert len(store) == 0
+
+
+def test_retain_keeps_unclaimed_images_only_for_a_while(monkeypatch):
+    store = ImageStore()
+    now = 1000.0
+    monkeypatch.setattr("computer_use_demo.images.time.monotonic", lambda: now)
+    in_flight = store.put(b"in flight", "image/png")
+    store.retain("a", set())
+    assert store.get(in_flight) == b"in flight"
+
+    now += store.unclaimed_seconds + 1
+    claimed = store.put(b"claimed", "image/png")
+    store.retain("a", {claimed})
+    assert len(store) == 1 and store.get(claimed) == b"claimed"
+
+
+def test_histories_own_images_by_session_id():
+    first, second = MessageHistory(), MessageHistory()
+    assert first.session_id != second.session_id
+    assert pickle.loads(pickle.dumps(first)).session_id != first.session_id
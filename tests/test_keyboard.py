@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+from computer_use_demo.tools.keyboard import (
+    PASTE_MIN_CHARS,
+    FakeKeyboard,
+    enter_text,
+    paste_text,
+    type_chunked,
+)
+
+TEXT = ("The quick brown fox jumps over the lazy dog. " * 50)[:2000]
+
+
+@pytest.mark.parametrize("length", [20, PASTE_MIN_CHARS, 2000])
+@pytest.mark.parametrize("strategy", [type_chunked, paste_text, enter_text])
+def test_strategies_enter_the_text_and_restore_the_clipboard(strategy, length):
+    keyboard = FakeKeyboard()
+    keyboard.clipboard = "previous"
+    strategy(keyboard, TEXT[:length], **({} if strategy is paste_text else {"interval": 0}))
+    assert keyboard.typed == TEXT[:length]
+    assert keyboard.clipboard == "previous"
+
+
+def test_enter_text_pastes_long_text_faster_than_typing():
+    # roughly the cost of a real key event and clipboard subprocess
+    typed, pasted = FakeKeyboard(key_time=0.002, clipboard_time=0.01), FakeKeyboard(key_time=0.002, clipboard_time=0.01)
+    start = time.perf_counter()
+    type_chunked(typed, TEXT[:500], interval=0)
+    typing = time.perf_counter() - start
+    start = time.perf_counter()
+    assert enter_text(pasted, TEXT[:500], interval=0) == ("paste", [])
+    pasting = time.perf_counter() - start
+    assert pasted.typed == typed.typed == TEXT[:500]
+    assert pasting < typing / 2
+
+
+def test_untypeable_chunks_are_pasted_on_their_own():
+    keyboard = FakeKeyboard(untypeable="é")
+    assert type_chunked(keyboard, "a" * 60 + "café", interval=0) == []
+    assert keyboard.typed == "a" * 60 + "café"
+
+
+def test_clipboard_with_other_data_is_never_pasted_over():
+    keyboard = FakeKeyboard(untypeable="é")
+    keyboard.clipboard_data = image = object()
+
+    assert not paste_text(keyboard, TEXT)
+    assert enter_text(keyboard, TEXT[:200], interval=0) == ("type", [])
+    assert type_chunked(keyboard, "café", interval=0) == ["café"]
+    assert keyboard.typed == TEXT[:200]
+    assert keyboard.clipboard_data is image
+
+
+def test_unavailable_clipboard_falls_back_to_typing():
+    keyboard = FakeKeyboard()
+    keyboard.clipboard = None
+    assert enter_text(keyboard, TEXT[:200], interval=0) == ("type", [])
+    assert keyboard.typed == TEXT[:200]
+
+
+class LosesFocus(FakeKeyboard):
+    """Keystrokes after the first `chars` go to another window."""
+
+    def __init__(self, chars: int):
+        super().__init__()
+        self.chars = chars
+        self.writes = 0
+
+    def write(self, text: str, interval: float):
+        self.writes += 1
+        if len(self.typed) < self.chars:
+            super().write(text, interval)
+
+
+def test_typed_chunks_are_verified_against_the_screen():
+    keyboard = FakeKeyboard()
+    assert type_chunked(keyboard, TEXT[:120], interval=0, screen_state=lambda: keyboard.typed) == []
+    assert keyboard.typed == TEXT[:120]
+
+
+def test_typing_stops_at_the_first_chunk_that_does_not_show_up():
+    keyboard = LosesFocus(50)
+    failed = type_chunked(keyboard, TEXT[:170], interval=0, screen_state=lambda: keyboard.typed)
+    assert keyboard.typed == TEXT[:50]
+    assert failed == [TEXT[50:100], TEXT[100:150], TEXT[150:170]]
+    assert keyboard.writes == 2
+    assert enter_text(LosesFocus(0), "hello", interval=0, screen_state=lambda: "") == ("type", ["hello"])
@@ -0,0 +1,269 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+from anthropic import Anthropic, AsyncAnthropic
+from openai import AsyncOpenAI
+
+# the RAG dependencies of the loop are not in requirements.txt
+pytest.importorskip("llama_index.readers.web")
+
+from computer_use_demo.history import CHARS_PER_TOKEN, estimate_tokens
+from computer_use_demo.loop import (
+    QA_SYSTEM_PROMPT,
+    WORKER_SYSTEM_PROMPT,
+    _stream_worker_step,
+    sampling_loop,
+)
+from computer_use_demo.routing import Route
+from computer_use_demo.scheduler import get_scheduler, set_scheduler
+from computer_use_demo.tools import ToolCollection, ToolResult
+from computer_use_demo.tools.base import BaseAnthropicTool
+
+from conftest import message
+from test_scheduler import charged, frozen_scheduler
+
+BASH_ECHO = {"type": "tool_use", "id": "toolu_echo", "name": "bash", "input": {"command": "echo $((6 * 7))"}}
+
+
+def is_worker(body: dict[str, Any]) -> bool:
+    return body["system"][0]["text"].startswith(WORKER_SYSTEM_PROMPT)
+
+
+def scripted_reply(body: dict[str, Any]):
+    """The manager plans, the worker runs one command and stops, QA approves."""
+    system = body["system"][0]["text"]
+    last = body["messages"][-1]["content"]
+    if system.startswith(QA_SYSTEM_PROMPT):
+        # the verdict only counts when the loop forces the tool
+        verdict = {"is_complete": body.get("tool_choice") == {"type": "tool", "name": "qa_verdict"}, "feedback": "Done."}
+        content = [{"type": "tool_use", "id": "toolu_qa", "name": "qa_verdict", "input": verdict}]
+    elif not is_worker(body):
+        content = [{"type": "text", "text": "Run echo, then stop."}]
+    elif isinstance(last, list) and any(block.get("type") == "tool_result" for block in last):
+        content = [{"type": "text", "text": "The command ran."}]
+    else:
+        content = [BASH_ECHO]
+    return 200, {}, message(content, model=body["model"])
+
+
+def blocking_client(base_url: str) -> Any:
+    """A synchronous client behind the interface the loop awaits, as it used to call it."""
+    client = Anthropic(base_url=base_url, api_key="stub", max_retries=0)
+
+    async def create(**params):
+        response = client.beta.messages.with_raw_response.create(**params)
+
+        async def parse():
+            return response.parse()
+
+        return SimpleNamespace(
+            http_request=response.http_request,
+            http_response=response.http_response,
+            parse=parse,
+        )
+
+    return SimpleNamespace(
+        beta=SimpleNamespace(messages=SimpleNamespace(with_raw_response=SimpleNamespace(create=create)))
+    )
+
+
+def loop_kwargs(**kwargs) -> dict[str, Any]:
+    return dict(
+        model="stub",
+        messages=[],
+        text_query_client=AsyncOpenAI(api_key="stub"),
+        output_callback=lambda block: None,
+        tool_output_callback=lambda result, tool_use_id: None,
+        api_response_callback=lambda *args, **kwargs: None,
+        capture_backend="fake",
+        prefetch_screenshots=False,
+        **kwargs,
+    )
+
+
+def tool_outputs(messages) -> list[str]:
+    return [
+        item["text"]
+        for message in messages
+        if isinstance(message["content"], list)
+        for block in message["content"]
+        if isinstance(block, dict) and block.get("type") == "tool_result"
+        for item in block["content"]
+    ]
+
+
+async def run_loops(client, loops: int) -> float:
+    kwargs = loop_kwargs()
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(
+            sampling_loop(computer_use_client=client, instruction="Work out 6 * 7.", **kwargs)
+            for _ in range(loops)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    for messages in results:
+        assert any(output.endswith("42") for output in tool_outputs(messages))
+        assert json.loads(messages[-1]["content"]) == {"is_complete": True, "feedback": "Done."}
+    return elapsed
+
+
+def test_concurrent_loops_overlap_their_api_calls(stub_api):
+    # five calls per loop: plan, two worker turns, QA and the final report
+    stub_api.latency = 0.2
+    stub_api.reply = scripted_reply
+    client = AsyncAnthropic(base_url=stub_api.base_url, api_key="stub", max_retries=0)
+    asyncio.run(run_loops(client, 1))  # warm up
+
+    awaited = asyncio.run(run_loops(client, 8))
+    blocked = asyncio.run(run_loops(blocking_client(stub_api.base_url), 8))
+
+    assert blocked >= 8 * 5 * stub_api.latency
+    assert blocked / awaited > 3, (blocked, awaited)
+
+
+@pytest.mark.parametrize("budget", [None, 20_000])
+def test_request_size_stays_within_the_token_budget(stub_api, budget):
+    # the worker never finishes: 80 turns of about 3,500 tokens of output each
+    worker_tokens = []
+
+    def reply(body):
+        if not is_worker(body):
+            return scripted_reply(body)
+        system = body["system"][0]["text"]
+        worker_tokens.append(
+            len(system) // CHARS_PER_TOKEN + sum(estimate_tokens(m) for m in body["messages"])
+        )
+        command = {"type": "tool_use", "id": f"toolu_{len(body['messages'])}", "name": "bash", "input": {"command": "seq 3000"}}
+        return 200, {}, message([command], model=body["model"])
+
+    stub_api.reply = reply
+    client = AsyncAnthropic(base_url=stub_api.base_url, api_key="stub", max_retries=0)
+
+    asyncio.run(
+        sampling_loop(
+            computer_use_client=client,
+            instruction="Count to 3000, again and again.",
+            **loop_kwargs(context_token_budget=budget),
+        )
+    )
+
+    assert len(worker_tokens) == 80
+    if budget is None:
+        assert worker_tokens[-1] > 250_000
+    else:
+        # the history is compacted before any request that would exceed the budget
+        assert max(worker_tokens) <= budget + worker_tokens[0]
+
+
+def sse(event: str, data: dict[str, Any]) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+def tool_use_stream(model: str, fail: bool = False) -> list[bytes]:
+    """A streamed worker turn calling the record tool, optionally cut off by an error after it."""
+    start = message([], model=model, input_tokens=1000, output_tokens=1)
+    events = [
+        sse("message_start", {"type": "message_start", "message": {**start, "stop_reason": None}}),
+        sse("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "tool_use", "id": "toolu_record", "name": "record", "input": {}}}),
+        sse("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "input_json_delta", "partial_json": '{"step": 1}'}}),
+        sse("content_block_stop", {"type": "content_block_stop", "index": 0}),
+    ]
+    if fail:
+        return events + [sse("error", {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}})]
+    return events + [
+        sse("message_delta", {"type": "message_delta", "delta": {"stop_reason": "tool_use", "stop_sequence": None}, "usage": {"output_tokens": 50}}),
+        sse("message_stop", {"type": "message_stop"}),
+    ]
+
+
+class RecordTool(BaseAnthropicTool):
+    """Records when it starts."""
+
+    def __init__(self):
+        self.started: list[float] = []
+        super().__init__()
+
+    def to_params(self):
+        return {"name": "record", "description": "Record a step.", "input_schema": {"type": "object", "properties": {"step": {"type": "integer"}}}}
+
+    async def __call__(self, step: int = 0, **kwargs):
+        self.started.append(time.monotonic())
+        return ToolResult(output=f"recorded {step}")
+
+
+@pytest.fixture
+def scheduler():
+    previous = get_scheduler("anthropic")
+    scheduler = frozen_scheduler()
+    set_scheduler("anthropic", scheduler)
+    yield scheduler
+    set_scheduler("anthropic", previous)
+
+
+def stream_step(stub_api, route: Route):
+    tool = RecordTool()
+    client = AsyncAnthropic(base_url=stub_api.base_url, api_key="stub", max_retries=0)
+
+    async def main():
+        response, batch, first_action_at = await _stream_worker_step(
+            client,
+            ToolCollection(tool),
+            route=route,
+            system="You record steps.",
+            messages=[{"role": "user", "content": "Record step 1."}],
+            output_callback=lambda block: None,
+            tool_output_callback=lambda result, tool_use_id: None,
+        )
+        return response, await batch.results(), first_action_at
+
+    return (*asyncio.run(main()), tool)
+
+
+def test_stream_starts_tools_before_the_message_ends(stub_api, scheduler):
+    stub_api.chunk_delay = 0.3
+    stub_api.reply = lambda body: (200, {}, tool_use_stream(body["model"]))
+
+    response, results, first_action_at, tool = stream_step(stub_api, Route(model="stub", use_tools=True))
+
+    arrived, body = stub_api.requests[0]
+    assert body["stream"] is True
+    # message_stop is the sixth chunk, sent after five delays
+    assert tool.started[0] < arrived + 5 * stub_api.chunk_delay
+    assert first_action_at < 5 * stub_api.chunk_delay
+    assert [block.type for block in response.content] == ["tool_use"]
+    assert results == [("toolu_record", ToolResult(output="recorded 1"))]
+    assert charged(scheduler) == (1000, 50)
+
+
+def test_stream_falls_back_when_the_model_is_overloaded(stub_api, scheduler):
+    def reply(body):
+        if body["model"] == "primary":
+            return 529, {}, {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}}
+        return 200, {}, tool_use_stream(body["model"])
+
+    stub_api.reply = reply
+
+    response, results, _, _ = stream_step(stub_api, Route(model="primary", fallback_model="fallback", use_tools=True))
+
+    assert [body["model"] for _, body in stub_api.requests] == ["primary", "fallback"]
+    assert response.model == "fallback"
+    assert results == [("toolu_record", ToolResult(output="recorded 1"))]
+    assert charged(scheduler) == (1000, 50)
+
+
+def test_stream_failing_after_a_tool_started_keeps_the_turn(stub_api, scheduler):
+    stub_api.reply = lambda body: (200, {}, tool_use_stream(body["model"], fail=True))
+
+    response, results, _, tool = stream_step(stub_api, Route(model="stub", use_tools=True))
+
+    # not replayed, since the tool has already run
+    assert len(stub_api.requests) == 1 and len(tool.started) == 1
+    assert [block.id for block in response.content] == ["toolu_record"]
+    assert response.stop_reason == "tool_use"
+    assert results == [("toolu_record", ToolResult(output="recorded 1"))]
+    assert charged(scheduler) == (1000, 1)
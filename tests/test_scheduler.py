@@ -0,0 +1,104 @@
+import asyncio
+
+import anthropic
+import pytest
+
+from computer_use_demo.scheduler import RequestScheduler, anthropic_usage
+
+from conftest import message
+
+ERRORS = {429: "rate_limit_error", 529: "overloaded_error"}
+
+
+def frozen_scheduler(max_retries: int = 3) -> RequestScheduler:
+    scheduler = RequestScheduler(
+        "anthropic",
+        input_tokens_per_minute=100_000,
+        output_tokens_per_minute=100_000,
+        max_retries=max_retries,
+        base_delay=0.05,
+    )
+    # no refill, so the levels show exactly what is still charged
+    for bucket in (scheduler.input_tokens, scheduler.output_tokens):
+        bucket._refill = lambda: None
+    return scheduler
+
+
+def charged(scheduler: RequestScheduler) -> tuple[float, float]:
+    return (
+        scheduler.input_tokens.capacity - scheduler.input_tokens.level,
+        scheduler.output_tokens.capacity - scheduler.output_tokens.level,
+    )
+
+
+def plan_replies(stub_api, plan: list[tuple[int, dict[str, str]]]):
+    plan = list(plan)
+
+    def reply(body):
+        if not plan:
+            return 200, {}, message([{"type": "text", "text": "ok"}], input_tokens=800, output_tokens=100)
+        status, headers = plan.pop(0)
+        return status, headers, {"type": "error", "error": {"type": ERRORS[status], "message": "try later"}}
+
+    stub_api.reply = reply
+
+
+async def request(stub_api, scheduler: RequestScheduler):
+    client = anthropic.AsyncAnthropic(base_url=stub_api.base_url, api_key="stub", max_retries=0)
+    return await scheduler.call(
+        lambda: client.beta.messages.with_raw_response.create(
+            model="stub", max_tokens=4096, messages=[{"role": "user", "content": "hi"}]
+        ),
+        input_tokens=1000,
+        output_tokens=4096,
+        usage=anthropic_usage,
+    )
+
+
+@pytest.mark.parametrize(
+    "plan, asked",
+    [
+        ([(429, {"retry-after-ms": "300"}), (429, {"retry-after-ms": "500"})], [0.3, 0.5]),
+        ([(429, {"retry-after": "1"}), (529, {})], [1.0, 0.0]),
+    ],
+)
+def test_retries_wait_as_long_as_the_server_asks(stub_api, plan, asked):
+    plan_replies(stub_api, plan)
+    scheduler = frozen_scheduler()
+
+    asyncio.run(request(stub_api, scheduler))
+
+    arrivals = [arrived for arrived, _ in stub_api.requests]
+    assert len(arrivals) == len(plan) + 1
+    waits = [later - earlier for earlier, later in zip(arrivals, arrivals[1:])]
+    assert all(waited >= expected for waited, expected in zip(waits, asked)), waits
+    # only the actual usage of the successful attempt stays charged
+    assert charged(scheduler) == (800, 100)
+
+
+def test_gives_up_after_max_retries_with_nothing_charged(stub_api):
+    plan_replies(stub_api, [(429, {"retry-after-ms": "50"})] * 10)
+    scheduler = frozen_scheduler(max_retries=3)
+
+    with pytest.raises(anthropic.RateLimitError):
+        asyncio.run(request(stub_api, scheduler))
+
+    assert len(stub_api.requests) == 4
+    assert charged(scheduler) == (0, 0)
+
+
+def test_cancelled_call_gives_back_its_reservation(stub_api):
+    stub_api.latency = 1.0
+    scheduler = frozen_scheduler()
+
+    async def main():
+        task = asyncio.create_task(request(stub_api, scheduler))
+        while not stub_api.requests:
+            await asyncio.sleep(0.01)
+        assert charged(scheduler) == (1000, 4096)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert charged(scheduler) == (0, 0)